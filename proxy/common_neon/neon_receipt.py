@@ -0,0 +1,137 @@
+"""Single-pass decoding of the Neon events in a confirmed solana transaction.
+
+A getConfirmedTransaction result is walked once: the evm_loader instructions, their OnEvent logs and
+the OnReturn result are decoded from base58 into a compact NeonReceipt that every consumer shares.
+Decoded receipts are cached by transaction signature, so the cost accounting, the measurements and
+the continue loop of the same receipt decode it only once.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+import base58
+
+NEON_RECEIPT_CACHE_SIZE = int(os.environ.get("NEON_RECEIPT_CACHE_SIZE", "4096"))
+
+ON_RETURN_TAG = 6
+ON_EVENT_TAG = 7
+# OnReturn exit statuses from 0xd0 up are errors
+EXIT_STATUS_ERROR = 0xd0
+
+
+class NeonInstruction(NamedTuple):
+    index: int
+    program: str
+    accounts: List[str]
+    data: bytes
+
+    @property
+    def tag(self) -> Optional[int]:
+        return self.data[0] if len(self.data) else None
+
+
+class NeonEvent(NamedTuple):
+    instruction_index: int
+    address: bytes
+    topics: List[bytes]
+    data: bytes
+
+
+class NeonReturn(NamedTuple):
+    instruction_index: int
+    exit_status: int
+    gas_used: int
+    return_value: bytes
+
+    @property
+    def succeeded(self) -> bool:
+        return self.exit_status < EXIT_STATUS_ERROR
+
+
+class NeonReceipt(NamedTuple):
+    signature: Optional[str]
+    slot: Optional[int]
+    instructions: List[NeonInstruction]
+    events: List[NeonEvent]
+    result: Optional[NeonReturn]
+
+    def evm_instructions(self, program_id) -> List[NeonInstruction]:
+        return [instruction for instruction in self.instructions if instruction.program == program_id]
+
+
+def decode_event(instruction_index, data) -> NeonEvent:
+    count_topics = int.from_bytes(data[21:29], 'little')
+    pos = 29 + 32 * count_topics
+    topics = [data[offset:offset + 32] for offset in range(29, pos, 32)]
+    return NeonEvent(instruction_index, data[1:21], topics, data[pos:])
+
+
+def parse_neon_receipt(trx, program_id) -> NeonReceipt:
+    """Decode a getConfirmedTransaction result (the 'result' field) without caching."""
+    message = trx['transaction']['message']
+    accounts = message['accountKeys']
+
+    instructions = []
+    evm_loader_instructions = set()
+    for idx, instruction in enumerate(message['instructions']):
+        program = accounts[instruction['programIdIndex']]
+        if program == program_id:
+            evm_loader_instructions.add(idx)
+        instructions.append(NeonInstruction(idx, program,
+                                            [accounts[acc] for acc in instruction['accounts']],
+                                            base58.b58decode(instruction['data'])))
+
+    events = []
+    result = None
+    for inner in (trx['meta'].get('innerInstructions') or []):
+        if inner['index'] not in evm_loader_instructions:
+            continue
+        for event in inner['instructions']:
+            if accounts[event['programIdIndex']] != program_id:
+                continue
+            data = base58.b58decode(event['data'])
+            if len(data) == 0:
+                continue
+            if data[0] == ON_EVENT_TAG:
+                events.append(decode_event(inner['index'], data))
+            elif data[0] == ON_RETURN_TAG:
+                result = NeonReturn(inner['index'], data[1], int.from_bytes(data[2:10], 'little'), data[10:])
+
+    signatures = trx['transaction'].get('signatures') or [None]
+    return NeonReceipt(signatures[0], trx.get('slot'), instructions, events, result)
+
+
+class NeonReceiptCache:
+    """Thread-safe LRU of decoded receipts by transaction signature."""
+
+    def __init__(self, max_size=NEON_RECEIPT_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.receipts: Dict[str, NeonReceipt] = OrderedDict()
+
+    def get(self, trx, program_id) -> NeonReceipt:
+        signatures = trx['transaction'].get('signatures')
+        signature = signatures[0] if signatures else None
+        if signature is not None:
+            with self.lock:
+                receipt = self.receipts.get(signature)
+                if receipt is not None:
+                    self.receipts.move_to_end(signature)
+                    return receipt
+
+        receipt = parse_neon_receipt(trx, program_id)
+        if signature is not None and self.max_size > 0:
+            with self.lock:
+                self.receipts[signature] = receipt
+                while len(self.receipts) > self.max_size:
+                    self.receipts.popitem(last=False)
+        return receipt
+
+
+receipt_cache = NeonReceiptCache()
+
+
+def decode_neon_receipt(trx, program_id) -> NeonReceipt:
+    """The decoded receipt of a getConfirmedTransaction result, shared by all callers."""
+    return receipt_cache.get(trx, program_id)
@@ -9,17 +9,17 @@
     :license: BSD, see LICENSE for more details.
 """
 import os
+import time
 import socket
 import logging
 import asyncio
 import selectors
-import contextlib
 import multiprocessing
 from multiprocessing import connection
 from multiprocessing.reduction import recv_handle
 
 from abc import ABC, abstractmethod
-from typing import Dict, Optional, Tuple, List, Union, Generator, Any, Type
+from typing import Dict, Optional, Tuple, List, Union, Any, Type
 from uuid import uuid4, UUID
 
 from .connection import TcpClientConnection
@@ -105,6 +105,12 @@ class Threadless(multiprocessing.Process):
 
     HttpProtocolHandler implements ThreadlessWork class and hooks into the
     event loop provided by Threadless.
+
+    Descriptors stay registered with the selector between iterations. After a
+    work runs, its get_events() is compared with its registrations and only
+    the differences reach the selector (register / modify / unregister).
+    Only works with ready descriptors are dispatched, so idle connections
+    cost nothing per wakeup.
     """
 
     def __init__(
@@ -121,30 +127,65 @@ class Threadless(multiprocessing.Process):
 
         self.running = multiprocessing.Event()
         self.works: Dict[int, ThreadlessWork] = {}
+        # Events each work is currently registered for, by work fileno
+        self.registered: Dict[int, Dict[socket.socket, int]] = {}
+        self.last_cleanup = 0.0
         self.selector: Optional[selectors.DefaultSelector] = None
         self.loop: Optional[asyncio.AbstractEventLoop] = None
 
-    @contextlib.contextmanager
-    def selected_events(self) -> Generator[Tuple[List[Union[int, HasFileno]],
-                                                 List[Union[int, HasFileno]]],
-                                           None, None]:
-        events: Dict[socket.socket, int] = {}
-        for work in self.works.values():
-            events.update(work.get_events())
+    def unregister(self, fd: socket.socket) -> None:
+        assert self.selector is not None
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            # Already closed and dropped by the selector
+            pass
+
+    def update_events(self, work_ids: List[int]) -> None:
+        """Apply the changes of get_events() of work_ids since their last update to the selector.
+
+        Removals of all works go first, a closed descriptor number may be
+        reused by another work in the same iteration."""
+        assert self.selector is not None
+        changes: List[Tuple[int, Dict[socket.socket, int]]] = []
+        for work_id in work_ids:
+            if work_id not in self.works:
+                continue
+            events = self.works[work_id].get_events()
+            registered = self.registered.setdefault(work_id, {})
+            for fd in [fd for fd in registered if fd not in events]:
+                self.unregister(fd)
+                del registered[fd]
+            changes.append((work_id, events))
+        for work_id, events in changes:
+            registered = self.registered[work_id]
+            for fd, mask in events.items():
+                if fd not in registered:
+                    try:
+                        self.selector.register(fd, mask, work_id)
+                    except KeyError:
+                        # Stale registration of a closed descriptor with the same number
+                        self.unregister(self.selector.get_key(fd).fileobj)
+                        self.selector.register(fd, mask, work_id)
+                elif registered[fd] != mask:
+                    self.selector.modify(fd, mask, work_id)
+                registered[fd] = mask
+
+    def selected_events(self) -> Dict[int, Tuple[List[Union[int, HasFileno]],
+                                                 List[Union[int, HasFileno]]]]:
+        """Ready descriptors by work fileno, the client queue under -1."""
         assert self.selector is not None
-        for fd in events:
-            self.selector.register(fd, events[fd])
         ev = self.selector.select(timeout=1)
-        readables = []
-        writables = []
+        ready: Dict[int, Tuple[List[Union[int, HasFileno]],
+                               List[Union[int, HasFileno]]]] = {}
         for key, mask in ev:
+            work_id = key.data if key.data is not None else -1
+            readables, writables = ready.setdefault(work_id, ([], []))
             if mask & selectors.EVENT_READ:
                 readables.append(key.fileobj)
             if mask & selectors.EVENT_WRITE:
                 writables.append(key.fileobj)
-        yield (readables, writables)
-        for fd in events.keys():
-            self.selector.unregister(fd)
+        return ready
 
     async def handle_events(
             self, fileno: int,
@@ -170,7 +211,7 @@ class Threadless(multiprocessing.Process):
             fileno, family=socket.AF_INET if self.flags.hostname.version == 4 else socket.AF_INET6,
             type=socket.SOCK_STREAM)
 
-    def accept_client(self) -> None:
+    def accept_client(self) -> Optional[int]:
         addr = self.client_queue.recv()
         fileno = recv_handle(self.client_queue)
         self.works[fileno] = self.work_klass(
@@ -190,6 +231,8 @@ class Threadless(multiprocessing.Process):
                 'Exception occurred during initialization',
                 exc_info=e)
             self.cleanup(fileno)
+            return None
+        return fileno
 
     def cleanup_inactive(self) -> None:
         inactive_works: List[int] = []
@@ -200,6 +243,9 @@ class Threadless(multiprocessing.Process):
             self.cleanup(work_id)
 
     def cleanup(self, work_id: int) -> None:
+        # Unregister before the descriptors are closed and their numbers reused
+        for fd in self.registered.pop(work_id, {}):
+            self.unregister(fd)
         # TODO: HttpProtocolHandler.shutdown can call flush which may block
         self.works[work_id].shutdown()
         del self.works[work_id]
@@ -207,28 +253,28 @@ class Threadless(multiprocessing.Process):
 
     def run_once(self) -> None:
         assert self.loop is not None
-        with self.selected_events() as (readables, writables):
-            if len(readables) == 0 and len(writables) == 0:
-                # Remove and shutdown inactive connections
-                self.cleanup_inactive()
-                return
+        ready = self.selected_events()
         # Note that selector from now on is idle,
         # until all the logic below completes.
         #
-        # Invoke Threadless.handle_events
-        # TODO: Only send readable / writables that client originally
-        # registered.
+        # Invoke Threadless.handle_events of the works with ready descriptors only,
+        # with their own descriptors
         tasks = {}
-        for fileno in self.works:
-            tasks[fileno] = self.loop.create_task(
-                self.handle_events(fileno, readables, writables))
+        for fileno, (readables, writables) in ready.items():
+            if fileno in self.works:
+                tasks[fileno] = self.loop.create_task(
+                    self.handle_events(fileno, readables, writables))
         # Accepted client connection from Acceptor
-        if self.client_queue in readables:
-            self.accept_client()
+        accepted = self.accept_client() if -1 in ready else None
         # Wait for Threadless.handle_events to complete
-        self.loop.run_until_complete(self.wait_for_tasks(tasks))
-        # Remove and shutdown inactive connections
-        self.cleanup_inactive()
+        if tasks:
+            self.loop.run_until_complete(self.wait_for_tasks(tasks))
+        # Only the works that ran may want other events
+        self.update_events(list(tasks) + ([accepted] if accepted is not None else []))
+        # Remove and shutdown inactive connections, idle ones are checked once a second
+        if len(ready) == 0 or time.monotonic() - self.last_cleanup >= 1:
+            self.last_cleanup = time.monotonic()
+            self.cleanup_inactive()
 
     def run(self) -> None:
         try:
@@ -48,6 +48,11 @@ class neon_cli:
             raise
 
 def read_elf_params(out_dict):
+    # exported params spare the neon-cli call, e.g. to replay an indexer archive offline
+    if all(name in os.environ for name in ("NEON_POOL_BASE", "NEON_TOKEN_MINT")):
+        for name in ("NEON_POOL_BASE", "NEON_TOKEN_MINT"):
+            out_dict[name] = os.environ[name]
+        return
     for param in neon_cli().call("neon-elf-params").splitlines():
         if param.startswith('NEON_') and '=' in param:
             v = param.split('=')
@@ -0,0 +1,348 @@
+"""Sharded backfill of the indexer history.
+
+    python backfill.py plan     # once: cut the history after INDEXER_START into slot-range leases
+    python backfill.py work     # any number of processes on any hosts: index leased ranges
+    python backfill.py merge    # once every range is done: finish transactions crossing range boundaries
+
+plan walks the evm_loader signatures from the newest one back to INDEXER_START and stores contiguous
+slot ranges of about BACKFILL_RANGE_SIZE signatures (a slot is never split) in the indexer_leases table.
+The live indexer is then started with INDEXER_START set to the newest planned signature, which plan logs.
+
+A worker claims an open range (or one whose lease expired), renews the lease while it works and indexes
+the range like the live indexer, starting without transactions in progress, plus the blockhashes of its slots.
+A range that fails keeps its lease for a backoff that doubles with each failure, other ranges go first;
+after BACKFILL_MAX_ATTEMPTS failures it is not claimed any more and merge waits for an operator.
+Iterative transactions and holders still open at the end of a range are saved with it; merge replays the
+beginning of the next range for them. Transactions submitted twice (by a range and by merge) are overwritten,
+the merged version carries the signatures of both ranges.
+"""
+import logging
+import os
+import socket
+import sys
+import time
+from typing import NamedTuple, Optional
+
+try:
+    from holder_reassembly import HolderReassembler
+    from solana_receipts_update import Indexer, TransactionStruct, PENDING_TRX_TTL, RECEIPTS_BATCH_SIZE, \
+        CATCHUP_BLOCK_COUNT, INDEXER_START
+    from sql_backend import get_backend
+    from sql_dict import encode, decode
+except ImportError:
+    from .holder_reassembly import HolderReassembler
+    from .solana_receipts_update import Indexer, TransactionStruct, PENDING_TRX_TTL, RECEIPTS_BATCH_SIZE, \
+        CATCHUP_BLOCK_COUNT, INDEXER_START
+    from .sql_backend import get_backend
+    from .sql_dict import encode, decode
+
+BACKFILL_RANGE_SIZE = int(os.environ.get("BACKFILL_RANGE_SIZE", "10000"))
+# a range whose lease is not renewed for this many seconds is given to another worker
+BACKFILL_LEASE_TIMEOUT = float(os.environ.get("BACKFILL_LEASE_TIMEOUT", "600"))
+# a failed range is claimed again after this many seconds, doubled on each failure up to BACKFILL_LEASE_TIMEOUT
+BACKFILL_RETRY_DELAY = float(os.environ.get("BACKFILL_RETRY_DELAY", "10"))
+BACKFILL_MAX_ATTEMPTS = int(os.environ.get("BACKFILL_MAX_ATTEMPTS", "10"))
+
+OPEN = 'open'
+DONE = 'done'
+MERGED = 'merged'
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Lease(NamedTuple):
+    start_slot: int
+    end_slot: int
+    # the newest signature of the range, the range goes back to until_signature (excluded)
+    last_signature: str
+    until_signature: Optional[str]
+
+
+class BackfillLeases:
+    """Slot ranges of the backfill and their leases, shared by all workers through the DB."""
+
+    COLUMNS = 'start_slot, end_slot, last_signature, until_signature'
+
+    def __init__(self, tablename='indexer_leases', backend=None):
+        self.tablename = tablename
+        self.backend = backend if backend is not None else get_backend()
+        self.backend.execute('''
+                CREATE TABLE IF NOT EXISTS
+                {} (
+                    start_slot BIGINT UNIQUE,
+                    end_slot BIGINT,
+                    last_signature TEXT,
+                    until_signature TEXT,
+                    status TEXT,
+                    owner TEXT,
+                    expires DOUBLE PRECISION,
+                    state {},
+                    attempts INTEGER DEFAULT 0
+                )
+            '''.format(self.tablename, self.backend.column_type('BYTEA')))
+
+    def create(self, leases):
+        """Add ranges, the ones already planned are kept as they are."""
+        rows = [tuple(lease) + (OPEN,) for lease in leases]
+        self.backend.upsert_many(self.tablename, self.COLUMNS + ', status', rows,
+                                 'ON CONFLICT (start_slot) DO NOTHING')
+
+    def claim(self, owner, timeout=BACKFILL_LEASE_TIMEOUT, max_attempts=BACKFILL_MAX_ATTEMPTS):
+        """The oldest open range that is not leased (or whose lease expired) and did not fail max_attempts times,
+        now leased to owner; None if there is none."""
+        now = time.time()
+        rows = self.backend.fetchall('''
+                UPDATE {0} SET owner = %s, expires = %s
+                WHERE start_slot = (
+                    SELECT start_slot FROM {0}
+                    WHERE status = %s AND (owner IS NULL OR expires < %s) AND attempts < %s
+                    ORDER BY start_slot LIMIT 1 {1}
+                ) AND status = %s AND (owner IS NULL OR expires < %s)
+                RETURNING {2}
+            '''.format(self.tablename, self.backend.skip_locked, self.COLUMNS),
+            (owner, now + timeout, OPEN, now, max_attempts, OPEN, now), retry=False)
+        return Lease(*rows[0]) if len(rows) else None
+
+    def renew(self, lease, owner, timeout=BACKFILL_LEASE_TIMEOUT):
+        """False if the lease is lost (expired and claimed by another worker)."""
+        return self.backend.execute(
+            'UPDATE {} SET expires = %s WHERE start_slot = %s AND owner = %s AND status = %s'.format(self.tablename),
+            (time.time() + timeout, lease.start_slot, owner, OPEN)) > 0
+
+    def complete(self, lease, owner, state):
+        return self.backend.execute(
+            'UPDATE {} SET status = %s, state = %s WHERE start_slot = %s AND owner = %s AND status = %s'.format(
+                self.tablename),
+            (DONE, encode(state), lease.start_slot, owner, OPEN)) > 0
+
+    def fail(self, lease, owner, retry_delay=BACKFILL_RETRY_DELAY):
+        """Count a failure, the lease is kept for the backoff: other ranges are claimed first.
+        Returns the failures of the range so far."""
+        rows = self.backend.fetchall('SELECT attempts FROM {} WHERE start_slot = %s AND owner = %s'.format(
+            self.tablename), (lease.start_slot, owner))
+        if len(rows) == 0:
+            return 0
+        attempts = rows[0][0] + 1
+        delay = min(BACKFILL_LEASE_TIMEOUT, retry_delay * 2 ** (attempts - 1))
+        self.backend.execute(
+            'UPDATE {} SET attempts = %s, expires = %s WHERE start_slot = %s AND owner = %s'.format(self.tablename),
+            (attempts, time.time() + delay, lease.start_slot, owner))
+        return attempts
+
+    def next_retry(self, owner, max_attempts=BACKFILL_MAX_ATTEMPTS):
+        """When the earliest range owner failed can be claimed again, None if there is none."""
+        rows = self.backend.fetchall(
+            'SELECT MIN(expires) FROM {} WHERE status = %s AND owner = %s AND attempts > 0 AND attempts < %s'.format(
+                self.tablename), (OPEN, owner, max_attempts))
+        return rows[0][0] if len(rows) else None
+
+    def release(self, lease, owner):
+        self.backend.execute(
+            'UPDATE {} SET owner = NULL, expires = NULL WHERE start_slot = %s AND owner = %s'.format(self.tablename),
+            (lease.start_slot, owner))
+
+    def set_merged(self, lease):
+        self.backend.execute('UPDATE {} SET status = %s WHERE start_slot = %s'.format(self.tablename),
+                             (MERGED, lease.start_slot))
+
+    def ranges(self):
+        """[(lease, status, state)] of all ranges, oldest first."""
+        rows = self.backend.fetchall('SELECT {}, status, state FROM {} ORDER BY start_slot'.format(
+            self.COLUMNS, self.tablename))
+        return [(Lease(*row[:4]), row[4], decode(row[5]) if row[5] is not None else None) for row in rows]
+
+
+def cut_ranges(signatures, range_size, until_signature):
+    """Leases of (signature, slot) pairs given newest first, ending at until_signature.
+
+    A range is closed once it has range_size signatures and the slot changes; slot ranges are contiguous."""
+    leases = []
+    current = None
+    for (signature, slot) in signatures:
+        if current is None:
+            current = [signature, slot, slot, 0]
+        elif current[3] >= range_size and slot < current[2]:
+            leases.append(Lease(slot + 1, current[1], current[0], signature))
+            current = [signature, slot, slot, 0]
+        current[2] = slot
+        current[3] += 1
+    if current is not None:
+        leases.append(Lease(current[2], current[1], current[0], until_signature))
+    return leases
+
+
+class BackfillIndexer(Indexer):
+    """Indexes leased ranges; no cursor, no checkpoints, no subscriptions."""
+
+    def __init__(self, leases=None):
+        super().__init__(subscribe=False)
+        self.leases = leases if leases is not None else BackfillLeases()
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def load_checkpoint(self):
+        pass
+
+    def save_checkpoint(self):
+        pass
+
+    def plan(self, range_size=BACKFILL_RANGE_SIZE):
+        until_signature = INDEXER_START if INDEXER_START != 'LATEST' else None
+        signatures = ((tx['signature'], tx['slot']) for tx in self.walk_signatures(until=until_signature))
+        leases = cut_ranges(signatures, range_size, until_signature)
+        self.leases.create(leases)
+        if len(leases):
+            logger.info("Planned {} ranges, slots {}-{}. Start the live indexer with INDEXER_START={}".format(
+                len(leases), leases[-1].start_slot, leases[0].end_slot, leases[0].last_signature))
+        return leases
+
+    def range_signatures(self, last_signature, until_signature):
+        """(signatures newest first, failed signatures) of a range:
+        last_signature and the older ones down to until_signature"""
+        ordered_txs = [last_signature] if last_signature is not None else []
+        failed_txs = set()
+        for tx in self.walk_signatures(before=last_signature, until=until_signature):
+            ordered_txs.append(tx['signature'])
+            if tx.get('err') is not None:
+                failed_txs.add(tx['signature'])
+        return ordered_txs, failed_txs
+
+    def work(self):
+        while True:
+            lease = self.leases.claim(self.owner)
+            if lease is None:
+                retry = self.leases.next_retry(self.owner)
+                if retry is None:
+                    logger.info("No open ranges left")
+                    return
+                # only ranges that failed here are left, wait for the first one to be claimed again
+                time.sleep(max(0.0, retry - time.time()) + 0.1)
+                continue
+            logger.info("Index slots {}-{}".format(lease.start_slot, lease.end_slot))
+            try:
+                state = self.index_range(lease)
+            except Exception as err:
+                attempts = self.leases.fail(lease, self.owner)
+                if attempts >= BACKFILL_MAX_ATTEMPTS:
+                    logger.error("Range {}-{} failed {} times, it is not claimed any more: {}".format(
+                        lease.start_slot, lease.end_slot, attempts, err))
+                else:
+                    logger.error("Range {}-{} is left for a retry: {}".format(lease.start_slot, lease.end_slot, err))
+                continue
+            if not self.leases.complete(lease, self.owner, state):
+                logger.error("Lease of slots {}-{} is lost".format(lease.start_slot, lease.end_slot))
+
+    def renew(self, lease):
+        if not self.leases.renew(lease, self.owner):
+            raise RuntimeError("the lease is lost")
+
+    def index_range(self, lease):
+        """Index the range, return the transactions and holders still open at its end."""
+        self.pending_trxs = {}
+        self.holders = HolderReassembler()
+        (ordered_txs, failed_txs) = self.range_signatures(lease.last_signature, lease.until_signature)
+        self.fetch_unknown_receipts(ordered_txs, failed_txs)
+        self.renew(lease)
+
+        for first_slot in range(lease.start_slot, lease.end_slot + 1, CATCHUP_BLOCK_COUNT):
+            missing_slot = self.store_blocks(first_slot, min(lease.end_slot, first_slot + CATCHUP_BLOCK_COUNT - 1))
+            if missing_slot is not None:
+                raise RuntimeError("block {} is not available".format(missing_slot))
+        self.renew(lease)
+
+        self.transaction_order = ordered_txs
+        self.failed_txs = failed_txs
+        counter = 0
+        for signature, trx in self.iter_new_receipts():
+            if trx is not None:
+                self.process_receipt(signature, trx)
+            counter += 1
+            if counter % RECEIPTS_BATCH_SIZE == 0:
+                self.renew(lease)
+                self.changes.flush()
+        self.changes.flush()
+        if counter < len(ordered_txs):
+            raise RuntimeError("{} receipts are not available".format(len(ordered_txs) - counter))
+
+        logger.debug("Slots {}-{}: {} receipts, {} transactions and {} holders open at the end".format(
+            lease.start_slot, lease.end_slot, counter, len(self.pending_trxs), len(self.holders)))
+        return {
+            'pending_trxs': {storage: trx_struct.to_state() for storage, trx_struct in self.pending_trxs.items()},
+            'holders': self.holders.to_state(),
+        }
+
+    def merge(self):
+        """Finish the transactions open at the end of each range with the receipts of the next one.
+        Returns False while some ranges are not indexed yet."""
+        ranges = self.leases.ranges()
+        not_done = [lease for (lease, status, _) in ranges if status == OPEN]
+        if len(not_done):
+            logger.info("{} ranges are not indexed yet".format(len(not_done)))
+            return False
+
+        for idx, (lease, status, state) in enumerate(ranges):
+            if status == MERGED:
+                continue
+            if len(state['pending_trxs']) or len(state['holders']):
+                if idx + 1 < len(ranges):
+                    next_lease = ranges[idx + 1][0]
+                    (ordered_txs, failed_txs) = self.range_signatures(next_lease.last_signature,
+                                                                      next_lease.until_signature)
+                else:
+                    # the newest range continues into what the live indexer handles
+                    (ordered_txs, failed_txs) = self.range_signatures(None, lease.last_signature)
+                self.resolve_boundary(state, ordered_txs, failed_txs)
+                self.changes.flush()
+            self.leases.set_merged(lease)
+        return True
+
+    def resolve_boundary(self, state, ordered_txs, failed_txs):
+        self.pending_trxs = {storage: TransactionStruct.from_state(trx_state)
+                             for storage, trx_state in state['pending_trxs'].items()}
+        self.holders = HolderReassembler()
+        self.holders.load_state(state['holders'])
+
+        # a transaction or holder is from the previous range if it started with one of these signatures
+        boundary = set(trx_struct.signatures[0] for trx_struct in self.pending_trxs.values())
+        boundary.update(holder.signatures[0] for (_, holder) in self.holders.items() if len(holder.signatures))
+        last_slot = max([trx_struct.slot for trx_struct in self.pending_trxs.values()] +
+                        [holder.slot for (_, holder) in self.holders.items()]) + PENDING_TRX_TTL
+
+        self.fetch_unknown_receipts(ordered_txs, failed_txs)
+        self.transaction_order = ordered_txs
+        self.failed_txs = failed_txs
+        for signature, trx in self.iter_new_receipts():
+            if trx is not None:
+                if trx['slot'] > last_slot:
+                    break
+                self.process_receipt(signature, trx)
+            if not self.boundary_open(boundary):
+                return
+        if self.boundary_open(boundary):
+            logger.error("Transactions from the previous range are left unfinished: {}".format(
+                [trx_struct.eth_signature for trx_struct in self.pending_trxs.values()
+                 if trx_struct.signatures[0] in boundary]))
+
+    def boundary_open(self, boundary):
+        return any(trx_struct.signatures[0] in boundary for trx_struct in self.pending_trxs.values()) or \
+            any(holder.signatures[:1] and holder.signatures[0] in boundary for (_, holder) in self.holders.items())
+
+
+def run_backfill(command):
+    logging.basicConfig(format='%(asctime)s - pid:%(process)d [%(levelname)-.1s] %(funcName)s:%(lineno)d - %(message)s')
+    indexer = BackfillIndexer()
+    try:
+        if command == 'plan':
+            indexer.plan()
+        elif command == 'work':
+            indexer.work()
+        elif command == 'merge':
+            indexer.merge()
+        else:
+            raise ValueError("Unknown backfill command {}, expected plan, work or merge".format(command))
+    finally:
+        indexer.close()
+
+
+if __name__ == "__main__":
+    run_backfill(sys.argv[1] if len(sys.argv) > 1 else 'work')
@@ -0,0 +1,137 @@
+"""Change notifications from the indexer to the proxy workers over postgres LISTEN/NOTIFY.
+
+Payloads are compact JSON objects:
+    {"kind": "trx", "hashes": [...]}          eth transactions committed (or overwritten)
+    {"kind": "rollback", "hashes": [...]}     eth transactions removed after a dropped fork
+    {"kind": "logs", "from": slot, "to": slot} logs written for this slot range
+    {"kind": "slot", "slot": slot}             receipts are indexed up to this slot
+A listener also gets {"kind": "reset"} after every (re)connection: changes published while it was
+disconnected are lost, so caches have to start over.
+
+NOTIFY is delivered at commit and only to listeners connected at that time; the tables stay the source
+of truth. With DB_BACKEND=sqlite there is no feed: publishing is a no-op and no listener is started.
+"""
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+try:
+    from sql_backend import get_backend, psycopg2, DB_BACKEND
+    from receipt_fetcher import backoff_delay
+except ImportError:
+    from .sql_backend import get_backend, psycopg2, DB_BACKEND
+    from .receipt_fetcher import backoff_delay
+
+CHANGE_FEED = os.environ.get("CHANGE_FEED", "YES") == "YES" and DB_BACKEND == 'postgres'
+CHANGE_CHANNEL = 'neon_changes'
+# hashes per notification, postgres limits a payload to 8000 bytes
+CHANGE_HASHES_PER_NOTIFY = 100
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class ChangePublisher:
+    """Collects the changes of an indexing pass, flush() publishes them."""
+
+    def __init__(self, backend=None, enabled=CHANGE_FEED):
+        self.backend = backend if backend is not None else get_backend()
+        self.enabled = enabled
+        self.trxs = []
+        self.rollbacks = []
+        self.logs_range = None
+        self.slot = None
+
+    def transaction(self, eth_signature, slot, has_logs):
+        self.trxs.append(eth_signature)
+        if has_logs:
+            (first, last) = self.logs_range or (slot, slot)
+            self.logs_range = (min(first, slot), max(last, slot))
+
+    def rollback(self, eth_signature):
+        self.rollbacks.append(eth_signature)
+
+    def indexed_slot(self, slot):
+        self.slot = slot
+
+    def changes(self):
+        changes = []
+        for (kind, hashes) in (('trx', self.trxs), ('rollback', self.rollbacks)):
+            for pos in range(0, len(hashes), CHANGE_HASHES_PER_NOTIFY):
+                changes.append({'kind': kind, 'hashes': hashes[pos:pos + CHANGE_HASHES_PER_NOTIFY]})
+        if self.logs_range is not None:
+            changes.append({'kind': 'logs', 'from': self.logs_range[0], 'to': self.logs_range[1]})
+        if self.slot is not None:
+            changes.append({'kind': 'slot', 'slot': self.slot})
+        return changes
+
+    def flush(self):
+        changes = self.changes()
+        self.trxs = []
+        self.rollbacks = []
+        self.logs_range = None
+        self.slot = None
+        if not self.enabled:
+            return
+        for change in changes:
+            try:
+                self.backend.notify(CHANGE_CHANNEL, json.dumps(change, separators=(',', ':')))
+            except Exception as err:
+                # listeners resynchronize on reconnect, a lost notification is not worth failing the pass
+                logger.warning("Could not publish %s: %s", change['kind'], err)
+
+
+class ChangeListener:
+    """Calls callback(change) on its own thread for every published change, see the module doc for the kinds."""
+
+    def __init__(self, callback, channel=CHANGE_CHANNEL, poll_timeout=5.0, backend=None):
+        self.backend = backend
+        self.callback = callback
+        self.channel = channel
+        self.poll_timeout = poll_timeout
+        self.connected = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="change-listener", daemon=True)
+        self.thread.start()
+
+    def dispatch(self, change):
+        try:
+            self.callback(change)
+        except Exception as err:
+            logger.error("Change %s is not handled: %s", change.get('kind'), err)
+
+    def run(self):
+        attempt = 0
+        while True:
+            conn = None
+            try:
+                conn = (self.backend or get_backend()).listen(self.channel)
+                self.connected = True
+                attempt = 0
+                self.dispatch({'kind': 'reset'})
+                while True:
+                    if select.select([conn], [], [], self.poll_timeout) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            change = json.loads(notify.payload)
+                        except ValueError:
+                            logger.error("Bad change notification %s", notify.payload)
+                            continue
+                        self.dispatch(change)
+            except (psycopg2.Error, OSError) as err:
+                logger.warning("Change feed connection lost: %s", err)
+            finally:
+                self.connected = False
+                if conn is not None:
+                    conn.close()
+            self.dispatch({'kind': 'reset'})
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
@@ -0,0 +1,162 @@
+"""Reassembly of ethereum transactions written to holder accounts by Write/WriteWithHolder instructions.
+
+The holder layout (after the account tag byte) is: signature (65 bytes), length of the unsigned message
+(8 bytes little endian), unsigned message. Chunks may come in any order, overlap or be rewritten;
+a payload is complete when every byte of it has been written at least once.
+"""
+import logging
+import os
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+HOLDER_MAX_SIZE = 128 * 1024
+# total bytes buffered for all open holders, the least recently written holders are evicted above it
+HOLDER_MEMORY_LIMIT = int(os.environ.get("HOLDER_MEMORY_LIMIT", str(64 * 1024 * 1024)))
+
+SIGNATURE_SIZE = 65
+HEADER_SIZE = SIGNATURE_SIZE + 8
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class IntervalSet:
+    """Sorted disjoint [start, end) ranges, adjacent and overlapping ranges are merged."""
+
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        for (start, end) in intervals:
+            self.add(start, end)
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        # every range touching [start, end] is merged into it
+        left = bisect_left(self.ends, start)
+        right = bisect_right(self.starts, end)
+        if left < right:
+            start = min(start, self.starts[left])
+            end = max(end, self.ends[right - 1])
+        self.starts[left:right] = [start]
+        self.ends[left:right] = [end]
+
+    def covers(self, start, end):
+        if start >= end:
+            return True
+        idx = bisect_right(self.starts, start) - 1
+        return idx >= 0 and self.ends[idx] >= end
+
+    def size(self):
+        return sum(end - start for start, end in zip(self.starts, self.ends))
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class HolderBuffer:
+    def __init__(self, holder_account):
+        self.holder_account = holder_account
+        self.data = bytearray()
+        self.written = IntervalSet()
+        self.signatures = []
+        self.slot = 0
+
+    def write(self, offset, chunk):
+        end = offset + len(chunk)
+        if end > HOLDER_MAX_SIZE:
+            raise ValueError("Write [{}, {}) is out of holder {}".format(offset, end, self.holder_account))
+        if end > len(self.data):
+            self.data.extend(bytes(end - len(self.data)))
+        self.data[offset:end] = chunk
+        self.written.add(offset, end)
+
+    def payload(self):
+        """(signature, unsigned_msg) as memoryviews once they are completely written, otherwise None"""
+        if not self.written.covers(0, HEADER_SIZE):
+            return None
+        length = int.from_bytes(self.data[SIGNATURE_SIZE:HEADER_SIZE], "little")
+        if HEADER_SIZE + length > HOLDER_MAX_SIZE or not self.written.covers(HEADER_SIZE, HEADER_SIZE + length):
+            return None
+        view = memoryview(self.data)
+        return (view[:SIGNATURE_SIZE], view[HEADER_SIZE:HEADER_SIZE + length])
+
+    def to_state(self):
+        return (self.holder_account, bytes(self.data), list(self.written), self.signatures, self.slot)
+
+    @staticmethod
+    def from_state(state):
+        (holder_account, data, written, signatures, slot) = state
+        holder = HolderBuffer(holder_account)
+        holder.data = bytearray(data)
+        holder.written = IntervalSet(written)
+        holder.signatures = list(signatures)
+        holder.slot = slot
+        return holder
+
+
+class HolderReassembler:
+    """Open holders by account, in least recently written order, limited to max_bytes of buffers in total."""
+
+    def __init__(self, max_bytes=HOLDER_MEMORY_LIMIT):
+        self.max_bytes = max_bytes
+        self.holders = OrderedDict()
+        self.total_bytes = 0
+        self.evicted = 0
+
+    def write(self, holder_account, offset, chunk, signature, slot):
+        holder = self.holders.get(holder_account)
+        if holder is None:
+            holder = self.holders[holder_account] = HolderBuffer(holder_account)
+        self.holders.move_to_end(holder_account)
+
+        size = len(holder.data)
+        holder.write(offset, chunk)
+        self.total_bytes += len(holder.data) - size
+        if holder.signatures[-1:] != [signature]:
+            holder.signatures.append(signature)
+        holder.slot = slot
+        self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.holders) > 1:
+            (holder_account, holder) = self.holders.popitem(last=False)
+            self.total_bytes -= len(holder.data)
+            self.evicted += 1
+            logger.error("Evict holder {} ({} bytes), holder memory limit {}".format(
+                holder_account, len(holder.data), self.max_bytes))
+
+    def get(self, holder_account):
+        return self.holders.get(holder_account)
+
+    def pop(self, holder_account):
+        holder = self.holders.pop(holder_account, None)
+        if holder is not None:
+            self.total_bytes -= len(holder.data)
+        return holder
+
+    def items(self):
+        return list(self.holders.items())
+
+    def to_state(self):
+        return {holder_account: holder.to_state() for holder_account, holder in self.holders.items()}
+
+    def load_state(self, state):
+        for holder_account, holder_state in state.items():
+            try:
+                holder = HolderBuffer.from_state(holder_state)
+            except ValueError:
+                logger.error("Skip holder {} saved in an unknown format".format(holder_account))
+                continue
+            self.holders[holder_account] = holder
+            self.total_bytes += len(holder.data)
+        self.evict()
+
+    def __contains__(self, holder_account):
+        return holder_account in self.holders
+
+    def __len__(self):
+        return len(self.holders)
@@ -0,0 +1,150 @@
+"""Counters, gauges and stage timers of the indexer.
+
+One registry per process, `metrics`, shared by the indexer thread and the fetcher event loop.
+INDEXER_METRICS_PORT serves it in the Prometheus text format on /metrics (0 - no endpoint),
+summary() is the periodic log line: the counters and stage times since the previous summary.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INDEXER_METRICS_PORT = int(os.environ.get("INDEXER_METRICS_PORT", "0"))
+# seconds between summary log lines
+METRICS_LOG_INTERVAL = float(os.environ.get("METRICS_LOG_INTERVAL", "60"))
+
+METRICS_PREFIX = 'neon_indexer_'
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(key, escape_label(val)) for key, val in labels) + '}'
+    return '{}{} {}'.format(METRICS_PREFIX, name, repr(float(value)) if isinstance(value, float) else value)
+
+
+class Metrics:
+    """Thread-safe counters (monotonic), gauges and per-stage timers, keyed by name and labels."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, ((label, value), ...)) -> value
+        self.counters = {}
+        self.gauges = {}
+        # stage -> [calls, seconds]
+        self.stages = {}
+        self.last_counters = {}
+        self.last_stages = {}
+        self.last_summary = time.monotonic()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            timing = self.stages.setdefault(stage, [0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+
+    @contextmanager
+    def time(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+    def counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def render(self):
+        """The Prometheus text exposition of every metric."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            stages = sorted((stage, list(timing)) for stage, timing in self.stages.items())
+        lines = []
+        for (samples, kind) in ((counters, 'counter'), (gauges, 'gauge')):
+            declared = set()
+            for ((name, labels), value) in samples:
+                if name not in declared:
+                    declared.add(name)
+                    lines.append('# TYPE {}{} {}'.format(METRICS_PREFIX, name, kind))
+                lines.append(format_sample(name, labels, value))
+        if stages:
+            lines.append('# TYPE {}stage_calls_total counter'.format(METRICS_PREFIX))
+            lines.extend(format_sample('stage_calls_total', (('stage', stage),), calls) for stage, (calls, _) in stages)
+            lines.append('# TYPE {}stage_seconds_total counter'.format(METRICS_PREFIX))
+            lines.extend(format_sample('stage_seconds_total', (('stage', stage),), seconds)
+                         for stage, (_, seconds) in stages)
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """One line: counters and stage times since the previous summary, current gauges."""
+        now = time.monotonic()
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = sorted(self.gauges.items())
+            stages = {stage: list(timing) for stage, timing in self.stages.items()}
+            (last_counters, last_stages) = (self.last_counters, self.last_stages)
+            (self.last_counters, self.last_stages) = (counters, stages)
+            elapsed = now - self.last_summary
+            self.last_summary = now
+
+        def label(name, labels):
+            return name + ''.join('[{}]'.format(value) for _, value in labels)
+
+        parts = ['{:.0f}s'.format(elapsed)]
+        parts.extend('{} {:.2f}s/{}'.format(stage, seconds - last_stages.get(stage, [0, 0.0])[1],
+                                            calls - last_stages.get(stage, [0, 0.0])[0])
+                     for stage, (calls, seconds) in sorted(stages.items()))
+        parts.extend('{} +{}'.format(label(*key), value - last_counters.get(key, 0))
+                     for key, value in sorted(counters.items()) if value != last_counters.get(key, 0))
+        parts.extend('{} {}'.format(label(*key), value) for key, value in gauges)
+        return ', '.join(parts)
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=INDEXER_METRICS_PORT, registry=metrics):
+    """Serve /metrics on a daemon thread, None if the port is 0."""
+    if port == 0:
+        return None
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = registry
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("Metrics on port {}".format(port))
+    return server
@@ -0,0 +1,72 @@
+"""Copy the pickled SQLDict tables into the typed tables.
+
+    python3 -m proxy.indexer.migrate_sql_dict [--drop]
+
+The old tables are left untouched unless --drop is given.
+"""
+import logging
+import sys
+from proxy.environment import evm_loader_id
+
+try:
+    from sql_dict import SQLDict
+    from sql_tables import EthereumTransactionsDict, SolanaEthereumTransactionsDict, EthereumSolanaTransactionsDict, \
+        BlocksByHashDict, ReceiptArchiveDict
+except ImportError:
+    from .sql_dict import SQLDict
+    from .sql_tables import EthereumTransactionsDict, SolanaEthereumTransactionsDict, EthereumSolanaTransactionsDict, \
+        BlocksByHashDict, ReceiptArchiveDict
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+MIGRATION_BATCH_SIZE = 1000
+
+MIGRATIONS = [
+    ("ethereum_transactions", EthereumTransactionsDict),
+    ("solana_ethereum_transactions", SolanaEthereumTransactionsDict),
+    ("ethereum_solana_transactions", EthereumSolanaTransactionsDict),
+    ("solana_blocks_by_hash", BlocksByHashDict),
+    ("known_transactions", lambda: ReceiptArchiveDict(evm_loader_id)),
+]
+
+
+def migrate_table(old_tablename, typed_dict_factory, drop=False):
+    old_table = SQLDict(tablename=old_tablename)
+    new_table = typed_dict_factory()
+    logger.info("Migrate %s -> %s: %d rows", old_tablename, new_table.tablename, len(old_table))
+
+    migrated = 0
+    skipped = 0
+    # streamed in batches: the old tables do not have to fit into memory
+    for key, value in old_table.backend.iterate('SELECT key, value FROM {}'.format(old_tablename),
+                                                batch_size=MIGRATION_BATCH_SIZE):
+        try:
+            value = old_table.decode(value)
+            if value is None:
+                # known_transactions keeps None for receipts that were not available yet
+                continue
+            new_table[key] = value
+            migrated += 1
+        except Exception as err:
+            logger.error("Skip %s[%s]: %s", old_tablename, key, err)
+            skipped += 1
+
+    logger.info("Migrated %s: %d rows, skipped: %d", old_tablename, migrated, skipped)
+    if drop and skipped == 0:
+        old_table.backend.execute('DROP TABLE {}'.format(old_tablename))
+        logger.info("Dropped %s", old_tablename)
+
+    old_table.close()
+    new_table.close()
+
+
+def run_migration(drop=False):
+    for old_tablename, typed_dict_factory in MIGRATIONS:
+        migrate_table(old_tablename, typed_dict_factory, drop)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - pid:%(process)d [%(levelname)-.1s] %(funcName)s:%(lineno)d - %(message)s')
+    run_migration(drop='--drop' in sys.argv[1:])
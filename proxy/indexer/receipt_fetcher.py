@@ -0,0 +1,239 @@
+"""Long-lived asynchronous fetcher of transaction receipts for the indexer.
+
+One event loop thread and one keep-alive HTTP session per process. The number of requests in flight
+follows the RPC node: it grows additively while responses are fast and is halved on throttling
+(HTTP 429/503) or slow responses, failed requests are retried with exponential backoff.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+import aiohttp
+
+try:
+    from metrics import metrics
+except ImportError:
+    from .metrics import metrics
+
+FETCH_INITIAL_CONCURRENCY = int(os.environ.get("FETCH_INITIAL_CONCURRENCY", os.environ.get("PARALLEL_REQUESTS", "2")))
+FETCH_MAX_CONCURRENCY = int(os.environ.get("FETCH_MAX_CONCURRENCY", "64"))
+# responses slower than this (seconds) shrink the concurrency
+FETCH_TARGET_LATENCY = float(os.environ.get("FETCH_TARGET_LATENCY", "1.0"))
+FETCH_MAX_RETRIES = int(os.environ.get("FETCH_MAX_RETRIES", "8"))
+# calls per JSON-RPC batch request
+FETCH_BATCH_SIZE = int(os.environ.get("FETCH_BATCH_SIZE", "100"))
+FETCH_BASE_BACKOFF = 0.25
+FETCH_MAX_BACKOFF = 30.0
+FETCH_REQUEST_TIMEOUT = 30.0
+
+THROTTLE_STATUSES = (429, 503)
+
+BLOCK_OPTS = {"commitment": "confirmed", "transactionDetails": "none", "rewards": False}
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class ThrottledError(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__("RPC node throttles requests")
+        self.retry_after = retry_after
+
+
+class AdaptiveConcurrency:
+    """AIMD limit of requests in flight, must be used from the event loop thread."""
+
+    def __init__(self, initial=FETCH_INITIAL_CONCURRENCY, maximum=FETCH_MAX_CONCURRENCY,
+                 target_latency=FETCH_TARGET_LATENCY):
+        self.limit = float(max(1, min(initial, maximum)))
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.condition = None
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, latency):
+        if latency > self.target_latency:
+            self.decrease(0.9)
+        else:
+            # about +1 per limit successful responses
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_throttle(self):
+        self.decrease(0.5)
+
+    def decrease(self, factor):
+        self.limit = max(1.0, self.limit * factor)
+
+
+def backoff_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        return min(FETCH_MAX_BACKOFF, retry_after)
+    delay = min(FETCH_MAX_BACKOFF, FETCH_BASE_BACKOFF * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class ReceiptFetcher:
+    """fetch(signatures) -> {signature: receipt} for the receipts the node returned,
+    fetch_blocks(slots) -> {slot: block} for the blocks (without transactions) the node returned."""
+
+    def __init__(self, url, concurrency=None):
+        self.url = url
+        self.concurrency = concurrency if concurrency is not None else AdaptiveConcurrency()
+        self.request_id = 0
+        self.session = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="receipt-fetcher", daemon=True)
+        self.thread.start()
+
+    def fetch(self, signatures):
+        return asyncio.run_coroutine_threadsafe(self.fetch_all(signatures), self.loop).result()
+
+    def fetch_blocks(self, slots):
+        return asyncio.run_coroutine_threadsafe(self.fetch_blocks_all(slots), self.loop).result()
+
+    def close(self):
+        if self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def get_session(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=FETCH_MAX_CONCURRENCY, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=FETCH_REQUEST_TIMEOUT))
+        return self.session
+
+    async def fetch_all(self, signatures):
+        start = time.monotonic()
+        results = await asyncio.gather(*(self.fetch_receipt(signature) for signature in signatures))
+        receipts = {signature: receipt for signature, receipt in zip(signatures, results) if receipt is not None}
+        logger.debug("Fetched %d/%d receipts in %.2fs, concurrency %.1f",
+                     len(receipts), len(signatures), time.monotonic() - start, self.concurrency.limit)
+        return receipts
+
+    async def fetch_receipt(self, signature):
+        for attempt in range(FETCH_MAX_RETRIES):
+            await self.concurrency.acquire()
+            retry_after = None
+            try:
+                start = time.monotonic()
+                receipt = await self.request("getConfirmedTransaction", [signature, "json"])
+                self.concurrency.on_success(time.monotonic() - start)
+                return receipt
+            except ThrottledError as err:
+                self.concurrency.on_throttle()
+                retry_after = err.retry_after
+                metrics.inc('rpc_errors_total', method="getConfirmedTransaction", error="throttled")
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+                self.concurrency.decrease(0.9)
+                logger.debug("getConfirmedTransaction %s: %s", signature, err)
+                metrics.inc('rpc_errors_total', method="getConfirmedTransaction", error=type(err).__name__)
+            finally:
+                await self.concurrency.release()
+            metrics.inc('rpc_retries_total', method="getConfirmedTransaction")
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+        logger.error("Give up fetching %s after %d attempts", signature, FETCH_MAX_RETRIES)
+        metrics.inc('rpc_give_ups_total', method="getConfirmedTransaction")
+        return None
+
+    async def fetch_blocks_all(self, slots):
+        start = time.monotonic()
+        batches = [slots[pos:pos + FETCH_BATCH_SIZE] for pos in range(0, len(slots), FETCH_BATCH_SIZE)]
+        results = await asyncio.gather(*(self.fetch_batch("getBlock", [[slot, BLOCK_OPTS] for slot in batch])
+                                         for batch in batches))
+        blocks = {}
+        for batch, batch_results in zip(batches, results):
+            for slot, block in zip(batch, batch_results):
+                if block is not None:
+                    blocks[slot] = block
+        logger.debug("Fetched %d/%d blocks in %d batches in %.2fs, concurrency %.1f",
+                     len(blocks), len(slots), len(batches), time.monotonic() - start, self.concurrency.limit)
+        return blocks
+
+    async def fetch_batch(self, method, params_list):
+        """Results of one method called with each of params_list, in batch requests; None for the failed calls.
+
+        Calls that fail inside a successful batch are retried in the next batch."""
+        results = [None] * len(params_list)
+        pending = list(range(len(params_list)))
+        for attempt in range(FETCH_MAX_RETRIES):
+            await self.concurrency.acquire()
+            retry_after = None
+            try:
+                responses = await self.request_batch(method, [params_list[idx] for idx in pending])
+                # a batch is slow by design, its latency does not grow the concurrency
+                failed = []
+                for idx, response in zip(pending, responses):
+                    if 'error' in response or response.get('result') is None:
+                        failed.append(idx)
+                    else:
+                        results[idx] = response['result']
+                pending = failed
+                if len(pending) == 0:
+                    return results
+                metrics.inc('rpc_errors_total', len(failed), method=method, error="call")
+            except ThrottledError as err:
+                self.concurrency.on_throttle()
+                retry_after = err.retry_after
+                metrics.inc('rpc_errors_total', method=method, error="throttled")
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+                self.concurrency.decrease(0.9)
+                logger.debug("%s batch of %d: %s", method, len(pending), err)
+                metrics.inc('rpc_errors_total', method=method, error=type(err).__name__)
+            finally:
+                await self.concurrency.release()
+            metrics.inc('rpc_retries_total', method=method)
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+        logger.error("Give up %d %s calls after %d attempts", len(pending), method, FETCH_MAX_RETRIES)
+        metrics.inc('rpc_give_ups_total', len(pending), method=method)
+        return results
+
+    async def request_batch(self, method, params_list):
+        """Responses of a JSON-RPC batch in the order of params_list."""
+        session = await self.get_session()
+        body = []
+        for params in params_list:
+            self.request_id += 1
+            body.append({"jsonrpc": "2.0", "id": self.request_id, "method": method, "params": params})
+        async with session.post(self.url, json=body) as response:
+            if response.status in THROTTLE_STATUSES:
+                retry_after = response.headers.get("Retry-After")
+                raise ThrottledError(float(retry_after) if retry_after and retry_after.isdigit() else None)
+            response.raise_for_status()
+            result = await response.json(content_type=None)
+        if not isinstance(result, list):
+            raise ValueError(result.get('error', result) if isinstance(result, dict) else result)
+        # the node may answer in any order
+        by_id = {item.get('id'): item for item in result}
+        return [by_id.get(request['id'], {'error': 'no response'}) for request in body]
+
+    async def request(self, method, params):
+        self.request_id += 1
+        session = await self.get_session()
+        body = {"jsonrpc": "2.0", "id": self.request_id, "method": method, "params": params}
+        async with session.post(self.url, json=body) as response:
+            if response.status in THROTTLE_STATUSES:
+                retry_after = response.headers.get("Retry-After")
+                raise ThrottledError(float(retry_after) if retry_after and retry_after.isdigit() else None)
+            response.raise_for_status()
+            result = await response.json(content_type=None)
+        if 'error' in result:
+            raise ValueError(result['error'])
+        return result['result']
@@ -0,0 +1,338 @@
+"""Record the RPC traffic of the indexer into an archive and replay it offline.
+
+    python replay.py record <archive.jsonl.gz>   # the live indexer, every RPC response it consumes is archived
+    python replay.py replay <archive.jsonl.gz>   # index the archive at full speed, without network
+
+An archive is gzipped JSON lines: a header {"header": {"cursor": ..., "last_block": ...}} with the point the
+recording started from, then {"method": ..., "params": [...], "result": ...} records of the client calls
+(getSignaturesForAddress, getSlot, getBlocks, getBlock, ...) and of the receipts and blocks of the fetcher.
+
+Replay answers from what was recorded, not call by call: the signature history is rebuilt from all the
+getSignaturesForAddress pages and paged again for whatever before/until the replaying indexer asks, getSlot is
+the newest recorded slot and every known transaction is finalized. A call the archive can not answer stops the
+replay with NotRecordedError. Replayed into a fresh database (DB_BACKEND=sqlite works), the indexer ends with
+the tables the recording run produced from the same start.
+The environment must not need the network: set EVM_LOADER, NEON_POOL_BASE and NEON_TOKEN_MINT, see
+`python replay.py env <archive>`.
+"""
+import gzip
+import json
+import logging
+import sys
+import threading
+import time
+
+from solana.rpc.api import Client
+from proxy.environment import evm_loader_id, ELF_PARAMS
+
+try:
+    from metrics import metrics
+    from receipt_fetcher import AdaptiveConcurrency, BLOCK_OPTS
+    from solana_receipts_update import Indexer
+except ImportError:
+    from .metrics import metrics
+    from .receipt_fetcher import AdaptiveConcurrency, BLOCK_OPTS
+    from .solana_receipts_update import Indexer
+
+# records written between two flushes of the archive
+ARCHIVE_FLUSH_RECORDS = 1000
+SIGNATURES_LIMIT = 1000
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class NotRecordedError(Exception):
+    """The archive has no response for a call of the replaying indexer."""
+
+
+class ArchiveWriter:
+    """Thread-safe writer of an archive, the fetcher records from its own thread."""
+
+    def __init__(self, path):
+        self.file = gzip.open(path, 'at')
+        self.lock = threading.Lock()
+        self.unflushed = 0
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.unflushed += 1
+            if self.unflushed >= ARCHIVE_FLUSH_RECORDS:
+                self.file.flush()
+                self.unflushed = 0
+
+    def record(self, method, params, result):
+        self.write({'method': method, 'params': params, 'result': result})
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_archive(path):
+    with gzip.open(path, 'rt') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+class RecordingProvider:
+    """Wraps the HTTP provider of a solana Client, archives every successful response."""
+
+    def __init__(self, provider, archive):
+        self.provider = provider
+        self.archive = archive
+
+    def make_request(self, method, *params):
+        response = self.provider.make_request(method, *params)
+        if 'result' in response:
+            self.archive.record(str(method), list(params), response['result'])
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+
+class RecordingFetcher:
+    """Wraps a ReceiptFetcher, archives the receipts and blocks it returns as single calls."""
+
+    def __init__(self, fetcher, archive):
+        self.fetcher = fetcher
+        self.archive = archive
+        self.concurrency = fetcher.concurrency
+
+    def fetch(self, signatures):
+        receipts = self.fetcher.fetch(signatures)
+        for signature, receipt in receipts.items():
+            self.archive.record('getConfirmedTransaction', [signature, 'json'], receipt)
+        return receipts
+
+    def fetch_blocks(self, slots):
+        blocks = self.fetcher.fetch_blocks(slots)
+        for slot, block in blocks.items():
+            self.archive.record('getBlock', [slot, BLOCK_OPTS], block)
+        return blocks
+
+    def close(self):
+        self.fetcher.close()
+
+
+class ReplaySource:
+    """The recorded chain: signature history, receipts and blocks."""
+
+    def __init__(self, records=()):
+        self.header = {}
+        # signature -> getSignaturesForAddress entry, in the order of first appearance
+        self.entries = {}
+        self.receipts = {}
+        self.blocks = {}
+        self.max_slot = 0
+        # entries newest first and their positions, built on the first signatures() call
+        self.history = None
+        self.positions = {}
+        for record in records:
+            self.add(record)
+
+    @staticmethod
+    def load(path):
+        return ReplaySource(read_archive(path))
+
+    def add(self, record):
+        if 'header' in record:
+            # appended recordings keep the start of the first one
+            self.header = self.header or record['header']
+            return
+        (method, params, result) = (record['method'], record['params'], record['result'])
+        if method == 'getSignaturesForAddress':
+            for entry in result:
+                self.entries.setdefault(entry['signature'], entry)
+                self.max_slot = max(self.max_slot, entry['slot'])
+            self.history = None
+        elif method == 'getConfirmedTransaction' and result is not None:
+            self.receipts[params[0]] = result
+            self.max_slot = max(self.max_slot, result['slot'])
+        elif method == 'getBlock' and result is not None:
+            self.blocks[params[0]] = result
+            self.max_slot = max(self.max_slot, params[0])
+        elif method == 'getSlot':
+            self.max_slot = max(self.max_slot, result)
+
+    def signatures(self, before=None, until=None, limit=SIGNATURES_LIMIT):
+        """getSignaturesForAddress over the recorded history, newest first."""
+        if self.history is None:
+            # pages are consistent within a slot, the first appearance keeps their order
+            self.history = sorted(self.entries.values(), key=lambda entry: -entry['slot'])
+            self.positions = {entry['signature']: pos for pos, entry in enumerate(self.history)}
+        if before is not None and before not in self.positions:
+            return []
+        start = self.positions[before] + 1 if before is not None else 0
+        page = []
+        for entry in self.history[start:start + limit]:
+            if entry['signature'] == until:
+                break
+            page.append(entry)
+        return page
+
+    def request(self, method, params):
+        """The result of a client call, raises NotRecordedError if the archive can not answer it."""
+        opts = params[-1] if len(params) and isinstance(params[-1], dict) else {}
+        if method == 'getSignaturesForAddress':
+            return self.signatures(opts.get('before'), opts.get('until'), opts.get('limit', SIGNATURES_LIMIT))
+        if method == 'getSlot':
+            return self.max_slot
+        if method in ('getConfirmedTransaction', 'getTransaction'):
+            return self.receipts.get(params[0])
+        if method == 'getBlock':
+            if params[0] not in self.blocks:
+                raise NotRecordedError("Block {} is not recorded".format(params[0]))
+            return self.blocks[params[0]]
+        if method == 'getBlocks':
+            return sorted(slot for slot in self.blocks if params[0] <= slot <= params[1])
+        if method == 'getSignatureStatuses':
+            return {'context': {'slot': self.max_slot}, 'value': [self.status(signature) for signature in params[0]]}
+        raise NotRecordedError("{} is not recorded".format(method))
+
+    def status(self, signature):
+        entry = self.entries.get(signature)
+        receipt = self.receipts.get(signature)
+        if entry is None and receipt is None:
+            return None
+        return {'slot': entry['slot'] if entry is not None else receipt['slot'], 'confirmations': None,
+                'err': entry.get('err') if entry is not None else receipt['meta'].get('err'),
+                'confirmationStatus': 'finalized'}
+
+
+class ReplayProvider:
+    """Stands for the HTTP provider of a solana Client, answers from a ReplaySource.
+
+    Calls it can not answer raise instead of returning an error response, which the indexer would retry forever."""
+
+    def __init__(self, source):
+        self.source = source
+        self.request_id = 0
+
+    def make_request(self, method, *params):
+        self.request_id += 1
+        return {'jsonrpc': '2.0', 'id': self.request_id, 'result': self.source.request(str(method), params)}
+
+    def is_connected(self):
+        return True
+
+
+class ReplayFetcher:
+    """Stands for the ReceiptFetcher: the recorded receipts and blocks, the missing ones are left out
+    as if the fetcher gave up on them."""
+
+    def __init__(self, source):
+        self.source = source
+        self.concurrency = AdaptiveConcurrency()
+
+    def fetch(self, signatures):
+        return {signature: self.source.receipts[signature] for signature in signatures
+                if signature in self.source.receipts}
+
+    def fetch_blocks(self, slots):
+        return {slot: self.source.blocks[slot] for slot in slots if slot in self.source.blocks}
+
+    def close(self):
+        pass
+
+
+class NoCanceller:
+    """Nothing is sent while replaying."""
+
+    def unlock_accounts(self, blocked_storages):
+        pass
+
+
+def replay_client(source):
+    client = Client()
+    client._provider = ReplayProvider(source)
+    return client
+
+
+def replay(indexer, source):
+    """Index everything the source holds from the point the recording started,
+    return (receipts processed, seconds)."""
+    if 'cursor' in source.header:
+        # whatever INDEXER_START made of the fresh database, the recording started from this cursor
+        indexer.cursor = source.header['cursor']
+        indexer.save_checkpoint()
+    if 'last_block' in source.header:
+        indexer.constants['last_block'] = indexer.last_block = source.header['last_block']
+
+    processed = metrics.counter('receipts_processed_total')
+    start = time.monotonic()
+    while True:
+        progress = (indexer.cursor, indexer.last_block)
+        indexer.gather_unknown_transactions()
+        indexer.process_receipts()
+        indexer.gather_blocks()
+        indexer.reconcile()
+        # done, or stuck at a receipt the recording ended before fetching
+        if (indexer.cursor, indexer.last_block) == progress:
+            break
+    return (metrics.counter('receipts_processed_total') - processed, time.monotonic() - start)
+
+
+def run_record(path):
+    archive = ArchiveWriter(path)
+    indexer = Indexer()
+    indexer.client._provider = RecordingProvider(indexer.client._provider, archive)
+    indexer.fetcher = RecordingFetcher(indexer.fetcher, archive)
+    archive.write({'header': {
+        'cursor': indexer.cursor,
+        'last_block': indexer.constants['last_block'],
+        'env': {
+            'EVM_LOADER': evm_loader_id,
+            'NEON_POOL_BASE': ELF_PARAMS.get("NEON_POOL_BASE"),
+            'NEON_TOKEN_MINT': ELF_PARAMS.get("NEON_TOKEN_MINT"),
+        },
+    }})
+    try:
+        indexer.run()
+    finally:
+        indexer.close()
+        archive.close()
+
+
+def run_replay(path):
+    source = ReplaySource.load(path)
+    logger.info("Replay {} signatures, {} receipts, {} blocks up to slot {}".format(
+        len(source.entries), len(source.receipts), len(source.blocks), source.max_slot))
+    indexer = Indexer(subscribe=False, client=replay_client(source), fetcher=ReplayFetcher(source),
+                      canceller=NoCanceller())
+    try:
+        (processed, seconds) = replay(indexer, source)
+    finally:
+        indexer.close()
+    logger.info("Replayed {} receipts in {:.2f}s, {:.0f} receipts/s".format(
+        processed, seconds, processed / seconds if seconds > 0 else 0))
+    logger.info("Indexer metrics: {}".format(metrics.summary()))
+
+
+def print_env(path):
+    """The exports replay needs, from the archive header."""
+    for record in read_archive(path):
+        if 'header' in record:
+            for name, value in sorted(record['header'].get('env', {}).items()):
+                print("export {}={}".format(name, value))
+            return
+
+
+def run(command, path):
+    logging.basicConfig(format='%(asctime)s - pid:%(process)d [%(levelname)-.1s] %(funcName)s:%(lineno)d - %(message)s')
+    if command == 'record':
+        run_record(path)
+    elif command == 'replay':
+        run_replay(path)
+    elif command == 'env':
+        print_env(path)
+    else:
+        raise ValueError("Unknown replay command {}, expected record, replay or env".format(command))
+
+
+if __name__ == "__main__":
+    run(sys.argv[1], sys.argv[2])
@@ -4,44 +4,127 @@ import json
 import os
 import time
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from solana.rpc.api import Client
-from multiprocessing.dummy import Pool as ThreadPool
 from typing import Dict, Union
 from proxy.environment import solana_url, evm_loader_id
 
 
 try:
     from utils import check_error, get_trx_results, get_trx_receipts, LogDB, Canceller
+    from receipt_fetcher import ReceiptFetcher
+    from holder_reassembly import HolderReassembler
+    from solana_subscriber import SolanaSubscriber, default_ws_url
+    from change_feed import ChangePublisher
+    from metrics import metrics, start_metrics_server, METRICS_LOG_INTERVAL
     from sql_dict import SQLDict
+    from sql_tables import EthereumTransactionsDict, SolanaEthereumTransactionsDict, EthereumSolanaTransactionsDict, \
+                           BlocksByHashDict, ReceiptArchiveDict, RawReceiptsDict, UnfinalizedTransactionsDict
 except ImportError:
     from .utils import check_error, get_trx_results, get_trx_receipts, LogDB, Canceller
+    from .receipt_fetcher import ReceiptFetcher
+    from .holder_reassembly import HolderReassembler
+    from .solana_subscriber import SolanaSubscriber, default_ws_url
+    from .change_feed import ChangePublisher
+    from .metrics import metrics, start_metrics_server, METRICS_LOG_INTERVAL
     from .sql_dict import SQLDict
+    from .sql_tables import EthereumTransactionsDict, SolanaEthereumTransactionsDict, EthereumSolanaTransactionsDict, \
+                            BlocksByHashDict, ReceiptArchiveDict, RawReceiptsDict, UnfinalizedTransactionsDict
 
 
 PARALLEL_REQUESTS = int(os.environ.get("PARALLEL_REQUESTS", "2"))
 CANCEL_TIMEOUT = int(os.environ.get("CANCEL_TIMEOUT", "60"))
+# slots without activity after which an unfinished transaction or holder is forgotten
+PENDING_TRX_TTL = int(os.environ.get("PENDING_TRX_TTL", "3000"))
+# wait for logsSubscribe/slotSubscribe notifications instead of polling continuously
+INDEXER_SUBSCRIBE = os.environ.get("INDEXER_SUBSCRIBE", "NO") == "YES"
+SOLANA_WS_URL = os.environ.get("SOLANA_WS_URL", default_ws_url(solana_url))
+# with subscriptions: the longest wait for a notification, blocks and gaps are polled at least this often (seconds)
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", "10"))
+# pause after a pass that found no new transactions (seconds)
+POLL_IDLE_INTERVAL = float(os.environ.get("POLL_IDLE_INTERVAL", "1"))
+# announcements come at this commitment; receipts can be fetched once confirmed, about a slot later
+INDEXER_SUBSCRIBE_COMMITMENT = os.environ.get("INDEXER_SUBSCRIBE_COMMITMENT", "processed")
+# deprecated commitment names of the solana RPC
+COMMITMENT_ALIASES = {'recent': 'processed', 'single': 'confirmed', 'singleGossip': 'confirmed',
+                      'max': 'finalized', 'root': 'finalized'}
+
+# an announced transaction is looked for every SLOT_TIME seconds until it is indexed or ANNOUNCED_TTL passes
+SLOT_TIME = 0.4
+ANNOUNCED_TTL = float(os.environ.get("ANNOUNCED_TTL", "30"))
+# transactions whose signatures getSignatureStatuses returns at once
+SIGNATURE_STATUSES_BATCH = 256
+# getBlock errors of a skipped slot: nothing was finalized in it
+SKIPPED_SLOT_ERRORS = (-32007, -32009)
+# keep full transaction JSON in the raw_receipts table for this many seconds, 0 - do not keep it
+RAW_RECEIPTS_RETENTION = int(os.environ.get("RAW_RECEIPTS_RETENTION", "0"))
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 DEVNET_HISTORY_START = "7BdwyUQ61RUZP63HABJkbW66beLk22tdXnP69KsvQBJekCPVaHoJY47Rw68b3VV1UbQNHxX3uxUSLfiJrfy2bTn"
-HISTORY_START = [DEVNET_HISTORY_START]
+# where a fresh indexer (no saved checkpoint) starts: after this signature, or LATEST - from the current tip
+INDEXER_START = os.environ.get("INDEXER_START", DEVNET_HISTORY_START)
+HISTORY_START = [INDEXER_START]
 
 UPDATE_BLOCK_COUNT = PARALLEL_REQUESTS * 16
-
-class HolderStruct:
-    def __init__(self, storage_account):
-        self.storage_account = storage_account
-        self.data = bytearray(128*1024)
-        self.count_written = 0
-        self.max_written = 0
-
-
-class ContinueStruct:
-    def __init__(self, signature, results, accounts = None):
-        self.signatures = [signature]
-        self.results = results
-        self.accounts = accounts
+# slots per gather_blocks cycle while the blocks lag behind by more than UPDATE_BLOCK_COUNT
+CATCHUP_BLOCK_COUNT = int(os.environ.get("CATCHUP_BLOCK_COUNT", "2000"))
+RECEIPTS_BATCH_SIZE = 1000
+# passes that fetch a receipt in vain before the indexer gives up on it and moves the cursor past it
+RECEIPT_MAX_FETCHES = int(os.environ.get("RECEIPT_MAX_FETCHES", "10"))
+
+# processes decoding ethereum transactions (rlp, keccak, ecrecover), 0 - decode on the indexer thread
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+# smaller batches are decoded on the indexer thread, the process round trip is not worth it
+DECODE_MIN_BATCH = 64
+# decode processes that die this many times in a row are not started again, everything is decoded inline
+DECODE_MAX_RESTARTS = 3
+
+# evm_loader instruction names for the metrics
+INSTRUCTION_NAMES = {
+    0x00: 'Write',
+    0x05: 'CallFromRawTrx',
+    0x09: 'PartialCallFromRawEthereumTX',
+    0x0a: 'Continue',
+    0x0b: 'ExecuteTrxFromAccountDataIterative',
+    0x0c: 'Cancel',
+    0x0d: 'PartialCallOrContinueFromRawEthereumTX',
+    0x0e: 'ExecuteTrxFromAccountDataIterativeOrContinue',
+    0x12: 'WriteWithHolder',
+    0x13: 'PartialCallFromRawEthereumTXv02',
+    0x14: 'ContinueV02',
+    0x15: 'CancelWithNonce',
+    0x16: 'ExecuteTrxFromAccountDataIterativeV02',
+}
+
+
+def commitment_level(commitment):
+    """The commitment a deprecated commitment name stands for"""
+    return COMMITMENT_ALIASES.get(commitment, commitment)
+
+
+def get_trx_payload(instruction_data):
+    """(unsigned_msg, signature) of the ethereum transaction carried by an instruction, None if there is none"""
+    if instruction_data[0] == 0x05: # CallFromRawTrx
+        return (instruction_data[90:], instruction_data[25:90])
+    if instruction_data[0] in (0x09, 0x13, 0x0d): # PartialCallFromRawEthereumTX(v02) PartialCallOrContinueFromRawEthereumTX
+        return (instruction_data[98:], instruction_data[33:98])
+    return None
+
+
+def decode_trx_payloads(payloads):
+    """Runs in the decode processes: [(eth_trx, eth_signature, from_address) or None] for [(unsigned_msg, signature)]"""
+    results = []
+    for (unsigned_msg, sign) in payloads:
+        try:
+            results.append(get_trx_receipts(unsigned_msg, sign))
+        except Exception:
+            # decoded again on the indexer thread, where the error is reported
+            results.append(None)
+    return results
 
 
 class TransactionStruct:
@@ -56,529 +139,768 @@ class TransactionStruct:
         self.blocked_accounts = blocked_accounts
         self.slot = slot
 
+    def to_state(self):
+        return (self.eth_trx, self.eth_signature, self.from_address, self.signatures, self.storage,
+                self.blocked_accounts, self.slot)
+
+    @staticmethod
+    def from_state(state):
+        (eth_trx, eth_signature, from_address, signatures, storage, blocked_accounts, slot) = state
+        return TransactionStruct(eth_trx, eth_signature, from_address, None, list(signatures), storage,
+                                 blocked_accounts, slot)
+
 
 class Indexer:
-    def __init__(self):
-        self.client = Client(solana_url)
-        self.canceller = Canceller()
+    def __init__(self, subscribe=INDEXER_SUBSCRIBE, client=None, fetcher=None, canceller=None):
+        # client, fetcher and canceller replace the RPC ones, see replay.py
+        self.client = client if client is not None else Client(solana_url)
+        self.fetcher = fetcher if fetcher is not None else ReceiptFetcher(solana_url)
+        self.subscriber = None
+        if subscribe:
+            self.subscriber = SolanaSubscriber(SOLANA_WS_URL, evm_loader_id, INDEXER_SUBSCRIBE_COMMITMENT)
+            self.subscriber.start()
+        # announced signatures the passes did not see yet: signature -> (failed, expiration time)
+        self.awaited = {}
+        self.idle = False
+        self.next_poll = 0
+        self.canceller = canceller if canceller is not None else Canceller()
         self.logs_db = LogDB()
-        self.blocks_by_hash = SQLDict(tablename="solana_blocks_by_hash")
-        self.transaction_receipts = SQLDict(tablename="known_transactions")
-        self.ethereum_trx = SQLDict(tablename="ethereum_transactions")
-        self.eth_sol_trx = SQLDict(tablename="ethereum_solana_transactions")
-        self.sol_eth_trx = SQLDict(tablename="solana_ethereum_transactions")
+        self.blocks_by_hash = BlocksByHashDict()
+        # slot -> block hash of the slots in the current receipts batch
+        self.block_hashes = {}
+        self.transaction_receipts = ReceiptArchiveDict(evm_loader_id)
+        self.raw_receipts = RawReceiptsDict(RAW_RECEIPTS_RETENTION) if RAW_RECEIPTS_RETENTION > 0 else None
+        self.ethereum_trx = EthereumTransactionsDict()
+        self.eth_sol_trx = EthereumSolanaTransactionsDict()
+        self.sol_eth_trx = SolanaEthereumTransactionsDict()
+        self.unfinalized = UnfinalizedTransactionsDict()
+        # notifies the proxy workers of the committed changes
+        self.changes = ChangePublisher()
         self.constants = SQLDict(tablename="constants")
-        self.last_slot = 0
+        self.finalized_slot = self.constants.get('finalized_slot', 0)
         self.current_slot = 0
+        # slot of the last processed receipt, for the lag report
+        self.processed_slot = 0
+        self.blocks_lag = 0
+        # signatures after the cursor, newest first
         self.transaction_order = []
+        # signatures of transactions that failed according to getSignaturesForAddress, no receipt is needed
+        self.failed_txs = set()
+        # signature -> fetches that did not return its receipt
+        self.fetch_attempts = {}
         if 'last_block' not in self.constants:
             self.constants['last_block'] = 0
+        # last signature whose receipt is processed, the next pass starts after it
+        self.cursor = None
+        # iterative transactions in progress by storage account, holder writes by holder account
+        self.pending_trxs = {}
+        self.holders = HolderReassembler()
+        self.saved_cursor = None
         self.blocked_storages = {}
-        self.counter_ = 0
+        self.decode_pool = self.new_decode_pool() if DECODE_WORKERS > 0 else None
+        # pools broken in a row, see predecode
+        self.decode_pool_restarts = 0
+        # (unsigned_msg, signature) -> (eth_trx, eth_signature, from_address) of the current receipts batch
+        self.decoded_trxs = {}
+        self.load_checkpoint()
+        self.last_block = self.constants['last_block']
+        self.next_summary = time.monotonic() + METRICS_LOG_INTERVAL
+
+    def new_decode_pool(self):
+        # spawned, not forked: the indexer already runs the fetcher thread and holds DB connections
+        return ProcessPoolExecutor(DECODE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+    def close(self):
+        """Stop the decode processes and the fetcher."""
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown(wait=False)
+            self.decode_pool = None
+        self.fetcher.close()
+
 
     def run(self, loop = True):
         while (True):
             try:
+                self.wait_for_work()
                 logger.debug("Start indexing")
                 self.gather_unknown_transactions()
                 logger.debug("Process receipts")
                 self.process_receipts()
-                logger.debug("Start getting blocks")
-                self.gather_blocks()
-                logger.debug("Unlock accounts")
-                self.canceller.unlock_accounts(self.blocked_storages)
-                self.blocked_storages = {}
+                if self.blocks_due():
+                    logger.debug("Start getting blocks")
+                    with metrics.time('blocks'):
+                        self.gather_blocks()
+                    self.report_lag()
+                    logger.debug("Unlock accounts")
+                    self.canceller.unlock_accounts(self.blocked_storages)
+                    self.blocked_storages = {}
+                    logger.debug("Reconcile finalized transactions")
+                    with metrics.time('reconcile'):
+                        self.reconcile()
+                    if self.raw_receipts is not None:
+                        logger.debug("Pruned %d raw receipts", self.raw_receipts.prune())
+                    self.next_poll = time.monotonic() + POLL_INTERVAL
             except Exception as err:
                 logger.debug("Got exception while indexing. Type(err):%s, Exception:%s", type(err), err)
+                metrics.inc('cycle_errors_total', error=type(err).__name__)
 
 
-    def gather_unknown_transactions(self):
-        poll_txs = set()
-        ordered_txs = []
+    def subscribed(self):
+        return self.subscriber is not None and self.subscriber.connected
+
+
+    def wait_for_work(self):
+        """Idle until there is something to index.
 
-        minimal_tx = None
-        continue_flag = True
-        current_slot = self.client.get_slot(commitment="confirmed")["result"]
-        maximum_slot = self.last_slot
-        minimal_slot = current_slot
+        With subscriptions: until transactions are announced, UPDATE_BLOCK_COUNT new slots pass or POLL_INTERVAL
+        expires; the announced receipts are fetched right away. Otherwise: POLL_IDLE_INTERVAL after an empty pass."""
+        if not self.subscribed():
+            if self.idle:
+                time.sleep(POLL_IDLE_INTERVAL)
+            return
 
-        percent = 0
+        # an announced transaction may not be confirmed or listed by getSignaturesForAddress yet, look again soon
+        timeout = SLOT_TIME if len(self.awaited) else max(0.0, self.next_poll - time.monotonic())
+        announced = self.subscriber.wait(timeout, self.last_block + UPDATE_BLOCK_COUNT)
+        now = time.monotonic()
+        self.awaited = {signature: awaited for signature, awaited in self.awaited.items() if awaited[1] > now}
+        self.awaited.update((signature, (failed, now + ANNOUNCED_TTL)) for signature, failed in announced.items())
 
+        signatures = [signature for signature, (failed, _) in self.awaited.items() if not failed]
+        if len(signatures):
+            known_txs = self.transaction_receipts.contains_many(signatures)
+            poll_txs = [sig for sig in signatures if sig not in known_txs]
+            with metrics.time('fetch'):
+                receipts = self.fetcher.fetch(poll_txs)
+            metrics.inc('receipts_fetched_total', len(receipts))
+            self.store_receipts(receipts)
+            logger.debug("Fetched announced receipts {}/{}".format(len(receipts), len(poll_txs)))
+
+
+    def blocks_due(self):
+        if not self.subscribed():
+            return True
+        return time.monotonic() >= self.next_poll or self.subscriber.slot >= self.last_block + UPDATE_BLOCK_COUNT
+
+
+    def get_slot(self, commitment):
+        """The slot announced by slotSubscribe when it is of the same commitment, from the RPC node otherwise."""
+        subscribed_commitment = commitment_level(commitment) == commitment_level(INDEXER_SUBSCRIBE_COMMITMENT)
+        if self.subscribed() and self.subscriber.slot > 0 and subscribed_commitment:
+            return self.subscriber.slot
+        return self.client.get_slot(commitment=commitment)["result"]
+
+
+    def walk_signatures(self, before=None, until=None):
+        """getSignaturesForAddress entries of evm_loader between before and until (both excluded), newest first.
+
+        Never goes past HISTORY_START."""
         counter = 0
-        while (continue_flag):
-            opts: Dict[str, Union[int, str]] = {}
-            if minimal_tx:
-                opts["before"] = minimal_tx
-            opts["commitment"] = "confirmed"
+        while True:
+            opts: Dict[str, Union[int, str]] = {"commitment": "confirmed"}
+            if before:
+                opts["before"] = before
+            if until:
+                opts["until"] = until
             result = self.client._provider.make_request("getSignaturesForAddress", evm_loader_id, opts)
             logger.debug("{:>3} get_signatures_for_address {}".format(counter, len(result["result"])))
             counter += 1
 
             if len(result["result"]) == 0:
-                logger.debug("len(result['result']) == 0")
-                break
+                return
 
             for tx in result["result"]:
-                solana_signature = tx["signature"]
-                slot = tx["slot"]
+                if tx["signature"] in HISTORY_START:
+                    logger.debug(tx["signature"])
+                    return
+                yield tx
 
-                if solana_signature in HISTORY_START:
-                    logger.debug(solana_signature)
-                    continue_flag = False
-                    break
+            before = result["result"][-1]["signature"]
 
-                ordered_txs.append(solana_signature)
 
-                if solana_signature not in self.transaction_receipts:
-                    poll_txs.add(solana_signature)
-
-                if slot < minimal_slot:
-                    minimal_slot = slot
-                    minimal_tx = solana_signature
-
-                if slot > maximum_slot:
-                    maximum_slot = slot
-
-                if slot < self.last_slot:
-                    continue_flag = False
-                    break
-
-        logger.debug("start getting receipts")
-        pool = ThreadPool(PARALLEL_REQUESTS)
-        pool.map(self.get_tx_receipts, poll_txs)
-
-        if len(self.transaction_order):
-            index = 0
-            try:
-                index = ordered_txs.index(self.transaction_order[0])
-            except ValueError:
-                self.transaction_order = ordered_txs + self.transaction_order
+    def gather_unknown_transactions(self):
+        """Collect the signatures after the cursor and fetch the receipts that are not archived yet."""
+        ordered_txs = []
+        failed_txs = set()
+        self.current_slot = self.get_slot("confirmed")
+
+        with metrics.time('signatures'):
+            for tx in self.walk_signatures(until=self.cursor):
+                ordered_txs.append(tx["signature"])
+                if tx.get("err") is not None:
+                    failed_txs.add(tx["signature"])
+        metrics.inc('signatures_total', len(ordered_txs))
+
+        self.fetch_unknown_receipts(ordered_txs, failed_txs)
+        self.transaction_order = ordered_txs
+        self.failed_txs = failed_txs
+        self.idle = len(ordered_txs) == 0
+        for signature in ordered_txs:
+            self.awaited.pop(signature, None)
+
+
+    def fetch_unknown_receipts(self, ordered_txs, failed_txs):
+        known_txs = self.transaction_receipts.contains_many(ordered_txs)
+        poll_txs = [sig for sig in ordered_txs if sig not in known_txs and sig not in failed_txs]
+
+        logger.debug("start getting receipts {}/{}, failed {}".format(len(poll_txs), len(ordered_txs), len(failed_txs)))
+        for pos in range(0, len(poll_txs), RECEIPTS_BATCH_SIZE):
+            with metrics.time('fetch'):
+                receipts = self.fetcher.fetch(poll_txs[pos:pos + RECEIPTS_BATCH_SIZE])
+            metrics.inc('receipts_fetched_total', len(receipts))
+            self.store_receipts(receipts)
+            for signature in poll_txs[pos:pos + RECEIPTS_BATCH_SIZE]:
+                if signature in receipts:
+                    self.fetch_attempts.pop(signature, None)
+                else:
+                    self.fetch_attempts[signature] = self.fetch_attempts.get(signature, 0) + 1
+
+
+    def store_receipts(self, receipts):
+        with metrics.time('db_write'):
+            self.transaction_receipts.set_many(receipts)
+            if self.raw_receipts is not None:
+                self.raw_receipts.set_many(receipts)
+
+
+    def iter_new_receipts(self):
+        """(signature, receipt) of transaction_order from the oldest one.
+
+        Failed transactions come with no receipt. Stops at the first receipt that is not archived yet:
+        everything after it waits for the next pass. A receipt the node did not return in RECEIPT_MAX_FETCHES
+        fetches comes as None too, so that one lost receipt does not hold the cursor forever.
+        Signatures indexed in the meantime (e.g. by the proxy) are processed again, so that a resumed
+        checkpoint sees the whole life of its transactions; submitting them again is idempotent.
+        Lookups are batched by RECEIPTS_BATCH_SIZE signatures."""
+        chronological = self.transaction_order[::-1]
+        for pos in range(0, len(chronological), RECEIPTS_BATCH_SIZE):
+            signatures = chronological[pos:pos + RECEIPTS_BATCH_SIZE]
+            receipts = self.transaction_receipts.get_many(signatures)
+            with metrics.time('decode'):
+                self.predecode(receipts.values())
+            self.load_block_hashes(receipts.values())
+            for signature in signatures:
+                if signature in self.failed_txs:
+                    yield signature, None
+                elif signature in receipts:
+                    yield signature, receipts[signature]
+                elif self.fetch_attempts.get(signature, 0) >= RECEIPT_MAX_FETCHES:
+                    logger.error("Skip {}: no receipt after {} fetches".format(signature, RECEIPT_MAX_FETCHES))
+                    metrics.inc('receipts_skipped_total')
+                    self.fetch_attempts.pop(signature)
+                    yield signature, None
+                else:
+                    logger.debug("Receipt of {} is not available yet".format(signature))
+                    return
+
+
+    def predecode(self, receipts):
+        """Decode the ethereum transactions of a receipts batch in the decode processes.
+
+        Holder transactions are left to the indexer thread: their payload is known only after reassembly."""
+        self.decoded_trxs = {}
+        if self.decode_pool is None:
+            return
+
+        payloads = set()
+        for trx in receipts:
+            if check_error(trx) or trx['transaction']['message']['instructions'] is None:
+                continue
+            account_keys = trx['transaction']['message']['accountKeys']
+            for instruction in trx['transaction']['message']['instructions']:
+                if account_keys[instruction["programIdIndex"]] != evm_loader_id:
+                    continue
+                payload = get_trx_payload(base58.b58decode(instruction['data']))
+                if payload is not None:
+                    payloads.add((bytes(payload[0]), bytes(payload[1])))
+        if len(payloads) < DECODE_MIN_BATCH:
+            return
+
+        payloads = list(payloads)
+        chunk_size = max(16, len(payloads) // (DECODE_WORKERS * 4))
+        chunks = [payloads[pos:pos + chunk_size] for pos in range(0, len(payloads), chunk_size)]
+        try:
+            for chunk, results in zip(chunks, self.decode_pool.map(decode_trx_payloads, chunks)):
+                for payload, result in zip(chunk, results):
+                    if result is not None:
+                        self.decoded_trxs[payload] = result
+            self.decode_pool_restarts = 0
+        except BrokenProcessPool as err:
+            # a worker died (OOM, failed start), the pool takes no more work: the rest is decoded inline
+            metrics.inc('decode_pool_errors_total')
+            self.decode_pool.shutdown(wait=False)
+            self.decode_pool_restarts += 1
+            if self.decode_pool_restarts < DECODE_MAX_RESTARTS:
+                logger.error("Decode processes died, start new ones: {}".format(err))
+                self.decode_pool = self.new_decode_pool()
             else:
-                self.transaction_order = ordered_txs[:index] + self.transaction_order
-        else:
-            self.transaction_order = ordered_txs
+                logger.error("Decode processes died {} times in a row, decode on the indexer thread: {}".format(
+                    self.decode_pool_restarts, err))
+                self.decode_pool = None
 
-        self.last_slot = maximum_slot
-        self.current_slot = current_slot
 
-        self.counter_ = 0
+    def load_block_hashes(self, receipts):
+        """Block hashes of the slots of a receipts batch: the stored ones, the others in one batched fetch."""
+        slots = set(trx['slot'] for trx in receipts if not check_error(trx))
+        self.block_hashes = self.blocks_by_hash.hashes_of(slots)
+        missing = sorted(slots.difference(self.block_hashes))
+        if len(missing):
+            with metrics.time('fetch'):
+                self.store_block_hashes(self.fetcher.fetch_blocks(missing))
 
 
-    def get_tx_receipts(self, solana_signature):
-        # trx = None
-        retry = True
+    def block_hash(self, slot):
+        block_hash = self.block_hashes.get(slot)
+        if block_hash is None:
+            # the fetcher retries FETCH_MAX_RETRIES times, the next pass starts over from the checkpoint
+            self.store_block_hashes(self.fetcher.fetch_blocks([slot]))
+            block_hash = self.block_hashes.get(slot)
+            if block_hash is None:
+                raise Exception("Could not get the block of slot {}".format(slot))
+        return block_hash
 
-        while retry:
-            try:
-                trx = self.client.get_confirmed_transaction(solana_signature)['result']
-                self.transaction_receipts[solana_signature] = trx
-                retry = False
-            except Exception as err:
-                logger.debug(err)
-                time.sleep(1)
 
-        self.counter_ += 1
-        if self.counter_ % 100 == 0:
-            logger.debug(self.counter_)
+    def store_block_hashes(self, blocks):
+        hashes = {slot: '0x' + base58.b58decode(block['blockhash']).hex() for (slot, block) in blocks.items()}
+        self.blocks_by_hash.set_many((block_hash, slot) for (slot, block_hash) in hashes.items())
+        self.block_hashes.update(hashes)
 
-        # return (solana_signature, trx)
+
+    def decode_trx(self, unsigned_msg, sign):
+        result = self.decoded_trxs.get((bytes(unsigned_msg), bytes(sign)))
+        if result is None:
+            with metrics.time('decode'):
+                result = get_trx_receipts(unsigned_msg, sign)
+        return result
 
 
     def process_receipts(self):
         counter = 0
-        holder_table = {}
-        continue_table = {}
-        trx_table = {}
-
-        for signature in self.transaction_order:
+        for signature, trx in self.iter_new_receipts():
             counter += 1
-
-            if signature in self.sol_eth_trx:
+            if trx is not None:
+                self.process_receipt(signature, trx)
+                self.processed_slot = trx['slot']
+            self.cursor = signature
+            if counter % RECEIPTS_BATCH_SIZE == 0:
+                self.save_checkpoint()
+                self.publish_changes()
+        self.save_checkpoint()
+        self.publish_changes()
+        metrics.inc('receipts_processed_total', counter)
+        logger.debug("Processed {} receipts, pending {} transactions, {} holders".format(
+            counter, len(self.pending_trxs), len(self.holders)))
+
+        for storage, trx_struct in list(self.pending_trxs.items()):
+            if abs(trx_struct.slot - self.current_slot) > PENDING_TRX_TTL:
+                logger.error("Drop pending transaction {} of storage {}".format(trx_struct.eth_signature, storage))
+                del self.pending_trxs[storage]
+            elif abs(trx_struct.slot - self.current_slot) > CANCEL_TIMEOUT:
+                self.blocked_storages[storage] = (trx_struct.eth_trx, trx_struct.blocked_accounts)
+
+        for holder_account, holder in self.holders.items():
+            if abs(holder.slot - self.current_slot) > PENDING_TRX_TTL:
+                self.holders.pop(holder_account)
+
+
+    def publish_changes(self):
+        self.changes.indexed_slot(self.processed_slot)
+        self.changes.flush()
+
+
+    def load_checkpoint(self):
+        """Resume from the saved cursor and transactions in progress, or set up the INDEXER_START point."""
+        state = self.constants.get('indexer_state', None)
+        if state is not None:
+            self.cursor = state['cursor']
+            self.pending_trxs = {storage: TransactionStruct.from_state(trx_state)
+                                 for storage, trx_state in state['pending_trxs'].items()}
+            self.holders.load_state(state['holders'])
+            self.saved_cursor = self.cursor
+            logger.debug("Resume after {}: {} pending transactions, {} holders".format(
+                self.cursor, len(self.pending_trxs), len(self.holders)))
+            return
+
+        if INDEXER_START == 'LATEST':
+            latest = self.client._provider.make_request("getSignaturesForAddress", evm_loader_id,
+                                                        {"limit": 1, "commitment": "confirmed"})["result"]
+            if len(latest):
+                self.cursor = latest[0]["signature"]
+                start_slot = latest[0]["slot"]
+            else:
+                start_slot = self.client.get_slot(commitment="confirmed")["result"]
+        else:
+            # the history is walked back to INDEXER_START, blocks are gathered from its slot
+            trx = self.client.get_confirmed_transaction(INDEXER_START)['result']
+            start_slot = trx['slot'] if trx is not None else 0
+
+        if self.constants['last_block'] < start_slot:
+            self.constants['last_block'] = start_slot
+        logger.debug("Start indexing from {} slot {}".format(INDEXER_START, start_slot))
+        self.save_checkpoint()
+
+
+    def save_checkpoint(self):
+        """Store the cursor together with the transactions in progress at that point, in one row."""
+        if self.saved_cursor == self.cursor and self.cursor is not None:
+            return
+        with metrics.time('db_write'):
+            self.constants['indexer_state'] = {
+                'cursor': self.cursor,
+                'pending_trxs': {storage: trx_struct.to_state() for storage, trx_struct in self.pending_trxs.items()},
+                'holders': self.holders.to_state(),
+            }
+        self.saved_cursor = self.cursor
+
+
+    def complete_transaction(self, trx_struct, got_result):
+        trx_struct.got_result = got_result
+        # still pending if submitting fails, the receipt is processed again
+        self.submit_transaction(trx_struct)
+        if self.pending_trxs.get(trx_struct.storage) is trx_struct:
+            del self.pending_trxs[trx_struct.storage]
+
+
+    def read_holder(self, holder_account):
+        """(eth_trx, eth_signature, from_address) from the data written to the holder, None if it is incomplete"""
+        holder = self.holders.get(holder_account)
+        if holder is None:
+            logger.error("Holder {} not found".format(holder_account))
+            return None
+        payload = holder.payload()
+        if payload is None:
+            logger.error("Holder {} is not completely written".format(holder_account))
+            return None
+
+        (signature, unsigned_msg) = payload
+        try:
+            return get_trx_receipts(unsigned_msg, signature)
+        except rlp.exceptions.RLPException:
+            return None
+        except Exception as err:
+            if str(err).startswith("unhashable type") or str(err).startswith("unsupported operand type"):
+                return None
+            logger.debug("could not parse trx {}".format(err))
+            raise
+
+
+    def start_from_holder(self, signature, holder_account, storage_account, blocked_accounts, slot):
+        """Iterative execution of a transaction written to a holder: the writes become part of its signatures"""
+        holder = self.holders.get(holder_account)
+        trx = self.read_holder(holder_account)
+        if trx is None:
+            return None
+        (eth_trx, eth_signature, from_address) = trx
+        if storage_account in self.pending_trxs:
+            logger.error("Strange behavior. Pay attention. STORAGE {} IS BUSY".format(storage_account))
+        trx_struct = TransactionStruct(eth_trx, eth_signature, from_address, None,
+                                       holder.signatures + [signature], storage_account, blocked_accounts, slot)
+        self.pending_trxs[storage_account] = trx_struct
+        self.holders.pop(holder_account)
+        return trx_struct
+
+
+    def process_receipt(self, signature, trx):
+        """Apply one transaction of the evm_loader program to the state of the transactions in progress.
+
+        Receipts must come in chronological order: a transaction starts with a partial call or with holder writes
+        followed by an execution from the holder, goes on with continues and ends with the one that returns
+        the result or with a cancel."""
+        if check_error(trx):
+            return
+        slot = trx['slot']
+        if trx['transaction']['message']['instructions'] is None:
+            return
+
+        account_keys = trx['transaction']['message']['accountKeys']
+        for instruction in trx['transaction']['message']['instructions']:
+            if account_keys[instruction["programIdIndex"]] != evm_loader_id:
                 continue
 
-            if signature in self.transaction_receipts:
-                trx = self.transaction_receipts[signature]
-                if trx is None:
-                    logger.error("trx is None")
-                    del self.transaction_receipts[signature]
+            instruction_data = base58.b58decode(instruction['data'])
+            accounts = [account_keys[acc_idx] for acc_idx in instruction['accounts']]
+            metrics.inc('instructions_total', type=INSTRUCTION_NAMES.get(instruction_data[0],
+                                                                         '0x{:02x}'.format(instruction_data[0])))
+
+            if instruction_data[0] == 0x00 or instruction_data[0] == 0x12: # Write or WriteWithHolder
+                write_account = accounts[0]
+                if instruction_data[0] == 0x00:
+                    offset = int.from_bytes(instruction_data[4:8], "little")
+                    length = int.from_bytes(instruction_data[8:16], "little")
+                    data = instruction_data[16:]
+                if instruction_data[0] == 0x12:
+                    offset = int.from_bytes(instruction_data[9:13], "little")
+                    length = int.from_bytes(instruction_data[13:21], "little")
+                    data = instruction_data[21:]
+
+                try:
+                    self.holders.write(write_account, offset, data[:length], signature, slot)
+                except ValueError as err:
+                    logger.error(err)
+
+            elif instruction_data[0] == 0x05: # CallFromRawTrx
+                # collateral_pool_buf = instruction_data[1:5]
+                # from_addr = instruction_data[5:25]
+                sign = instruction_data[25:90]
+                unsigned_msg = instruction_data[90:]
+
+                (eth_trx, eth_signature, from_address) = self.decode_trx(unsigned_msg, sign)
+                got_result = get_trx_results(trx)
+                if got_result is not None:
+                    self.submit_transaction(TransactionStruct(eth_trx, eth_signature, from_address, got_result,
+                                                              [signature], None, None, slot))
+                else:
+                    logger.error("RESULT NOT FOUND IN 05\n{}".format(json.dumps(trx, indent=4, sort_keys=True)))
+
+            elif instruction_data[0] == 0x09 or instruction_data[0] == 0x13: # PartialCallFromRawEthereumTX PartialCallFromRawEthereumTXv02
+                storage_account = accounts[0]
+                blocked_accounts = accounts[7:]
+
+                # collateral_pool_buf = instruction_data[1:5]
+                # step_count = instruction_data[5:13]
+                # from_addr = instruction_data[13:33]
+                sign = instruction_data[33:98]
+                unsigned_msg = instruction_data[98:]
+
+                (eth_trx, eth_signature, from_address) = self.decode_trx(unsigned_msg, sign)
+                if storage_account in self.pending_trxs:
+                    logger.error("Strange behavior. Pay attention. STORAGE {} IS BUSY".format(storage_account))
+                self.pending_trxs[storage_account] = TransactionStruct(eth_trx, eth_signature, from_address, None,
+                                                                       [signature], storage_account, blocked_accounts,
+                                                                       slot)
+
+            elif instruction_data[0] == 0x0a or instruction_data[0] == 0x14: # Continue or ContinueV02
+                storage_account = accounts[0]
+                blocked_accounts = accounts[5:]
+                got_result = get_trx_results(trx)
+
+                trx_struct = self.pending_trxs.get(storage_account)
+                if trx_struct is None:
+                    logger.debug("Continue of unknown transaction in storage {}".format(storage_account))
                     continue
-                if 'slot' not in trx:
-                    logger.debug("\n{}".format(json.dumps(trx, indent=4, sort_keys=True)))
-                    exit()
-                slot = trx['slot']
-                if trx['transaction']['message']['instructions'] is not None:
-                    for instruction in trx['transaction']['message']['instructions']:
-
-                        if trx["transaction"]["message"]["accountKeys"][instruction["programIdIndex"]] != evm_loader_id:
-                            continue
-
-                        if check_error(trx):
-                            continue
-
-                        instruction_data = base58.b58decode(instruction['data'])
-
-                        if instruction_data[0] == 0x00 or instruction_data[0] == 0x12: # Write or WriteWithHolder
-                            # if instruction_data[0] == 0x00:
-                            #     logger.debug("{:>10} {:>6} Write 0x{}".format(slot, counter, instruction_data[-20:].hex()))
-                            # if instruction_data[0] == 0x12:
-                            #     logger.debug("{:>10} {:>6} WriteWithHolder 0x{}".format(slot, counter, instruction_data[-20:].hex()))
-
-                            write_account = trx['transaction']['message']['accountKeys'][instruction['accounts'][0]]
-
-                            if write_account in holder_table:
-                                storage_account = holder_table[write_account].storage_account
-                                if storage_account in continue_table:
-                                    continue_table[storage_account].signatures.append(signature)
-
-                                if instruction_data[0] == 0x00:
-                                    offset = int.from_bytes(instruction_data[4:8], "little")
-                                    length = int.from_bytes(instruction_data[8:16], "little")
-                                    data = instruction_data[16:]
-                                if instruction_data[0] == 0x12:
-                                    offset = int.from_bytes(instruction_data[9:13], "little")
-                                    length = int.from_bytes(instruction_data[13:21], "little")
-                                    data = instruction_data[21:]
-
-                                # logger.debug("WRITE offset {} length {}".format(offset, length))
-
-                                if holder_table[write_account].max_written < (offset + length):
-                                    holder_table[write_account].max_written = offset + length
-
-                                for index in range(length):
-                                    holder_table[write_account].data[1+offset+index] = data[index]
-                                    holder_table[write_account].count_written += 1
-
-                                if holder_table[write_account].max_written == holder_table[write_account].count_written:
-                                    # logger.debug("WRITE {} {}".format(holder_table[write_account].max_written, holder_table[write_account].count_written))
-                                    signature = holder_table[write_account].data[1:66]
-                                    length = int.from_bytes(holder_table[write_account].data[66:74], "little")
-                                    unsigned_msg = holder_table[write_account].data[74:74+length]
-
-                                    try:
-                                        (eth_trx, eth_signature, from_address) = get_trx_receipts(unsigned_msg, signature)
-                                        if len(eth_trx) / 2 > holder_table[write_account].max_written:
-                                            logger.debug("WRITE got {} exp {}".format(len(eth_trx), holder_table[write_account].max_written))
-                                            continue
-
-                                        if storage_account in continue_table:
-                                            continue_result = continue_table[storage_account]
-
-                                            # logger.debug(eth_signature)
-                                            trx_table[eth_signature] = TransactionStruct(
-                                                    eth_trx,
-                                                    eth_signature,
-                                                    from_address,
-                                                    continue_result.results,
-                                                    continue_result.signatures,
-                                                    storage_account,
-                                                    continue_result.accounts,
-                                                    slot
-                                                )
-
-                                            del continue_table[storage_account]
-                                        else:
-                                            logger.error("Storage not found")
-                                            logger.error(eth_signature, "unknown")
-                                            # raise
-
-                                        del holder_table[write_account]
-                                    except rlp.exceptions.RLPException:
-                                        # logger.debug("rlp.exceptions.RLPException")
-                                        pass
-                                    except Exception as err:
-                                        if str(err).startswith("unhashable type"):
-                                            # logger.debug("unhashable type")
-                                            pass
-                                        elif str(err).startswith("unsupported operand type"):
-                                            # logger.debug("unsupported operand type")
-                                            pass
-                                        else:
-                                            logger.debug("could not parse trx {}".format(err))
-                                            raise
-
-                        elif instruction_data[0] == 0x01: # Finalize
-                            # logger.debug("{:>10} {:>6} Finalize 0x{}".format(slot, counter, instruction_data.hex()))
-
-                            pass
-
-                        elif instruction_data[0] == 0x02: # CreateAccount
-                            # logger.debug("{:>10} {:>6} CreateAccount 0x{}".format(slot, counter, instruction_data[-21:-1].hex()))
-
-                            pass
-
-                        elif instruction_data[0] == 0x03: # Call
-                            # logger.debug("{:>10} {:>6} Call 0x{}".format(slot, counter, instruction_data.hex()))
-
-                            pass
-
-                        elif instruction_data[0] == 0x04: # CreateAccountWithSeed
-                            # logger.debug("{:>10} {:>6} CreateAccountWithSeed 0x{}".format(slot, counter, instruction_data.hex()))
-
-                            pass
-
-                        elif instruction_data[0] == 0x05: # CallFromRawTrx
-                            # logger.debug("{:>10} {:>6} CallFromRawTrx 0x{}".format(slot, counter, instruction_data.hex()))
-
-                            # collateral_pool_buf = instruction_data[1:5]
-                            # from_addr = instruction_data[5:25]
-                            sign = instruction_data[25:90]
-                            unsigned_msg = instruction_data[90:]
-
-                            (eth_trx, eth_signature, from_address) = get_trx_receipts(unsigned_msg, sign)
-
-                            got_result = get_trx_results(trx)
-                            if got_result is not None:
-                                # self.submit_transaction(eth_trx, eth_signature, from_address, got_result, [signature])
-                                trx_table[eth_signature] = TransactionStruct(
-                                        eth_trx,
-                                        eth_signature,
-                                        from_address,
-                                        got_result,
-                                        [signature],
-                                        None,
-                                        None,
-                                        slot
-                                    )
-                            else:
-                                logger.error("RESULT NOT FOUND IN 05\n{}".format(json.dumps(trx, indent=4, sort_keys=True)))
-
-                        elif instruction_data[0] == 0x09 or instruction_data[0] == 0x13: # PartialCallFromRawEthereumTX PartialCallFromRawEthereumTXv02
-                            # if instruction_data[0] == 0x09:
-                            #     logger.debug("{:>10} {:>6} PartialCallFromRawEthereumTX 0x{}".format(slot, counter, instruction_data.hex()))
-                            # if instruction_data[0] == 0x13:
-                            #     logger.debug("{:>10} {:>6} PartialCallFromRawEthereumTXv02 0x{}".format(slot, counter, instruction_data.hex()))
-
-
-                            storage_account = trx['transaction']['message']['accountKeys'][instruction['accounts'][0]]
-                            blocked_accounts = [trx['transaction']['message']['accountKeys'][acc_idx] for acc_idx in instruction['accounts'][7:]]
-
-                            # collateral_pool_buf = instruction_data[1:5]
-                            # step_count = instruction_data[5:13]
-                            # from_addr = instruction_data[13:33]
-
-                            sign = instruction_data[33:98]
-                            unsigned_msg = instruction_data[98:]
-
-                            (eth_trx, eth_signature, from_address) = get_trx_receipts(unsigned_msg, sign)
-
-                            trx_table[eth_signature] = TransactionStruct(
-                                    eth_trx,
-                                    eth_signature,
-                                    from_address,
-                                    None,
-                                    [signature],
-                                    storage_account,
-                                    blocked_accounts,
-                                    slot
-                                )
-
-                            if storage_account in continue_table:
-                                continue_result = continue_table[storage_account]
-                                if continue_result.accounts != blocked_accounts:
-                                    logger.error("Strange behavior. Pay attention. BLOCKED ACCOUNTS NOT EQUAL")
-                                continue_result.signatures.append(signature)
-                                trx_table[eth_signature].got_result = continue_result.results
-                                trx_table[eth_signature].signatures = continue_result.signatures
-                                del continue_table[storage_account]
-
-                        elif instruction_data[0] == 0x0a or instruction_data[0] == 0x14: # Continue or ContinueV02
-
-                            storage_account = trx['transaction']['message']['accountKeys'][instruction['accounts'][0]]
-                            if instruction_data[0] == 0x0a:
-                                # logger.debug("{:>10} {:>6} Continue 0x{}".format(slot, counter, instruction_data.hex()))
-                                blocked_accounts = [trx['transaction']['message']['accountKeys'][acc_idx] for acc_idx in instruction['accounts'][5:]]
-                            if instruction_data[0] == 0x14:
-                                # logger.debug("{:>10} {:>6} ContinueV02 0x{}".format(slot, counter, instruction_data.hex()))
-                                blocked_accounts = [trx['transaction']['message']['accountKeys'][acc_idx] for acc_idx in instruction['accounts'][5:]]
-                            got_result = get_trx_results(trx)
-
-                            if storage_account in continue_table:
-                                continue_table[storage_account].signatures.append(signature)
-
-                                if got_result:
-                                    if continue_table[storage_account].results:
-                                        logger.error("Strange behavior. Pay attention. RESULT ALREADY EXISTS IN CONTINUE TABLE")
-                                    if continue_table[storage_account].accounts != blocked_accounts:
-                                        logger.error("Strange behavior. Pay attention. BLOCKED ACCOUNTS NOT EQUAL")
-
-                                    continue_table[storage_account].results = got_result
-                            else:
-                                continue_table[storage_account] = ContinueStruct(signature, got_result, blocked_accounts)
-
-                        elif instruction_data[0] == 0x0b or instruction_data[0] == 0x16: # ExecuteTrxFromAccountDataIterative ExecuteTrxFromAccountDataIterativeV02
-                            if instruction_data[0] == 0x0b:
-                                # logger.debug("{:>10} {:>6} ExecuteTrxFromAccountDataIterative 0x{}".format(slot, counter, instruction_data.hex()))
-                                blocked_accounts = [trx['transaction']['message']['accountKeys'][acc_idx] for acc_idx in instruction['accounts'][5:]]
-                            if instruction_data[0] == 0x16:
-                                # logger.debug("{:>10} {:>6} ExecuteTrxFromAccountDataIterativeV02 0x{}".format(slot, counter, instruction_data.hex()))
-                                blocked_accounts = [trx['transaction']['message']['accountKeys'][acc_idx] for acc_idx in instruction['accounts'][7:]]
-
-
-                            holder_account =  trx['transaction']['message']['accountKeys'][instruction['accounts'][0]]
-                            storage_account = trx['transaction']['message']['accountKeys'][instruction['accounts'][1]]
-                            blocked_accounts = [trx['transaction']['message']['accountKeys'][acc_idx] for acc_idx in instruction['accounts'][5:]]
-
-                            if storage_account in continue_table:
-                                continue_table[storage_account].signatures.append(signature)
-
-                                if holder_account in holder_table:
-                                    if holder_table[holder_account].storage_account != storage_account:
-                                        logger.error("Strange behavior. Pay attention. STORAGE_ACCOUNT != STORAGE_ACCOUNT")
-                                        holder_table[holder_account] = HolderStruct(storage_account)
-                                else:
-                                    holder_table[holder_account] = HolderStruct(storage_account)
-                            else:
-                                continue_table[storage_account] =  ContinueStruct(signature, None, blocked_accounts)
-                                holder_table[holder_account] = HolderStruct(storage_account)
-
-
-                        elif instruction_data[0] == 0x0c or instruction_data[0] == 0x15: # Cancel
-                            # logger.debug("{:>10} {:>6} Cancel 0x{}".format(slot, counter, instruction_data.hex()))
-
-                            storage_account = trx['transaction']['message']['accountKeys'][instruction['accounts'][0]]
-                            continue_table[storage_account] = ContinueStruct(signature, ([], "0x0", 0, [], trx['slot']))
-
-                        elif instruction_data[0] == 0x0d:
-                            # logger.debug("{:>10} {:>6} PartialCallOrContinueFromRawEthereumTX 0x{}".format(slot, counter, instruction_data.hex()))
-
-                            storage_account = trx['transaction']['message']['accountKeys'][instruction['accounts'][0]]
-                            blocked_accounts = [trx['transaction']['message']['accountKeys'][acc_idx] for acc_idx in instruction['accounts'][7:]]
-                            got_result = get_trx_results(trx)
-
-                            # collateral_pool_buf = instruction_data[1:5]
-                            # step_count = instruction_data[5:13]
-                            # from_addr = instruction_data[13:33]
-
-                            sign = instruction_data[33:98]
-                            unsigned_msg = instruction_data[98:]
-
-                            (eth_trx, eth_signature, from_address) = get_trx_receipts(unsigned_msg, sign)
-
-                            if eth_signature in trx_table:
-                                trx_table[eth_signature].signatures.append(signature)
-                            else:
-                                trx_table[eth_signature] = TransactionStruct(
-                                        eth_trx,
-                                        eth_signature,
-                                        from_address,
-                                        got_result,
-                                        [signature],
-                                        storage_account,
-                                        blocked_accounts,
-                                        slot
-                                    )
-
-                        elif instruction_data[0] == 0x0e:
-                            # logger.debug("{:>10} {:>6} ExecuteTrxFromAccountDataIterativeOrContinue 0x{}".format(slot, counter, instruction_data.hex()))
-
-                            holder_account =  trx['transaction']['message']['accountKeys'][instruction['accounts'][0]]
-                            storage_account = trx['transaction']['message']['accountKeys'][instruction['accounts'][1]]
-                            blocked_accounts = [trx['transaction']['message']['accountKeys'][acc_idx] for acc_idx in instruction['accounts'][7:]]
-                            got_result = get_trx_results(trx)
-
-                            if storage_account in continue_table:
-                                continue_table[storage_account].signatures.append(signature)
-
-                                if holder_account in holder_table:
-                                    if holder_table[holder_account].storage_account != storage_account:
-                                        logger.error("Strange behavior. Pay attention. STORAGE_ACCOUNT != STORAGE_ACCOUNT")
-                                        holder_table[holder_account] = HolderStruct(storage_account)
-                                else:
-                                    logger.error("Strange behavior. Pay attention. HOLDER ACCOUNT NOT FOUND")
-                                    holder_table[holder_account] = HolderStruct(storage_account)
-
-                                if got_result:
-                                    if continue_table[storage_account].results:
-                                        logger.error("Strange behavior. Pay attention. RESULT ALREADY EXISTS IN CONTINUE TABLE")
-                                    if continue_table[storage_account].accounts != blocked_accounts:
-                                        logger.error("Strange behavior. Pay attention. BLOCKED ACCOUNTS NOT EQUAL")
-
-                                    continue_table[storage_account].results = got_result
-                            else:
-                                continue_table[storage_account] =  ContinueStruct(signature, got_result, blocked_accounts)
-                                holder_table[holder_account] = HolderStruct(storage_account)
-
-                        if instruction_data[0] > 0x16:
-                            logger.debug("{:>10} {:>6} Unknown 0x{}".format(slot, counter, instruction_data.hex()))
-
-                            pass
-
-        for eth_signature, trx_struct in trx_table.items():
-            if trx_struct.got_result:
-                self.submit_transaction(trx_struct)
-            elif trx_struct.storage:
-                if abs(trx_struct.slot - self.current_slot) > CANCEL_TIMEOUT:
-                    self.blocked_storages[trx_struct.storage] = (trx_struct.eth_trx, trx_struct.blocked_accounts)
-            else:
-                logger.error(trx_struct)
+                if trx_struct.blocked_accounts != blocked_accounts:
+                    logger.error("Strange behavior. Pay attention. BLOCKED ACCOUNTS NOT EQUAL")
+                trx_struct.signatures.append(signature)
+                trx_struct.slot = slot
+                if got_result:
+                    self.complete_transaction(trx_struct, got_result)
+
+            elif instruction_data[0] == 0x0b or instruction_data[0] == 0x16: # ExecuteTrxFromAccountDataIterative ExecuteTrxFromAccountDataIterativeV02
+                holder_account = accounts[0]
+                storage_account = accounts[1]
+                blocked_accounts = accounts[5:]
+                self.start_from_holder(signature, holder_account, storage_account, blocked_accounts, slot)
+
+            elif instruction_data[0] == 0x0c or instruction_data[0] == 0x15: # Cancel
+                storage_account = accounts[0]
+                trx_struct = self.pending_trxs.get(storage_account)
+                if trx_struct is None:
+                    logger.debug("Cancel of unknown transaction in storage {}".format(storage_account))
+                    continue
+                trx_struct.signatures.append(signature)
+                self.complete_transaction(trx_struct, ([], "0x0", 0, [], slot))
+
+            elif instruction_data[0] == 0x0d: # PartialCallOrContinueFromRawEthereumTX
+                storage_account = accounts[0]
+                blocked_accounts = accounts[7:]
+                got_result = get_trx_results(trx)
+
+                # collateral_pool_buf = instruction_data[1:5]
+                # step_count = instruction_data[5:13]
+                # from_addr = instruction_data[13:33]
+                sign = instruction_data[33:98]
+                unsigned_msg = instruction_data[98:]
+
+                (eth_trx, eth_signature, from_address) = self.decode_trx(unsigned_msg, sign)
+                trx_struct = self.pending_trxs.get(storage_account)
+                if trx_struct is not None and trx_struct.eth_signature == eth_signature:
+                    trx_struct.signatures.append(signature)
+                    trx_struct.slot = slot
+                else:
+                    trx_struct = TransactionStruct(eth_trx, eth_signature, from_address, None,
+                                                   [signature], storage_account, blocked_accounts, slot)
+                    self.pending_trxs[storage_account] = trx_struct
+                if got_result:
+                    self.complete_transaction(trx_struct, got_result)
+
+            elif instruction_data[0] == 0x0e: # ExecuteTrxFromAccountDataIterativeOrContinue
+                holder_account = accounts[0]
+                storage_account = accounts[1]
+                blocked_accounts = accounts[7:]
+                got_result = get_trx_results(trx)
+
+                trx_struct = self.pending_trxs.get(storage_account)
+                if trx_struct is not None and holder_account not in self.holders:
+                    trx_struct.signatures.append(signature)
+                    trx_struct.slot = slot
+                else:
+                    trx_struct = self.start_from_holder(signature, holder_account, storage_account,
+                                                        blocked_accounts, slot)
+                if trx_struct is not None and got_result:
+                    self.complete_transaction(trx_struct, got_result)
+
+            elif instruction_data[0] > 0x16:
+                logger.debug("{:>10} Unknown 0x{}".format(slot, instruction_data.hex()))
 
 
     def submit_transaction(self, trx_struct):
         (logs, status, gas_used, return_value, slot) = trx_struct.got_result
-        (_slot, block_hash) = self.get_block(slot)
-        if logs:
-            for rec in logs:
-                rec['transactionHash'] = trx_struct.eth_signature
-                rec['blockHash'] = block_hash
-            self.logs_db.push_logs(logs)
-        self.ethereum_trx[trx_struct.eth_signature] = {
-            'eth_trx': trx_struct.eth_trx,
-            'slot': slot,
-            'logs': logs,
-            'status': status,
-            'gas_used': gas_used,
-            'return_value': return_value,
-            'from_address': trx_struct.from_address,
-        }
-        self.eth_sol_trx[trx_struct.eth_signature] = trx_struct.signatures
-        for idx, sig in enumerate(trx_struct.signatures):
-            self.sol_eth_trx[sig] = {
-                'idx': idx,
-                'eth': trx_struct.eth_signature,
+        block_hash = self.block_hash(slot)
+        with metrics.time('db_write'):
+            if logs:
+                for rec in logs:
+                    rec['transactionHash'] = trx_struct.eth_signature
+                    rec['blockHash'] = block_hash
+                self.logs_db.push_logs(logs)
+            self.ethereum_trx[trx_struct.eth_signature] = {
+                'eth_trx': trx_struct.eth_trx,
+                'slot': slot,
+                'logs': logs,
+                'status': status,
+                'gas_used': gas_used,
+                'return_value': return_value,
+                'from_address': trx_struct.from_address,
             }
-        self.blocks_by_hash[block_hash] = slot
+            if slot > self.finalized_slot:
+                self.unfinalized[trx_struct.eth_signature] = slot
+            # newest first: idx 0 is the solana transaction with the result
+            signatures = trx_struct.signatures[::-1]
+            self.eth_sol_trx[trx_struct.eth_signature] = signatures
+            self.sol_eth_trx.set_many((sig, {
+                    'idx': idx,
+                    'eth': trx_struct.eth_signature,
+                }) for idx, sig in enumerate(signatures))
+        self.changes.transaction(trx_struct.eth_signature, slot, bool(logs))
 
         logger.debug(trx_struct.eth_signature + " " + status)
 
 
-    def gather_blocks(self):
-        max_slot = self.client.get_slot(commitment="recent")["result"]
+    def reconcile(self):
+        """Promote the transactions indexed before finalization once their slot is finalized,
+        roll back the ones whose solana transactions were dropped with a fork."""
+        self.finalized_slot = self.client.get_slot(commitment="finalized")["result"]
+        self.constants['finalized_slot'] = self.finalized_slot
+
+        candidates = self.unfinalized.up_to(self.finalized_slot)
+        if len(candidates) == 0:
+            return
+        eth_sol_trx = self.eth_sol_trx.get_many(candidates.keys())
+        signatures = [sig for eth_signature in candidates for sig in eth_sol_trx.get(eth_signature, [])]
+        statuses = {}
+        for pos in range(0, len(signatures), SIGNATURE_STATUSES_BATCH):
+            batch = signatures[pos:pos + SIGNATURE_STATUSES_BATCH]
+            result = self.client._provider.make_request("getSignatureStatuses", batch,
+                                                        {"searchTransactionHistory": True})["result"]["value"]
+            statuses.update(zip(batch, result))
+
+        finalized = []
+        for eth_signature in candidates:
+            trx_signatures = eth_sol_trx.get(eth_signature, [])
+            trx_statuses = [statuses.get(sig) for sig in trx_signatures]
+            if any(status is not None and status.get('err') is not None for status in trx_statuses):
+                self.rollback_transaction(eth_signature, trx_signatures)
+            elif any(status is None for status in trx_statuses):
+                # an unknown signature may just not be visible to this node yet, only a finalized block proves a drop
+                if any(self.dropped(sig) for sig, status in zip(trx_signatures, trx_statuses) if status is None):
+                    self.rollback_transaction(eth_signature, trx_signatures)
+            elif all(status.get('confirmationStatus') == 'finalized' for status in trx_statuses):
+                finalized.append(eth_signature)
+        for eth_signature in finalized:
+            del self.unfinalized[eth_signature]
+        self.changes.flush()
+        logger.debug("Finalized {} transactions up to slot {}".format(len(finalized), self.finalized_slot))
+
+
+    def dropped(self, signature):
+        """True if the finalized block of the slot the receipt came from does not have the transaction,
+        or the slot was skipped. False while the node can not tell."""
+        receipt = self.transaction_receipts.get(signature, None)
+        if receipt is None or receipt['slot'] > self.finalized_slot:
+            return False
+        response = self.client._provider.make_request("getBlock", receipt['slot'], {
+            "commitment": "finalized", "transactionDetails": "signatures", "rewards": False})
+        if 'error' in response:
+            return response['error'].get('code') in SKIPPED_SLOT_ERRORS
+        return response['result'] is not None and signature not in response['result']['signatures']
+
+
+    def rollback_transaction(self, eth_signature, signatures):
+        logger.error("Roll back {}: its solana transactions failed or are not in the finalized chain".format(eth_signature))
+        self.logs_db.delete_logs(eth_signature)
+        for sig in signatures:
+            self.sol_eth_trx.pop(sig, None)
+            self.transaction_receipts.pop(sig, None)
+        self.eth_sol_trx.pop(eth_signature, None)
+        self.ethereum_trx.pop(eth_signature, None)
+        self.unfinalized.pop(eth_signature, None)
+        self.changes.rollback(eth_signature)
 
-        last_block = self.constants['last_block']
-        if last_block + UPDATE_BLOCK_COUNT < max_slot:
-            max_slot = last_block + UPDATE_BLOCK_COUNT
-        slots = self.client._provider.make_request("getBlocks", last_block, max_slot, {"commitment": "confirmed"})["result"]
 
-        pool = ThreadPool(PARALLEL_REQUESTS)
-        results = pool.map(self.get_block, slots)
-
-        for block_result in results:
-            (slot, block_hash) = block_result
-            self.blocks_by_hash[block_hash] = slot
+    def gather_blocks(self):
+        """Store the blockhashes of the slots after last_block, UPDATE_BLOCK_COUNT slots per cycle,
+        up to CATCHUP_BLOCK_COUNT while catching up. Blocks are fetched in JSON-RPC batches."""
+        max_slot = self.get_slot("recent")
 
+        last_block = self.constants['last_block']
+        self.blocks_lag = max(0, max_slot - last_block)
+        if self.blocks_lag > UPDATE_BLOCK_COUNT:
+            window = min(self.blocks_lag, max(UPDATE_BLOCK_COUNT, CATCHUP_BLOCK_COUNT))
+            logger.debug("Blocks lag {} slots, catch up {} slots".format(self.blocks_lag, window))
+            max_slot = last_block + window
+        missing_slot = self.store_blocks(last_block, max_slot)
+        if missing_slot is not None:
+            # the next cycle starts from the first block that could not be fetched
+            max_slot = missing_slot
         self.constants['last_block'] = max_slot
-
-
-    def get_block(self, slot):
-        retry = True
-
-        while retry:
-            try:
-                block = self.client._provider.make_request("getBlock", slot, {"commitment":"confirmed", "transactionDetails":"none", "rewards":False})['result']
-                block_hash = '0x' + base58.b58decode(block['blockhash']).hex()
-                retry = False
-            except Exception as err:
-                logger.debug(err)
-                time.sleep(1)
-
-        return (slot, block_hash)
+        self.last_block = max_slot
+        self.blocks_lag = max(0, self.blocks_lag - (max_slot - last_block))
+
+
+    def store_blocks(self, first_slot, last_slot):
+        """Store the blockhashes of the blocks in [first_slot, last_slot].
+        Returns the first slot whose block could not be fetched, None if all are stored."""
+        slots = self.client._provider.make_request("getBlocks", first_slot, last_slot, {"commitment": "confirmed"})["result"]
+
+        blocks = self.fetcher.fetch_blocks(slots)
+        self.store_block_hashes(blocks)
+
+        missing = [slot for slot in slots if slot not in blocks]
+        if len(missing):
+            logger.error("Could not get {} blocks, first one in slot {}".format(len(missing), missing[0]))
+            return missing[0]
+        return None
+
+
+    def report_lag(self):
+        receipts_lag = max(0, self.current_slot - self.processed_slot) if self.processed_slot else None
+        logger.info("Indexer lag: receipts {} slots, blocks {} slots".format(receipts_lag, self.blocks_lag))
+        if receipts_lag is not None:
+            metrics.set('lag_slots', receipts_lag, kind="receipts")
+        metrics.set('lag_slots', self.blocks_lag, kind="blocks")
+        metrics.set('slot', self.current_slot, kind="chain")
+        metrics.set('slot', self.processed_slot, kind="processed")
+        metrics.set('slot', self.last_block, kind="blocks")
+        metrics.set('queue_depth', len(self.transaction_order), queue="signatures")
+        metrics.set('queue_depth', len(self.awaited), queue="announced")
+        metrics.set('queue_depth', len(self.pending_trxs), queue="pending_trxs")
+        metrics.set('queue_depth', len(self.holders), queue="holders")
+        metrics.set('queue_depth', len(self.blocked_storages), queue="blocked_storages")
+        metrics.set('fetch_concurrency', round(self.fetcher.concurrency.limit, 1))
+        if time.monotonic() >= self.next_summary:
+            self.next_summary = time.monotonic() + METRICS_LOG_INTERVAL
+            logger.info("Indexer metrics: {}".format(metrics.summary()))
 
 
 def run_indexer():
     logging.basicConfig(format='%(asctime)s - pid:%(process)d [%(levelname)-.1s] %(funcName)s:%(lineno)d - %(message)s')
     logger.setLevel(logging.DEBUG)
+    start_metrics_server()
     indexer = Indexer()
-    indexer.run(False)
+    try:
+        indexer.run(False)
+    finally:
+        indexer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+"""Websocket subscriptions that wake the indexer up instead of polling.
+
+logsSubscribe (mentions the evm_loader) announces new transactions, slotSubscribe follows the tip.
+Notifications can be lost while the socket reconnects: they only trigger work, the signature polling
+of the indexer stays the source of truth and fills the gaps.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, urlunparse
+
+import aiohttp
+
+try:
+    from receipt_fetcher import backoff_delay
+except ImportError:
+    from .receipt_fetcher import backoff_delay
+
+LOGS_SUBSCRIPTION_ID = 1
+SLOT_SUBSCRIPTION_ID = 2
+# announced signatures kept until the indexer takes them
+MAX_ANNOUNCED = 100000
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def default_ws_url(url):
+    """Websocket endpoint of a solana RPC url: ws(s) scheme, RPC port + 1 (8899 -> 8900)."""
+    parsed = urlparse(url)
+    scheme = 'wss' if parsed.scheme == 'https' else 'ws'
+    netloc = parsed.netloc
+    if parsed.port is not None:
+        netloc = '{}:{}'.format(parsed.hostname, parsed.port + 1)
+    return urlunparse(parsed._replace(scheme=scheme, netloc=netloc))
+
+
+class SolanaSubscriber:
+    """Collects the announced transactions of program_id and the latest slot on its own event loop thread."""
+
+    def __init__(self, ws_url, program_id, commitment="confirmed"):
+        self.ws_url = ws_url
+        self.program_id = program_id
+        self.commitment = commitment
+        self.condition = threading.Condition()
+        # signature -> True if the transaction failed
+        self.announced = OrderedDict()
+        self.slot = 0
+        self.connected = False
+        self.reconnected = False
+        self.loop = None
+        self.thread = None
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="solana-subscriber", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.listen(), self.loop)
+
+    def wait(self, timeout, slot_target=None):
+        """Block until transactions are announced, the slot reaches slot_target, the subscription is
+        (re)established or timeout seconds pass. Returns the announced {signature: failed} and forgets them."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not (len(self.announced) or self.reconnected or
+                       (slot_target is not None and self.slot >= slot_target)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.connected:
+                    break
+                self.condition.wait(remaining)
+            announced = self.announced
+            self.announced = OrderedDict()
+            self.reconnected = False
+            return announced
+
+    def set_connected(self, connected):
+        with self.condition:
+            if connected and not self.connected:
+                # notifications may have been lost, the indexer has to poll
+                self.reconnected = True
+            self.connected = connected
+            self.condition.notify_all()
+
+    def on_message(self, message):
+        method = message.get('method')
+        if method == 'logsNotification':
+            result = message['params']['result']
+            value = result['value']
+            with self.condition:
+                self.announced[value['signature']] = value.get('err') is not None
+                while len(self.announced) > MAX_ANNOUNCED:
+                    self.announced.popitem(last=False)
+                self.slot = max(self.slot, result['context']['slot'])
+                self.condition.notify_all()
+        elif method == 'slotNotification':
+            with self.condition:
+                self.slot = max(self.slot, message['params']['result']['slot'])
+                self.condition.notify_all()
+        elif message.get('id') == LOGS_SUBSCRIPTION_ID:
+            if 'error' in message:
+                raise ValueError(message['error'])
+            logger.debug("Subscribed to logs of %s", self.program_id)
+            self.set_connected(True)
+
+    async def listen(self):
+        attempt = 0
+        while True:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(self.ws_url, heartbeat=30) as ws:
+                        await ws.send_json({"jsonrpc": "2.0", "id": LOGS_SUBSCRIPTION_ID, "method": "logsSubscribe",
+                                            "params": [{"mentions": [self.program_id]},
+                                                       {"commitment": self.commitment}]})
+                        await ws.send_json({"jsonrpc": "2.0", "id": SLOT_SUBSCRIPTION_ID, "method": "slotSubscribe"})
+                        async for msg in ws:
+                            if msg.type != aiohttp.WSMsgType.TEXT:
+                                break
+                            self.on_message(json.loads(msg.data))
+                            attempt = 0
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as err:
+                logger.debug("Subscription to %s failed: %s", self.ws_url, err)
+            self.set_connected(False)
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
@@ -0,0 +1,341 @@
+"""Storage backends of SQLDict, LogDB and SQLCost.
+
+DB_BACKEND=postgres (default) uses a per-process pool of connections to the POSTGRES_* server,
+DB_BACKEND=sqlite keeps everything in the SQLITE_PATH file (WAL mode), without a DB server.
+
+Queries are written once, in the postgres dialect with %s placeholders; a backend rewrites
+what its engine does not understand and provides the bulk operations (in_list, upsert_many, iterate).
+"""
+import io
+import os
+import logging
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+DB_BACKEND = os.environ.get("DB_BACKEND", "postgres")
+
+POSTGRES_DB = os.environ.get("POSTGRES_DB", "neon-db")
+POSTGRES_USER = os.environ.get("POSTGRES_USER", "neon-proxy")
+POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD", "neon-proxy-pass")
+POSTGRES_HOST = os.environ.get("POSTGRES_HOST", "localhost")
+POSTGRES_POOL_MIN = int(os.environ.get("POSTGRES_POOL_MIN", "1"))
+POSTGRES_POOL_MAX = int(os.environ.get("POSTGRES_POOL_MAX", "8"))
+
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "neon-proxy.sqlite")
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", "30"))
+
+# upsert_many switches from multi-row INSERT to COPY through a temp table above this row count
+SQL_COPY_THRESHOLD = int(os.environ.get("SQL_COPY_THRESHOLD", "1000"))
+SQL_PAGE_SIZE = 1000
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def copy_text(value):
+    """One column of a COPY ... FROM STDIN text-format row."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def numbered_placeholders(query):
+    """%s, %s ... -> $1, $2 ... for PREPARE"""
+    counter = iter(range(1, query.count('%s') + 1))
+    return re.sub('%s', lambda _: '${}'.format(next(counter)), query)
+
+
+if psycopg2 is not None:
+    class PreparedConnection(psycopg2.extensions.connection):
+        """Remembers which statements are already prepared in its server session."""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
+
+        def execute_prepared(self, name, statement, params):
+            """PREPARE the statement once per session, then EXECUTE it."""
+            cur = self.cursor()
+            if name not in self.prepared:
+                cur.execute('PREPARE {} AS {}'.format(name, numbered_placeholders(statement)))
+                self.prepared.add(name)
+            cur.execute('EXECUTE {} ({})'.format(name, ','.join(['%s'] * len(params))), params)
+            return cur
+
+
+class ConnectionPool:
+    """Bounded pool of autocommit connections shared by all threads of a process.
+
+    Callers block while all maxconn connections are busy. Dead connections are replaced on checkout,
+    connections broken during a query are dropped instead of being returned to the pool.
+    A query whose connection is lost is repeated only if it is safe to run twice (retry=True): the server
+    may have applied it before the connection dropped."""
+
+    def __init__(self, minconn=POSTGRES_POOL_MIN, maxconn=POSTGRES_POOL_MAX):
+        self.pid = os.getpid()
+        self.semaphore = threading.BoundedSemaphore(maxconn)
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn,
+            dbname=POSTGRES_DB,
+            user=POSTGRES_USER,
+            password=POSTGRES_PASSWORD,
+            host=POSTGRES_HOST,
+            connection_factory=PreparedConnection
+        )
+
+    @staticmethod
+    def is_alive(conn):
+        return not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+
+    def getconn(self):
+        conn = self.pool.getconn()
+        if not self.is_alive(conn):
+            logger.warning("Replace broken postgres connection")
+            self.pool.putconn(conn, close=True)
+            conn = self.pool.getconn()
+        if not conn.autocommit:
+            conn.autocommit = True
+        return conn
+
+    def getconn_retry(self):
+        """getconn, once more if the connection fails: nothing is sent yet"""
+        try:
+            return self.getconn()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+            logger.warning("Postgres connection failed, reconnect: %s", err)
+        return self.getconn()
+
+    @contextmanager
+    def connection(self):
+        with self.semaphore:
+            conn = self.getconn_retry()
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.pool.putconn(conn, close=True)
+                raise
+            except Exception:
+                self.pool.putconn(conn, close=not self.is_alive(conn))
+                raise
+            else:
+                self.pool.putconn(conn)
+
+    def run(self, query_func, retry=False):
+        """Call query_func(conn) and return its result.
+        With retry, once more on a fresh connection if the connection is lost during the query."""
+        try:
+            with self.connection() as conn:
+                return query_func(conn)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+            if not retry:
+                raise
+            logger.warning("Postgres connection lost, reconnect: %s", err)
+        with self.connection() as conn:
+            return query_func(conn)
+
+
+class PostgresBackend:
+    name = 'postgres'
+    # row lock clause for work queue style claims
+    skip_locked = 'FOR UPDATE SKIP LOCKED'
+
+    def __init__(self):
+        if psycopg2 is None:
+            raise RuntimeError("DB_BACKEND=postgres needs psycopg2")
+        self.pid = os.getpid()
+        self.pool = ConnectionPool()
+
+    def column_type(self, sql_type):
+        return sql_type
+
+    def execute(self, query, params=None):
+        """Run a statement, return the number of affected rows."""
+        def execute(conn):
+            cur = conn.cursor()
+            cur.execute(query, params)
+            return cur.rowcount
+        return self.pool.run(execute)
+
+    def fetchall(self, query, params=None, retry=True):
+        """Rows of a query, retry=False for a statement that writes (UPDATE ... RETURNING)"""
+        def fetchall(conn):
+            cur = conn.cursor()
+            cur.execute(query, params)
+            return cur.fetchall()
+        return self.pool.run(fetchall, retry=retry)
+
+    def execute_prepared(self, name, query, params):
+        self.pool.run(lambda conn: conn.execute_prepared(name, query, params))
+
+    def fetchone_prepared(self, name, query, params):
+        return self.pool.run(lambda conn: conn.execute_prepared(name, query, params).fetchone(), retry=True)
+
+    def in_list(self, values):
+        """(sql, params) of a `column <sql>` membership test."""
+        return '= ANY(%s)', (list(values),)
+
+    def upsert_many(self, tablename, column_names, rows, conflict):
+        """INSERT rows (tuples of key + columns) with an ON CONFLICT clause, which makes it safe to repeat."""
+        if len(rows) > SQL_COPY_THRESHOLD:
+            self.pool.run(lambda conn: self._copy_rows(conn, tablename, column_names, rows, conflict), retry=True)
+        else:
+            self.pool.run(lambda conn: psycopg2.extras.execute_values(
+                conn.cursor(),
+                'INSERT INTO {} ({}) VALUES %s '.format(tablename, column_names) + conflict,
+                rows, page_size=SQL_PAGE_SIZE), retry=True)
+
+    def _copy_rows(self, conn, tablename, column_names, rows, conflict):
+        data = io.StringIO()
+        for row in rows:
+            data.write('\t'.join(copy_text(value) for value in row))
+            data.write('\n')
+        data.seek(0)
+
+        copy_table = '{}_copy'.format(tablename)
+        cur = conn.cursor()
+        cur.execute('BEGIN')
+        try:
+            cur.execute('CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP'.format(copy_table, tablename))
+            cur.copy_expert('COPY {} ({}) FROM STDIN'.format(copy_table, column_names), data)
+            cur.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2} '.format(tablename, column_names, copy_table) +
+                        conflict)
+            cur.execute('COMMIT')
+        except Exception:
+            cur.execute('ROLLBACK')
+            raise
+
+    def notify(self, channel, payload):
+        self.execute('SELECT pg_notify(%s, %s)', (channel, payload))
+
+    def listen(self, channel):
+        """A dedicated (unpooled) autocommit connection LISTENing to channel, poll it for conn.notifies."""
+        conn = psycopg2.connect(dbname=POSTGRES_DB, user=POSTGRES_USER,
+                                password=POSTGRES_PASSWORD, host=POSTGRES_HOST)
+        conn.autocommit = True
+        conn.cursor().execute('LISTEN {}'.format(channel))
+        return conn
+
+    def iterate(self, query, params=None, batch_size=SQL_PAGE_SIZE):
+        """Stream the rows of a large result through a server-side cursor."""
+        with self.pool.connection() as conn:
+            cur = conn.cursor(name='iterate_{}'.format(threading.get_ident()), withhold=True)
+            cur.itersize = batch_size
+            try:
+                cur.execute(query, params)
+                for row in cur:
+                    yield row
+            finally:
+                cur.close()
+
+
+class SQLiteBackend:
+    """One connection per thread to a WAL-mode database file, shared safely between processes."""
+    name = 'sqlite'
+    # writers are serialized by the database lock
+    skip_locked = ''
+
+    COLUMN_TYPES = {
+        'BYTEA': 'BLOB',
+    }
+
+    def __init__(self, path=SQLITE_PATH):
+        self.pid = os.getpid()
+        self.path = path
+        self.local = threading.local()
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def dialect(query):
+        return query.replace('%s', '?')
+
+    def column_type(self, sql_type):
+        return self.COLUMN_TYPES.get(sql_type, sql_type)
+
+    def execute(self, query, params=None):
+        return self.connection().execute(self.dialect(query), params or ()).rowcount
+
+    def fetchall(self, query, params=None, retry=True):
+        return self.connection().execute(self.dialect(query), params or ()).fetchall()
+
+    def execute_prepared(self, name, query, params):
+        # sqlite3 keeps its own per-connection statement cache
+        self.execute(query, params)
+
+    def fetchone_prepared(self, name, query, params):
+        return self.connection().execute(self.dialect(query), params).fetchone()
+
+    def in_list(self, values):
+        values = tuple(values)
+        return 'IN ({})'.format(','.join(['?'] * len(values))), values
+
+    def upsert_many(self, tablename, column_names, rows, conflict):
+        if len(rows) == 0:
+            return
+        conn = self.connection()
+        query = 'INSERT INTO {} ({}) VALUES ({}) '.format(tablename, column_names, ','.join(['?'] * len(rows[0])))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(query + conflict, rows)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def notify(self, channel, payload):
+        # no NOTIFY in sqlite, readers see the changes in the tables only
+        pass
+
+    def iterate(self, query, params=None, batch_size=SQL_PAGE_SIZE):
+        cur = self.connection().execute(self.dialect(query), params or ())
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+
+BACKENDS = {
+    PostgresBackend.name: PostgresBackend,
+    SQLiteBackend.name: SQLiteBackend,
+}
+
+backend_instance = None
+backend_lock = threading.Lock()
+
+
+def get_backend():
+    """The DB_BACKEND backend of the current process, a forked child gets a new one
+    instead of sharing the parent's sockets/file handles."""
+    global backend_instance
+    backend = backend_instance
+    if backend is not None and backend.pid == os.getpid():
+        return backend
+    with backend_lock:
+        if backend_instance is None or backend_instance.pid != os.getpid():
+            if DB_BACKEND not in BACKENDS:
+                raise RuntimeError("Unknown DB_BACKEND {}, expected one of {}".format(DB_BACKEND, list(BACKENDS)))
+            backend_instance = BACKENDS[DB_BACKEND]()
+        return backend_instance
@@ -1,12 +1,17 @@
-import psycopg2
 import os
 import logging
+import threading
+import time
+from collections import OrderedDict
 from collections.abc import MutableMapping
 
-POSTGRES_DB = os.environ.get("POSTGRES_DB", "neon-db")
-POSTGRES_USER = os.environ.get("POSTGRES_USER", "neon-proxy")
-POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD", "neon-proxy-pass")
-POSTGRES_HOST = os.environ.get("POSTGRES_HOST", "localhost")
+try:
+    from sql_backend import get_backend, SQL_PAGE_SIZE
+except ImportError:
+    from .sql_backend import get_backend, SQL_PAGE_SIZE
+
+# how long CachedSQLDict remembers that a key is not in the table yet
+SQL_CACHE_NEGATIVE_TTL = float(os.environ.get("SQL_CACHE_NEGATIVE_TTL", "0.5"))
 
 try:
     from cPickle import dumps, loads, HIGHEST_PROTOCOL as PICKLE_PROTOCOL
@@ -20,7 +25,7 @@ logger.setLevel(logging.DEBUG)
 
 def encode(obj):
     """Serialize an object using pickle to a binary format accepted by SQLite."""
-    return psycopg2.Binary(dumps(obj, protocol=PICKLE_PROTOCOL))
+    return dumps(obj, protocol=PICKLE_PROTOCOL)
 
 
 def decode(obj):
@@ -29,58 +34,90 @@ def decode(obj):
 
 
 class SQLDict(MutableMapping):
-    """Serialize an object using pickle to a binary format accepted by SQLite."""
+    """Serialize an object using pickle to a binary format accepted by SQLite.
 
-    def __init__(self, tablename='table'):
+    Subclasses can store values in typed columns instead: KEY_TYPE and COLUMNS describe the table,
+    encode_key/decode_key convert keys and encode_value/decode_value convert a value to/from a row of COLUMNS."""
+
+    KEY_TYPE = 'TEXT'
+    COLUMNS = (('value', 'BYTEA'),)
+    INDEXES = ()
+
+    def __init__(self, tablename='table', backend=None):
         self.encode = encode
         self.decode = decode
         self.tablename = tablename
-        self.conn = psycopg2.connect(
-            dbname=POSTGRES_DB,
-            user=POSTGRES_USER,
-            password=POSTGRES_PASSWORD,
-            host=POSTGRES_HOST
-        )
-        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        cur = self.conn.cursor()
-        cur.execute('''
+        self.column_names = ', '.join(name for name, _ in self.COLUMNS)
+        self.backend = backend if backend is not None else get_backend()
+
+        self.backend.execute('''
                 CREATE TABLE IF NOT EXISTS
                 {} (
-                    key TEXT UNIQUE,
-                    value BYTEA
+                    key {} UNIQUE,
+                    {}
                 )
-            '''.format(self.tablename)
+            '''.format(self.tablename, self.backend.column_type(self.KEY_TYPE),
+                       ', '.join(name + ' ' + self.backend.column_type(type) for name, type in self.COLUMNS))
         )
+        for column in self.INDEXES:
+            self.backend.execute('CREATE INDEX IF NOT EXISTS {0}_{1}_idx ON {0} ({1})'.format(self.tablename, column))
+
+        # hot-path statements, prepared once per pooled connection
+        self.get_statement = ('{}_get'.format(self.tablename),
+                              'SELECT {} FROM {} WHERE key = %s'.format(self.column_names, self.tablename))
+        self.contains_statement = ('{}_contains'.format(self.tablename),
+                                   'SELECT 1 FROM {} WHERE key = %s'.format(self.tablename))
+        self.upsert_tail = '''
+                ON CONFLICT (key)
+                DO UPDATE SET
+                {}
+            '''.format(', '.join('{0} = EXCLUDED.{0}'.format(name) for name, _ in self.COLUMNS))
+        self.set_statement = ('{}_set'.format(self.tablename), '''
+                INSERT INTO {} (key, {})
+                VALUES ({})
+            '''.format(self.tablename, self.column_names, ','.join(['%s'] * (len(self.COLUMNS) + 1))) +
+            self.upsert_tail)
+
+    def encode_key(self, key):
+        return key
+
+    def decode_key(self, key):
+        return key
+
+    def encode_value(self, value):
+        return (self.encode(value),)
+
+    def decode_value(self, row):
+        return self.decode(row[0])
+
+    def _key(self, key):
+        try:
+            return self.encode_key(key)
+        except (ValueError, TypeError):
+            raise KeyError(key)
 
     def close(self):
-        self.conn.close()
+        """Connections belong to the process backend, nothing to release per table."""
+        pass
 
     def __len__(self):
-        cur = self.conn.cursor()
-        cur.execute('SELECT COUNT(*) FROM {}'.format(self.tablename))
-        rows = cur.fetchone()[0]
+        rows = self.backend.fetchall('SELECT COUNT(*) FROM {}'.format(self.tablename))[0][0]
         return rows if rows is not None else 0
 
     def iterkeys(self):
-        cur = self.conn.cursor()
-        cur.execute('SELECT key FROM {}'.format(self.tablename))
-        rows = cur.fetchall()
+        rows = self.backend.fetchall('SELECT key FROM {}'.format(self.tablename))
         for row in rows:
-            yield row[0]
+            yield self.decode_key(row[0])
 
     def itervalues(self):
-        cur = self.conn.cursor()
-        cur.execute('SELECT value FROM {}'.format(self.tablename))
-        rows = cur.fetchall()
-        for value in rows:
-            yield self.decode(value[0])
+        rows = self.backend.fetchall('SELECT {} FROM {}'.format(self.column_names, self.tablename))
+        for row in rows:
+            yield self.decode_value(row)
 
     def iteritems(self):
-        cur = self.conn.cursor()
-        cur.execute('SELECT key, value FROM {}'.format(self.tablename))
-        rows = cur.fetchall()
+        rows = self.backend.fetchall('SELECT key, {} FROM {}'.format(self.column_names, self.tablename))
         for row in rows:
-            yield row[0], self.decode(row[1])
+            yield self.decode_key(row[0]), self.decode_value(row[1:])
 
     def keys(self):
         return list(self.iterkeys())
@@ -92,35 +129,228 @@ class SQLDict(MutableMapping):
         return list(self.iteritems())
 
     def __contains__(self, key):
-        cur = self.conn.cursor()
-        cur.execute('SELECT 1 FROM {} WHERE key = %s'.format(self.tablename), (key,))
-        return cur.fetchone() is not None
+        try:
+            db_key = self._key(key)
+        except KeyError:
+            return False
+        (name, query) = self.contains_statement
+        return self.backend.fetchone_prepared(name, query, (db_key,)) is not None
 
     def __getitem__(self, key):
-        cur = self.conn.cursor()
-        cur.execute('SELECT value FROM {} WHERE key = %s'.format(self.tablename), (key,))
-        item = cur.fetchone()
+        (name, query) = self.get_statement
+        item = self.backend.fetchone_prepared(name, query, (self._key(key),))
         if item is None:
             raise KeyError(key)
-        return self.decode(item[0])
+        return self.decode_value(item)
 
     def __setitem__(self, key, value):
-        cur = self.conn.cursor()
-        cur.execute('''
-                INSERT INTO {} (key, value)
-                VALUES (%s,%s)
-                ON CONFLICT (key)
-                DO UPDATE SET
-                value = EXCLUDED.value
-            '''.format(self.tablename),
-            (key, self.encode(value))
-        )
+        (name, query) = self.set_statement
+        self.backend.execute_prepared(name, query, (self.encode_key(key),) + tuple(self.encode_value(value)))
 
     def __delitem__(self, key):
-        cur = self.conn.cursor()
-        if key not in self:
+        rowcount = self.backend.execute('DELETE FROM {} WHERE key = %s'.format(self.tablename), (self._key(key),))
+        if rowcount == 0:
             raise KeyError(key)
-        cur.execute('DELETE FROM {} WHERE key = %s'.format(self.tablename), (key,))
 
     def __iter__(self):
         return self.iterkeys()
+
+    def _encode_keys(self, keys):
+        db_keys = []
+        for key in keys:
+            try:
+                db_keys.append(self.encode_key(key))
+            except (ValueError, TypeError):
+                pass
+        return db_keys
+
+    def _select_many(self, columns, keys):
+        db_keys = self._encode_keys(keys)
+        rows = []
+        for pos in range(0, len(db_keys), SQL_PAGE_SIZE):
+            (in_sql, params) = self.backend.in_list(db_keys[pos:pos + SQL_PAGE_SIZE])
+            rows += self.backend.fetchall('SELECT {} FROM {} WHERE key {}'.format(columns, self.tablename, in_sql),
+                                          params)
+        return rows
+
+    def get_many(self, keys):
+        """One query per SQL_PAGE_SIZE keys, returns {key: value} for the found keys; keys are in decoded form."""
+        rows = self._select_many('key, ' + self.column_names, keys)
+        return {self.decode_key(row[0]): self.decode_value(row[1:]) for row in rows}
+
+    def contains_many(self, keys):
+        """Set of the given keys that are stored, in decoded form."""
+        return set(self.decode_key(row[0]) for row in self._select_many('key', keys))
+
+    def set_many(self, items):
+        """Upsert a mapping or an iterable of (key, value) pairs in bulk."""
+        items = dict(items)
+        if len(items) == 0:
+            return
+        rows = [(self.encode_key(key),) + tuple(self.encode_value(value)) for key, value in items.items()]
+        self.backend.upsert_many(self.tablename, 'key, ' + self.column_names, rows, self.upsert_tail)
+
+
+class CachedSQLDict(MutableMapping):
+    """Bounded read-through LRU cache in front of a write-once SQLDict.
+
+    Only for tables whose values never change once written: entries are not expired, local writes
+    update the cache, writes from other processes are seen as soon as a key is not cached.
+    Misses are remembered for negative_ttl seconds so polling for a not yet indexed key stays cheap.
+    Cached values are shared between callers and must not be modified.
+    A table that is rewritten needs its keys invalidated on change, as the proxy does from the change feed.
+    A read that raced an invalidation of its key does not fill the cache: it may have seen the old row."""
+
+    def __init__(self, sql_dict, max_size, negative_ttl=SQL_CACHE_NEGATIVE_TTL):
+        self.sql_dict = sql_dict
+        self.tablename = sql_dict.tablename
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.missing = OrderedDict()
+        # counts invalidations; key -> generation of its last invalidation, for the max_size latest keys
+        self.generation = 0
+        self.invalidated = OrderedDict()
+        # the keys not in invalidated were invalidated at this generation or before
+        self.forgotten_generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def _lookup(self, key):
+        """(found, value) from the cache, found is None if the table has to be asked:
+        value is then the generation to fill the cache with"""
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return True, self.cache[key]
+            expire = self.missing.get(key)
+            if expire is not None:
+                if expire > time.monotonic():
+                    self.negative_hits += 1
+                    return False, None
+                del self.missing[key]
+            self.misses += 1
+            return None, self.generation
+
+    def _invalidated_since(self, key, generation):
+        return generation is not None and self.invalidated.get(key, self.forgotten_generation) > generation
+
+    def _put(self, key, value, generation=None):
+        """Cache a value read at generation, None for a value written by this process"""
+        with self.lock:
+            if self._invalidated_since(key, generation):
+                return
+            self.missing.pop(key, None)
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def _put_missing(self, key, generation):
+        if self.negative_ttl <= 0:
+            return
+        with self.lock:
+            if self._invalidated_since(key, generation):
+                return
+            self.missing[key] = time.monotonic() + self.negative_ttl
+            self.missing.move_to_end(key)
+            while len(self.missing) > self.max_size:
+                self.missing.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Forget one key, or everything if key is None."""
+        with self.lock:
+            self.generation += 1
+            if key is None:
+                self.cache.clear()
+                self.missing.clear()
+                self.invalidated.clear()
+                self.forgotten_generation = self.generation
+            else:
+                self.cache.pop(key, None)
+                self.missing.pop(key, None)
+                self.invalidated[key] = self.generation
+                self.invalidated.move_to_end(key)
+                while len(self.invalidated) > self.max_size:
+                    (_, self.forgotten_generation) = self.invalidated.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.cache),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'negative_hits': self.negative_hits,
+            }
+
+    def __getitem__(self, key):
+        (found, value) = self._lookup(key)
+        if found:
+            return value
+        if found is not None:
+            raise KeyError(key)
+        generation = value
+        try:
+            value = self.sql_dict[key]
+        except KeyError:
+            self._put_missing(key, generation)
+            raise
+        self._put(key, value, generation)
+        return value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, key, value):
+        self.sql_dict[key] = value
+        self._put(key, value)
+
+    def __delitem__(self, key):
+        self.invalidate(key)
+        del self.sql_dict[key]
+
+    def __len__(self):
+        return len(self.sql_dict)
+
+    def __iter__(self):
+        return iter(self.sql_dict)
+
+    def get_many(self, keys):
+        result = {}
+        query_keys = []
+        generation = None
+        for key in keys:
+            (found, value) = self._lookup(key)
+            if found:
+                result[key] = value
+            elif found is None:
+                query_keys.append(key)
+                # the oldest generation of the batch, the query starts after every lookup
+                generation = value if generation is None else min(generation, value)
+        if len(query_keys):
+            found_items = self.sql_dict.get_many(query_keys)
+            for key in query_keys:
+                if key in found_items:
+                    value = found_items[key]
+                    self._put(key, value, generation)
+                    result[key] = value
+                else:
+                    self._put_missing(key, generation)
+        return result
+
+    def contains_many(self, keys):
+        return set(self.get_many(keys))
+
+    def set_many(self, items):
+        items = dict(items)
+        self.sql_dict.set_many(items)
+        for key, value in items.items():
+            self._put(key, value)
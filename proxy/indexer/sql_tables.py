@@ -0,0 +1,406 @@
+import base58
+import json
+import rlp
+import time
+import zlib
+
+try:
+    from sql_backend import SQL_PAGE_SIZE
+    from sql_dict import SQLDict
+except ImportError:
+    from .sql_backend import SQL_PAGE_SIZE
+    from .sql_dict import SQLDict
+
+
+def hex_to_bytes(value):
+    if value.startswith('0x'):
+        value = value[2:]
+    return bytes.fromhex(value)
+
+
+def bytes_to_hex(value):
+    return '0x' + bytes(value).hex()
+
+
+def encode_hash(key):
+    """'0x' + 64 hex digits -> 32 bytes"""
+    data = hex_to_bytes(key.lower())
+    if len(data) != 32:
+        raise ValueError("Wrong hash length {}".format(key))
+    return data
+
+
+def decode_hash(key):
+    return bytes_to_hex(key)
+
+
+def encode_signature(key):
+    """base58 solana signature -> 64 bytes"""
+    data = base58.b58decode(key)
+    if len(data) != 64:
+        raise ValueError("Wrong signature length {}".format(key))
+    return data
+
+
+def decode_signature(key):
+    return base58.b58encode(bytes(key)).decode('utf-8')
+
+
+def encode_logs(logs):
+    """Pack a list of receipt logs as RLP: hex strings become bytes, hex quantities become integers."""
+    return rlp.encode([
+        [
+            hex_to_bytes(log['address']),
+            [hex_to_bytes(topic) for topic in log['topics']],
+            hex_to_bytes(log['data']),
+            int(log['transactionLogIndex'], 16),
+            int(log['transactionIndex'], 16),
+            int(log['blockNumber'], 16),
+            int(log['logIndex'], 16),
+            hex_to_bytes(log.get('transactionHash', '')),
+            hex_to_bytes(log.get('blockHash', '')),
+        ]
+        for log in logs
+    ])
+
+
+def decode_logs(data):
+    logs = []
+    for item in rlp.decode(bytes(data)):
+        (address, topics, log_data, trx_log_index, trx_index, block_number, log_index, trx_hash, block_hash) = item
+        log = {
+            'address': bytes_to_hex(address),
+            'topics': [bytes_to_hex(topic) for topic in topics],
+            'data': bytes_to_hex(log_data),
+            'transactionLogIndex': hex(rlp.sedes.big_endian_int.deserialize(trx_log_index)),
+            'transactionIndex': hex(rlp.sedes.big_endian_int.deserialize(trx_index)),
+            'blockNumber': hex(rlp.sedes.big_endian_int.deserialize(block_number)),
+            'logIndex': hex(rlp.sedes.big_endian_int.deserialize(log_index)),
+        }
+        if len(trx_hash):
+            log['transactionHash'] = bytes_to_hex(trx_hash)
+        if len(block_hash):
+            log['blockHash'] = bytes_to_hex(block_hash)
+        logs.append(log)
+    return logs
+
+
+RECEIPT_FORMAT_VERSION = 1
+ARCHIVED_ERROR = 'archived error'
+
+
+def encode_receipt(trx, program_id):
+    """Keep only what the indexer reads from a getConfirmedTransaction result, as zlib(RLP):
+    [version, account keys, instructions, inner instructions].
+
+    Every outer instruction keeps its position and program, but only program_id instructions keep accounts
+    and data; inner instructions are kept only for program_id events of program_id instructions.
+    Account keys are reindexed to the referenced ones. Failed transactions keep no instructions at all."""
+    message = trx['transaction']['message']
+    keys = message['accountKeys']
+    meta = trx.get('meta') or {}
+    failed = meta.get('err') is not None
+
+    used = {}
+
+    def key_index(idx):
+        if idx not in used:
+            used[idx] = len(used)
+        return used[idx]
+
+    instructions = []
+    inner_list = []
+    if not failed:
+        program_instructions = set()
+        for pos, instruction in enumerate(message['instructions'] or []):
+            program_idx = instruction['programIdIndex']
+            if keys[program_idx] == program_id:
+                program_instructions.add(pos)
+                accounts = bytes(key_index(idx) for idx in instruction['accounts'])
+                data = base58.b58decode(instruction['data'])
+            else:
+                accounts = b''
+                data = b''
+            instructions.append([key_index(program_idx), accounts, data])
+
+        for inner in meta.get('innerInstructions') or []:
+            if inner['index'] not in program_instructions:
+                continue
+            events = [[key_index(event['programIdIndex']), base58.b58decode(event['data'])]
+                      for event in inner['instructions'] if keys[event['programIdIndex']] == program_id]
+            if len(events):
+                inner_list.append([inner['index'], events])
+
+    account_keys = [base58.b58decode(keys[idx]) for idx, _ in sorted(used.items(), key=lambda item: item[1])]
+    return zlib.compress(rlp.encode([RECEIPT_FORMAT_VERSION, account_keys, instructions, inner_list]))
+
+
+def decode_receipt(data, slot, failed):
+    """Rebuild the getConfirmedTransaction-shaped dict consumed by process_receipts/get_trx_results."""
+    (version, account_keys, instructions, inner_list) = rlp.decode(zlib.decompress(bytes(data)))
+    if rlp.sedes.big_endian_int.deserialize(version) != RECEIPT_FORMAT_VERSION:
+        raise ValueError("Unknown receipt format {}".format(version))
+
+    to_int = rlp.sedes.big_endian_int.deserialize
+    return {
+        'slot': slot,
+        'transaction': {
+            'message': {
+                'accountKeys': [base58.b58encode(key).decode('utf-8') for key in account_keys],
+                'instructions': [
+                    {
+                        'programIdIndex': to_int(program_idx),
+                        'accounts': list(accounts),
+                        'data': base58.b58encode(instruction_data).decode('utf-8'),
+                    }
+                    for (program_idx, accounts, instruction_data) in instructions
+                ],
+            },
+        },
+        'meta': {
+            'err': ARCHIVED_ERROR if failed else None,
+            'innerInstructions': [
+                {
+                    'index': to_int(index),
+                    'instructions': [
+                        {
+                            'programIdIndex': to_int(program_idx),
+                            'accounts': [],
+                            'data': base58.b58encode(event_data).decode('utf-8'),
+                        }
+                        for (program_idx, event_data) in events
+                    ],
+                }
+                for (index, events) in inner_list
+            ],
+        },
+    }
+
+
+class EthereumTransactionsDict(SQLDict):
+    """eth trx hash -> {'eth_trx', 'slot', 'logs', 'status', 'gas_used', 'return_value', 'from_address'}"""
+
+    KEY_TYPE = 'BYTEA'
+    COLUMNS = (
+        ('eth_trx', 'BYTEA'),
+        ('slot', 'BIGINT'),
+        ('status', 'SMALLINT'),
+        ('gas_used', 'BIGINT'),
+        ('from_address', 'BYTEA'),
+        ('return_value', 'BYTEA'),
+        ('logs', 'BYTEA'),
+    )
+    INDEXES = ('slot', 'from_address')
+
+    def __init__(self, tablename='eth_transactions', backend=None):
+        SQLDict.__init__(self, tablename, backend)
+
+    def encode_key(self, key):
+        return encode_hash(key)
+
+    def decode_key(self, key):
+        return decode_hash(key)
+
+    def encode_value(self, value):
+        return_value = value['return_value']
+        status = value['status']
+        return (
+            hex_to_bytes(value['eth_trx']),
+            value['slot'],
+            int(status, 16) if isinstance(status, str) else int(status),
+            value['gas_used'],
+            hex_to_bytes(value['from_address']),
+            hex_to_bytes(return_value) if isinstance(return_value, str) else None,
+            encode_logs(value['logs']),
+        )
+
+    def decode_value(self, row):
+        (eth_trx, slot, status, gas_used, from_address, return_value, logs) = row
+        return {
+            'eth_trx': bytes(eth_trx).hex(),
+            'slot': slot,
+            'logs': decode_logs(logs),
+            'status': hex(status),
+            'gas_used': gas_used,
+            'return_value': bytes(return_value).hex() if return_value is not None else None,
+            'from_address': bytes_to_hex(from_address),
+        }
+
+
+class SolanaEthereumTransactionsDict(SQLDict):
+    """solana signature -> {'idx': position in the eth transaction, 'eth': eth trx hash}"""
+
+    KEY_TYPE = 'BYTEA'
+    COLUMNS = (
+        ('idx', 'INT'),
+        ('eth', 'BYTEA'),
+    )
+    INDEXES = ('eth',)
+
+    def __init__(self, tablename='sol_eth_transactions', backend=None):
+        SQLDict.__init__(self, tablename, backend)
+
+    def encode_key(self, key):
+        return encode_signature(key)
+
+    def decode_key(self, key):
+        return decode_signature(key)
+
+    def encode_value(self, value):
+        return (value['idx'], encode_hash(value['eth']))
+
+    def decode_value(self, row):
+        (idx, eth) = row
+        return {'idx': idx, 'eth': decode_hash(eth)}
+
+
+class EthereumSolanaTransactionsDict(SQLDict):
+    """eth trx hash -> list of solana signatures, stored as concatenated 64-byte signatures"""
+
+    KEY_TYPE = 'BYTEA'
+    COLUMNS = (
+        ('signatures', 'BYTEA'),
+    )
+
+    def __init__(self, tablename='eth_sol_transactions', backend=None):
+        SQLDict.__init__(self, tablename, backend)
+
+    def encode_key(self, key):
+        return encode_hash(key)
+
+    def decode_key(self, key):
+        return decode_hash(key)
+
+    def encode_value(self, value):
+        return (b''.join(base58.b58decode(signature) for signature in value),)
+
+    def decode_value(self, row):
+        data = bytes(row[0])
+        return [decode_signature(data[pos:pos + 64]) for pos in range(0, len(data), 64)]
+
+
+class BlocksByHashDict(SQLDict):
+    """block hash -> slot"""
+
+    KEY_TYPE = 'BYTEA'
+    COLUMNS = (
+        ('slot', 'BIGINT'),
+    )
+    INDEXES = ('slot',)
+
+    def __init__(self, tablename='solana_blocks', backend=None):
+        SQLDict.__init__(self, tablename, backend)
+
+    def encode_key(self, key):
+        return encode_hash(key)
+
+    def decode_key(self, key):
+        return decode_hash(key)
+
+    def encode_value(self, value):
+        return (value,)
+
+    def decode_value(self, row):
+        return row[0]
+
+    def hashes_of(self, slots):
+        """{slot: block hash} of the stored blocks among `slots`"""
+        slots = list(slots)
+        hashes = {}
+        for pos in range(0, len(slots), SQL_PAGE_SIZE):
+            (in_sql, params) = self.backend.in_list(slots[pos:pos + SQL_PAGE_SIZE])
+            rows = self.backend.fetchall('SELECT key, slot FROM {} WHERE slot {}'.format(self.tablename, in_sql), params)
+            hashes.update((slot, self.decode_key(key)) for (key, slot) in rows)
+        return hashes
+
+
+class ReceiptArchiveDict(SQLDict):
+    """solana signature -> compacted getConfirmedTransaction result of a program_id transaction"""
+
+    KEY_TYPE = 'BYTEA'
+    COLUMNS = (
+        ('slot', 'BIGINT'),
+        ('failed', 'SMALLINT'),
+        ('receipt', 'BYTEA'),
+    )
+    INDEXES = ('slot',)
+
+    def __init__(self, program_id, tablename='neon_receipts', backend=None):
+        self.program_id = program_id
+        SQLDict.__init__(self, tablename, backend)
+
+    def encode_key(self, key):
+        return encode_signature(key)
+
+    def decode_key(self, key):
+        return decode_signature(key)
+
+    def encode_value(self, value):
+        meta = value.get('meta') or {}
+        return (value['slot'], int(meta.get('err') is not None), encode_receipt(value, self.program_id))
+
+    def decode_value(self, row):
+        (slot, failed, receipt) = row
+        return decode_receipt(receipt, slot, failed)
+
+
+class RawReceiptsDict(SQLDict):
+    """solana signature -> full getConfirmedTransaction result, kept for `retention` seconds"""
+
+    KEY_TYPE = 'BYTEA'
+    COLUMNS = (
+        ('stored_at', 'BIGINT'),
+        ('receipt', 'BYTEA'),
+    )
+    INDEXES = ('stored_at',)
+
+    def __init__(self, retention, tablename='raw_receipts', backend=None):
+        self.retention = retention
+        SQLDict.__init__(self, tablename, backend)
+
+    def encode_key(self, key):
+        return encode_signature(key)
+
+    def decode_key(self, key):
+        return decode_signature(key)
+
+    def encode_value(self, value):
+        return (int(time.time()), zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8')))
+
+    def decode_value(self, row):
+        return json.loads(zlib.decompress(bytes(row[1])))
+
+    def prune(self):
+        """Drop the receipts older than the retention period, return how many."""
+        return self.backend.execute('DELETE FROM {} WHERE stored_at < %s'.format(self.tablename),
+                                    (int(time.time()) - self.retention,))
+
+
+class UnfinalizedTransactionsDict(SQLDict):
+    """eth trx hash -> slot, for the transactions indexed before their slot was finalized"""
+
+    KEY_TYPE = 'BYTEA'
+    COLUMNS = (
+        ('slot', 'BIGINT'),
+    )
+    INDEXES = ('slot',)
+
+    def __init__(self, tablename='unfinalized_transactions', backend=None):
+        SQLDict.__init__(self, tablename, backend)
+
+    def encode_key(self, key):
+        return encode_hash(key)
+
+    def decode_key(self, key):
+        return decode_hash(key)
+
+    def encode_value(self, value):
+        return (value,)
+
+    def decode_value(self, row):
+        return row[0]
+
+    def up_to(self, slot):
+        """{eth trx hash: slot} of the transactions in slots up to `slot`"""
+        rows = self.backend.fetchall('SELECT key, slot FROM {} WHERE slot <= %s'.format(self.tablename), (slot,))
+        return {self.decode_key(key): row_slot for (key, row_slot) in rows}
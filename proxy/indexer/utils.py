@@ -1,11 +1,11 @@
-import base58
 import base64
 import json
 import logging
 import os
 import rlp
-import psycopg2
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from construct import Struct, Bytes, Int64ul
 from eth_utils import big_endian_to_int
 from ethereum.transactions import Transaction as EthTrx
@@ -20,6 +20,12 @@ from spl.token.constants import TOKEN_PROGRAM_ID
 from spl.token.instructions import get_associated_token_address
 from web3.auto.gethdev import w3
 from proxy.environment import solana_url, evm_loader_id, ETH_TOKEN_MINT_ID
+from proxy.common_neon.neon_receipt import decode_neon_receipt
+
+try:
+    from sql_backend import get_backend
+except ImportError:
+    from .sql_backend import get_backend
 
 sysvarclock = "SysvarC1ock11111111111111111111111111111111"
 sysinstruct = "Sysvar1nstructions1111111111111111111111111"
@@ -28,6 +34,16 @@ rentid = "SysvarRent111111111111111111111111111111111"
 incinerator = "1nc1nerator11111111111111111111111111111111"
 system = "11111111111111111111111111111111"
 
+# storages per getMultipleAccounts, the RPC limit
+MULTIPLE_ACCOUNTS_BATCH = 100
+# cancel transactions sent at once
+CANCEL_PARALLELISM = int(os.environ.get("CANCEL_PARALLELISM", "8"))
+# seconds to wait for the confirmation of the sent cancels
+CANCEL_CONFIRM_TIMEOUT = float(os.environ.get("CANCEL_CONFIRM_TIMEOUT", "30"))
+CANCEL_CONFIRM_INTERVAL = 1.0
+# signatures per getSignatureStatuses
+SIGNATURE_STATUSES_BATCH = 256
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -42,63 +58,28 @@ def check_error(trx):
 
 
 def get_trx_results(trx):
-    # init variables for instruction owner checks
-    accounts = trx["transaction"]["message"]["accountKeys"]
-    evm_loader_instructions = []
-    for idx, instruction in enumerate(trx["transaction"]["message"]["instructions"]):
-        if accounts[instruction["programIdIndex"]] == evm_loader_id:
-            evm_loader_instructions.append(idx)
+    receipt = decode_neon_receipt(trx, evm_loader_id)
+    if receipt.result is None:
+        return None
 
     slot = trx['slot']
     block_number = hex(slot)
-    got_result = False
     logs = []
-    status = "0x1"
-    gas_used = 0
-    return_value = bytes
-    log_index = 0
-    for inner in (trx['meta']['innerInstructions']):
-        if inner["index"] in evm_loader_instructions:
-            for event in inner['instructions']:
-                if accounts[event['programIdIndex']] == evm_loader_id:
-                    log = base58.b58decode(event['data'])
-                    instruction = log[:1]
-                    if (int().from_bytes(instruction, "little") == 7):  # OnEvent evmInstruction code
-                        address = log[1:21]
-                        count_topics = int().from_bytes(log[21:29], 'little')
-                        topics = []
-                        pos = 29
-                        for _ in range(count_topics):
-                            topic_bin = log[pos:pos + 32]
-                            topics.append('0x'+topic_bin.hex())
-                            pos += 32
-                        data = log[pos:]
-                        rec = {
-                            'address': '0x'+address.hex(),
-                            'topics': topics,
-                            'data': '0x'+data.hex(),
-                            'transactionLogIndex': hex(0),
-                            'transactionIndex': hex(inner['index']),
-                            'blockNumber': block_number,
-                            # 'transactionHash': trxId, # set when transaction found
-                            'logIndex': hex(log_index),
-                            # 'blockHash': block_hash # set when transaction found
-                        }
-                        logs.append(rec)
-                        log_index +=1
-                    elif int().from_bytes(instruction, "little") == 6:  # OnReturn evmInstruction code
-                        got_result = True
-                        if log[1] < 0xd0:
-                            status = "0x1"
-                        else:
-                            status = "0x0"
-                        gas_used = int.from_bytes(log[2:10], 'little')
-                        return_value = log[10:].hex()
-
-    if got_result:
-        return (logs, status, gas_used, return_value, slot)
-    else:
-        return None
+    for (log_index, event) in enumerate(receipt.events):
+        logs.append({
+            'address': '0x' + event.address.hex(),
+            'topics': ['0x' + topic.hex() for topic in event.topics],
+            'data': '0x' + event.data.hex(),
+            'transactionLogIndex': hex(0),
+            'transactionIndex': hex(event.instruction_index),
+            'blockNumber': block_number,
+            # 'transactionHash': trxId, # set when transaction found
+            'logIndex': hex(log_index),
+            # 'blockHash': block_hash # set when transaction found
+        })
+
+    status = "0x1" if receipt.result.succeeded else "0x0"
+    return (logs, status, receipt.result.gas_used, receipt.result.return_value.hex(), slot)
 
 
 def get_trx_receipts(unsigned_msg, signature):
@@ -132,24 +113,18 @@ STORAGE_ACCOUNT_INFO_LAYOUT = Struct(
 
 )
 
-def get_account_list(client, storage_account):
-    opts = {
-        "encoding": "base64",
-        "commitment": "confirmed",
-        "dataSlice": {
-            "offset": 0,
-            "length": 2048,
-        }
+STORAGE_ACCOUNT_OPTS = {
+    "encoding": "base64",
+    "commitment": "confirmed",
+    "dataSlice": {
+        "offset": 0,
+        "length": 2048,
     }
-    result = client._provider.make_request("getAccountInfo", str(storage_account), opts)
-    # logger.debug("\n{}".format(json.dumps(result, indent=4, sort_keys=True)))
+}
 
-    info = result['result']['value']
-    if info is None:
-        raise Exception("Can't get information about {}".format(storage_account))
-
-    data = base64.b64decode(info['data'][0])
 
+def parse_account_list(data):
+    """Accounts locked by a storage account, None if it is empty or not a storage."""
     tag = data[0]
     if tag == 0:
         logger.debug("Empty")
@@ -171,24 +146,39 @@ def get_account_list(client, storage_account):
         return None
 
 
+def get_account_list(client, storage_account):
+    result = client._provider.make_request("getAccountInfo", str(storage_account), STORAGE_ACCOUNT_OPTS)
+    # logger.debug("\n{}".format(json.dumps(result, indent=4, sort_keys=True)))
+
+    info = result['result']['value']
+    if info is None:
+        raise Exception("Can't get information about {}".format(storage_account))
+
+    return parse_account_list(base64.b64decode(info['data'][0]))
+
+
+def get_account_lists(client, storage_accounts):
+    """{storage: account list} with one getMultipleAccounts per MULTIPLE_ACCOUNTS_BATCH storages.
+    Missing storages are left out, empty ones map to None."""
+    storage_accounts = [str(storage) for storage in storage_accounts]
+    acc_lists = {}
+    for pos in range(0, len(storage_accounts), MULTIPLE_ACCOUNTS_BATCH):
+        batch = storage_accounts[pos:pos + MULTIPLE_ACCOUNTS_BATCH]
+        result = client._provider.make_request("getMultipleAccounts", batch, STORAGE_ACCOUNT_OPTS)
+        for storage, info in zip(batch, result['result']['value']):
+            if info is None:
+                logger.error("Can't get information about {}".format(storage))
+                continue
+            acc_lists[storage] = parse_account_list(base64.b64decode(info['data'][0]))
+    return acc_lists
+
+
 
 
 class LogDB:
     def __init__(self):
-        POSTGRES_DB = os.environ.get("POSTGRES_DB", "neon-db")
-        POSTGRES_USER = os.environ.get("POSTGRES_USER", "neon-proxy")
-        POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD", "neon-proxy-pass")
-        POSTGRES_HOST = os.environ.get("POSTGRES_HOST", "localhost")
-
-        self.conn = psycopg2.connect(
-            dbname=POSTGRES_DB,
-            user=POSTGRES_USER,
-            password=POSTGRES_PASSWORD,
-            host=POSTGRES_HOST
-        )
-
-        cur = self.conn.cursor()
-        cur.execute("""CREATE TABLE IF NOT EXISTS
+        self.backend = get_backend()
+        self.backend.execute("""CREATE TABLE IF NOT EXISTS
         logs (
             address TEXT,
             blockHash TEXT,
@@ -201,7 +191,6 @@ class LogDB:
             json TEXT,
             UNIQUE(transactionLogIndex, transactionHash, topic)
         );""")
-        self.conn.commit()
 
 
     def push_logs(self, logs):
@@ -221,13 +210,17 @@ class LogDB:
                 )
         if len(rows):
             # logger.debug(rows)
-            cur = self.conn.cursor()
-            cur.executemany('INSERT INTO logs VALUES (%s, %s, %s, %s,  %s, %s,  %s) ON CONFLICT DO NOTHING', rows)
-            self.conn.commit()
+            self.backend.upsert_many('logs',
+                                     'address, blockHash, blockNumber, topic, transactionHash, transactionLogIndex, json',
+                                     rows, 'ON CONFLICT DO NOTHING')
         else:
             logger.debug("NO LOGS")
 
 
+    def delete_logs(self, transaction_hash):
+        self.backend.execute("DELETE FROM logs WHERE transactionHash = %s", (transaction_hash,))
+
+
     def get_logs(self, fromBlock = None, toBlock = None, address = None, topics = None, blockHash = None):
         queries = []
         params = []
@@ -275,10 +268,7 @@ class LogDB:
         logger.debug(query_string)
         logger.debug(params)
 
-        cur = self.conn.cursor()
-        cur.execute(query_string, tuple(params))
-
-        rows = cur.fetchall()
+        rows = self.backend.fetchall(query_string, tuple(params))
 
         logs = set()
         for row in rows:
@@ -288,10 +278,6 @@ class LogDB:
             return_list.append(json.loads(log))
         return return_list
 
-    def __del__(self):
-        self.conn.close()
-
-
 class Canceller:
     def __init__(self):
         # Initialize user account
@@ -315,6 +301,7 @@ class Canceller:
 
         self.operator = self.signer.public_key()
         self.operator_token = get_associated_token_address(PublicKey(self.operator), ETH_TOKEN_MINT_ID)
+        self.executor = ThreadPoolExecutor(CANCEL_PARALLELISM)
 
 
     def call(self, *args):
@@ -330,6 +317,44 @@ class Canceller:
 
 
     def unlock_accounts(self, blocked_storages):
+        """Cancel the transactions hanging in blocked_storages: {storage: (eth_trx, blocked accounts)}.
+
+        The storages are read with getMultipleAccounts, the ones already emptied (cancelled or finished by
+        someone else) or holding other accounts are skipped. Cancels are sent CANCEL_PARALLELISM at a time
+        and confirmed together."""
+        storages = {}
+        for storage, (eth_trx, blocked_accs) in blocked_storages.items():
+            if eth_trx is None:
+                logger.error("trx is None")
+                continue
+            if blocked_accs is None:
+                logger.error("blocked_accs is None")
+                continue
+            storages[storage] = (eth_trx, blocked_accs)
+        if len(storages) == 0:
+            return
+
+        acc_lists = get_account_lists(self.client, storages.keys())
+        trxs = []
+        for storage, (eth_trx, blocked_accs) in storages.items():
+            acc_list = acc_lists.get(storage)
+            if acc_list is None:
+                logger.debug("Storage {} is already unlocked".format(storage))
+                continue
+            if acc_list != blocked_accs:
+                logger.error("acc_list != blocked_accs")
+                continue
+            trxs.append((storage, self.make_cancel(storage, rlp.decode(bytes.fromhex(eth_trx), EthTrx), acc_list)))
+        if len(trxs) == 0:
+            return
+
+        recent_blockhash = self.client.get_recent_blockhash(commitment=Confirmed)["result"]["value"]["blockhash"]
+        signatures = self.executor.map(lambda trx: self.send_cancel(trx, recent_blockhash), [trx for _, trx in trxs])
+        sent = {signature: storage for (storage, _), signature in zip(trxs, signatures) if signature is not None}
+        self.confirm_cancels(sent)
+
+
+    def make_cancel(self, storage, eth_trx, acc_list):
         readonly_accs = [
             PublicKey(evm_loader_id),
             ETH_TOKEN_MINT_ID,
@@ -341,45 +366,57 @@ class Canceller:
             PublicKey(incinerator),
             PublicKey(system),
         ]
-        for storage, trx_accs in blocked_storages.items():
-            (eth_trx, blocked_accs) = trx_accs
-            acc_list = get_account_list(self.client, storage)
-            if eth_trx is None:
-                logger.error("trx is None")
-                continue
-            if blocked_accs is None:
-                logger.error("blocked_accs is None")
-                continue
-
-            eth_trx = rlp.decode(bytes.fromhex(eth_trx), EthTrx)
-            if acc_list != blocked_accs:
-                logger.error("acc_list != blocked_accs")
-                continue
-
-            if acc_list is not None:
-                keys = [
-                        AccountMeta(pubkey=storage, is_signer=False, is_writable=True),
-                        AccountMeta(pubkey=self.operator, is_signer=True, is_writable=True),
-                        AccountMeta(pubkey=self.operator_token, is_signer=False, is_writable=True),
-                        AccountMeta(pubkey=acc_list[4], is_signer=False, is_writable=True),
-                        AccountMeta(pubkey=incinerator, is_signer=False, is_writable=True),
-                        AccountMeta(pubkey=system, is_signer=False, is_writable=False)
-                    ]
-                for acc in acc_list:
-                    keys.append(AccountMeta(pubkey=acc, is_signer=False, is_writable=(False if acc in readonly_accs else True)))
-
-                trx = Transaction()
-                trx.add(TransactionInstruction(
-                    program_id=evm_loader_id,
-                    data=bytearray.fromhex("15") + eth_trx[0].to_bytes(8, 'little'),
-                    keys=keys
-                ))
-
-                logger.debug("Send Cancel")
-                try:
-                    self.client.send_transaction(trx, self.signer, opts=TxOpts(preflight_commitment=Confirmed))
-                except Exception as err:
-                    logger.error(err)
-                else:
-                    logger.debug("Canceled")
-                    logger.debug(acc_list)
+        keys = [
+                AccountMeta(pubkey=storage, is_signer=False, is_writable=True),
+                AccountMeta(pubkey=self.operator, is_signer=True, is_writable=True),
+                AccountMeta(pubkey=self.operator_token, is_signer=False, is_writable=True),
+                AccountMeta(pubkey=acc_list[4], is_signer=False, is_writable=True),
+                AccountMeta(pubkey=incinerator, is_signer=False, is_writable=True),
+                AccountMeta(pubkey=system, is_signer=False, is_writable=False)
+            ]
+        for acc in acc_list:
+            keys.append(AccountMeta(pubkey=acc, is_signer=False, is_writable=(False if acc in readonly_accs else True)))
+
+        trx = Transaction()
+        trx.add(TransactionInstruction(
+            program_id=evm_loader_id,
+            data=bytearray.fromhex("15") + eth_trx[0].to_bytes(8, 'little'),
+            keys=keys
+        ))
+        return trx
+
+
+    def send_cancel(self, trx, recent_blockhash):
+        """Signature of the sent cancel, None if the preflight rejected it."""
+        trx.recent_blockhash = recent_blockhash
+        trx.sign(self.signer)
+        logger.debug("Send Cancel")
+        try:
+            return self.client.send_raw_transaction(trx.serialize(), opts=TxOpts(skip_confirmation=True,
+                                                                                 preflight_commitment=Confirmed))["result"]
+        except Exception as err:
+            logger.error(err)
+            return None
+
+
+    def confirm_cancels(self, sent):
+        """Wait up to CANCEL_CONFIRM_TIMEOUT for the cancels {signature: storage}, polling their statuses in batches."""
+        pending = dict(sent)
+        deadline = time.monotonic() + CANCEL_CONFIRM_TIMEOUT
+        while len(pending) and time.monotonic() < deadline:
+            time.sleep(CANCEL_CONFIRM_INTERVAL)
+            signatures = list(pending)
+            for pos in range(0, len(signatures), SIGNATURE_STATUSES_BATCH):
+                batch = signatures[pos:pos + SIGNATURE_STATUSES_BATCH]
+                statuses = self.client._provider.make_request("getSignatureStatuses", batch)["result"]["value"]
+                for signature, status in zip(batch, statuses):
+                    if status is None or status.get('confirmationStatus') not in ('confirmed', 'finalized'):
+                        continue
+                    storage = pending.pop(signature)
+                    if status.get('err') is not None:
+                        logger.error("Cancel of {} failed: {}".format(storage, status['err']))
+                    else:
+                        logger.debug("Canceled {}".format(storage))
+        for signature, storage in pending.items():
+            logger.error("Cancel {} of {} is not confirmed".format(signature, storage))
+        logger.debug("Confirmed {}/{} cancels".format(len(sent) - len(pending), len(sent)))
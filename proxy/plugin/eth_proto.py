@@ -2,7 +2,8 @@ from ecdsa import SigningKey, SECP256k1, VerifyingKey
 from sha3 import keccak_256
 import json
 import rlp
-from eth_keys import keys
+from eth_keys import KeyAPI
+from eth_keys.backends import get_backend
 
 public = '0x2377BB12320F46F0B9E30EBFB941121352716f2C'
 private = '0x886d5b4ce9465473701bf394b1b0b217548c57576436864fcbc1f554033a0680'
@@ -22,7 +23,15 @@ a0 5d09ca05a62935d6c2a04bfa5bfa1cb46bfcb59e3a115e0c8cceca807efb778b - s
 
 
 
-class Trx(rlp.Serializable):
+# CoinCurveECCBackend (libsecp256k1) is picked when coincurve is installed, the pure python one otherwise.
+# The backend is resolved once here instead of on every signature operation.
+ECC_BACKEND = get_backend()
+
+
+class Trx:
+    """Signed ethereum transaction decoded once.
+    The unsigned message, its hash, the signature, the signed hash and the sender are computed on first use and kept."""
+
     fields = (
         ('nonce', rlp.codec.big_endian_int),
         ('gasPrice', rlp.codec.big_endian_int),
@@ -34,15 +43,36 @@ class Trx(rlp.Serializable):
         ('r', rlp.codec.big_endian_int),
         ('s', rlp.codec.big_endian_int)
     )
+    sedes = rlp.sedes.List([field_sedes for _, field_sedes in fields])
+
+    __slots__ = tuple(name for name, _ in fields) + ('_raw', '_msg', '_msg_hash', '_signature', '_hash_signed', '_sender')
+
+    def __init__(self, nonce, gasPrice, gasLimit, toAddress, value, callData, v, r, s, raw=None):
+        self.nonce = nonce
+        self.gasPrice = gasPrice
+        self.gasLimit = gasLimit
+        self.toAddress = toAddress
+        self.value = value
+        self.callData = callData
+        self.v = v
+        self.r = r
+        self.s = s
 
-    def __init__(self, *args, **kwargs):
-        rlp.Serializable.__init__(self, *args, **kwargs)
+        self._raw = raw
         self._msg = None
+        self._msg_hash = None
+        self._signature = None
+        self._hash_signed = None
+        self._sender = None
 
     @classmethod
     def fromString(cls, s):
-        return rlp.decode(s, Trx)
-    
+        raw = bytes(s)
+        return cls(*rlp.decode(raw, cls.sedes), raw=raw)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name, _ in self.fields}
+
     def chainId(self):
         # chainid*2 + 35  xxxxx0 + 100011   xxxx0 + 100010 +1
         # chainid*2 + 36  xxxxx0 + 100100   xxxx0 + 100011 +1
@@ -53,18 +83,32 @@ class Trx(rlp.Serializable):
             self._msg = rlp.encode((self.nonce, self.gasPrice, self.gasLimit, self.toAddress, self.value, self.callData, self.chainId(), b"", b""))
         return self._msg
 
+    def unsigned_msg_hash(self):
+        if self._msg_hash is None:
+            self._msg_hash = keccak_256(self.unsigned_msg()).digest()
+        return self._msg_hash
+
+    def _vrs_signature(self):
+        return KeyAPI.Signature(vrs=[1 if self.v % 2 == 0 else 0, self.r, self.s], backend=ECC_BACKEND)
+
     def signature(self):
-        return keys.Signature(vrs=[1 if self.v % 2 == 0 else 0, self.r, self.s]).to_bytes()
+        if self._signature is None:
+            self._signature = self._vrs_signature().to_bytes()
+        return self._signature
 
     def sender(self):
-        hash = keccak_256(self.unsigned_msg()).digest()
-        sig = keys.Signature(vrs=[1 if self.v%2==0 else 0, self.r, self.s])
-        pub = sig.recover_public_key_from_msg_hash(hash)
-        return pub.to_canonical_address().hex()
+        if self._sender is None:
+            pub = self._vrs_signature().recover_public_key_from_msg_hash(self.unsigned_msg_hash())
+            self._sender = pub.to_canonical_address().hex()
+        return self._sender
 
     def hash_signed(self):
-        return keccak_256(rlp.encode((self.nonce, self.gasPrice, self.gasLimit, self.toAddress, self.value, self.callData,
-                                      self.v, self.r, self.s))).digest()
+        if self._hash_signed is None:
+            if self._raw is None:
+                self._raw = rlp.encode((self.nonce, self.gasPrice, self.gasLimit, self.toAddress, self.value, self.callData,
+                                        self.v, self.r, self.s))
+            self._hash_signed = keccak_256(self._raw).digest()
+        return self._hash_signed
 
 #class JsonEncoder(json.JSONEncoder):
 #    def default(self, obj):
@@ -10,6 +10,7 @@
 """
 from typing import List, Tuple, Optional
 import copy
+import os
 import json
 import unittest
 import eth_utils
@@ -30,12 +31,15 @@ import threading
 
 from .solana_rest_api_tools import EthereumAddress, get_token_balance_or_airdrop, getAccountInfo, call_signed, \
                                    call_emulated, EthereumError, neon_config_load, MINIMAL_GAS_PRICE, estimate_gas
-from solana.rpc.commitment import Commitment, Confirmed
+from solana.rpc.commitment import Commitment
 from web3 import Web3
 import logging
 from ..core.acceptor.pool import proxy_id_glob
 from ..indexer.utils import get_trx_results, LogDB
-from ..indexer.sql_dict import SQLDict
+from ..indexer.sql_dict import CachedSQLDict, SQL_CACHE_NEGATIVE_TTL
+from ..indexer.change_feed import CHANGE_FEED, ChangeListener, ChangePublisher
+from ..indexer.sql_tables import EthereumTransactionsDict, SolanaEthereumTransactionsDict, EthereumSolanaTransactionsDict, \
+                                 BlocksByHashDict, UnfinalizedTransactionsDict
 from ..environment import evm_loader_id, solana_cli, solana_url, neon_cli
 
 logger = logging.getLogger(__name__)
@@ -44,6 +48,18 @@ logger.setLevel(logging.DEBUG)
 modelInstanceLock = threading.Lock()
 modelInstance = None
 
+BLOCKS_CACHE_SIZE = int(os.environ.get("BLOCKS_CACHE_SIZE", "10000"))
+# indexed transactions and their solana signatures are cached only while the change feed is connected:
+# they are rewritten and rolled back
+SOL_ETH_TRX_CACHE_SIZE = int(os.environ.get("SOL_ETH_TRX_CACHE_SIZE", "100000"))
+ETH_TRX_CACHE_SIZE = int(os.environ.get("ETH_TRX_CACHE_SIZE", "10000"))
+# misses are remembered until the indexer announces the key, this long at most (seconds)
+CHANGE_FEED_NEGATIVE_TTL = float(os.environ.get("CHANGE_FEED_NEGATIVE_TTL", "30"))
+# confirmed - answer with everything indexed, finalized - hide transactions, logs and blocks not finalized yet
+RPC_COMMITMENT = os.environ.get("RPC_COMMITMENT", "confirmed")
+# commitment of the block tags a read can ask for, "latest" follows RPC_COMMITMENT
+BLOCK_TAG_COMMITMENTS = {'latest': RPC_COMMITMENT, 'safe': 'confirmed', 'finalized': 'finalized'}
+
 NEON_PROXY_PKG_VERSION = '0.4.1-rc0'
 NEON_PROXY_REVISION = 'NEON_PROXY_REVISION_TO_BE_REPLACED'
 
@@ -53,10 +69,19 @@ class EthereumModel:
         self.client = SolanaClient(solana_url)
 
         self.logs_db = LogDB()
-        self.blocks_by_hash = SQLDict(tablename="solana_blocks_by_hash")
-        self.ethereum_trx = SQLDict(tablename="ethereum_transactions")
-        self.eth_sol_trx = SQLDict(tablename="ethereum_solana_transactions")
-        self.sol_eth_trx = SQLDict(tablename="solana_ethereum_transactions")
+        self.blocks_by_hash = CachedSQLDict(BlocksByHashDict(), BLOCKS_CACHE_SIZE)
+        self.ethereum_trx = CachedSQLDict(EthereumTransactionsDict(), ETH_TRX_CACHE_SIZE)
+        # not cached: the indexer rewrites the signature list the send path stores
+        self.eth_sol_trx = EthereumSolanaTransactionsDict()
+        self.sol_eth_trx = CachedSQLDict(SolanaEthereumTransactionsDict(), SOL_ETH_TRX_CACHE_SIZE)
+        self.unfinalized = UnfinalizedTransactionsDict()
+        self.commitment = Commitment(RPC_COMMITMENT)
+        # highest slot the indexer reported as indexed
+        self.indexed_slot = 0
+        self.change_listener = None
+        if CHANGE_FEED:
+            self.change_listener = ChangeListener(self.on_change)
+            self.change_listener.start()
 
         with proxy_id_glob.get_lock():
             self.proxy_id = proxy_id_glob.value
@@ -124,8 +149,8 @@ class EthereumModel:
         return str(self.__dict__)
 
     def process_block_tag(self, tag):
-        if tag == "latest":
-            slot = int(self.client.get_slot(commitment=Confirmed)["result"])
+        if tag in BLOCK_TAG_COMMITMENTS:
+            slot = int(self.client.get_slot(commitment=Commitment(BLOCK_TAG_COMMITMENTS[tag]))["result"])
         elif tag in ('earliest', 'pending'):
             raise Exception("Invalid tag {}".format(tag))
         elif isinstance(tag, str):
@@ -137,7 +162,7 @@ class EthereumModel:
         return slot
 
     def eth_blockNumber(self):
-        slot = self.client.get_slot(commitment=Confirmed)['result']
+        slot = self.client.get_slot(commitment=self.commitment)['result']
         logger.debug("eth_blockNumber %s", hex(slot))
         return hex(slot)
 
@@ -168,11 +193,14 @@ class EthereumModel:
            topics = obj['topics']
         if 'blockHash' in obj:
            blockHash = obj['blockHash']
+        if RPC_COMMITMENT == 'finalized':
+            finalized_slot = self.client.get_slot(commitment=self.commitment)['result']
+            toBlock = finalized_slot if toBlock is None else min(toBlock, finalized_slot)
 
         return self.logs_db.get_logs(fromBlock, toBlock, address, topics, blockHash)
 
-    def getBlockBySlot(self, slot, full):
-        response = self.client._provider.make_request("getBlock", slot, {"commitment":"confirmed", "transactionDetails":"signatures"})
+    def getBlockBySlot(self, slot, full, commitment=RPC_COMMITMENT):
+        response = self.client._provider.make_request("getBlock", slot, {"commitment":commitment, "transactionDetails":"signatures"})
         if 'error' in response:
             raise Exception(response['error']['message'])
         block_info = response['result']
@@ -182,15 +210,20 @@ class EthereumModel:
         transactions = []
         gasUsed = 0
         trx_index = 0
+        sol_eth_trx = self.cached(self.sol_eth_trx).get_many(block_info['signatures'])
+        trx_infos = self.cached(self.ethereum_trx).get_many(eth_trx['eth'] for eth_trx in sol_eth_trx.values() if eth_trx['idx'] == 0)
+        # the block is finalized, the reconciler may not have promoted its transactions yet
+        hidden = self.unfinalized.contains_many(trx_infos.keys()) if commitment == 'finalized' else set()
         for signature in block_info['signatures']:
-            eth_trx = self.sol_eth_trx.get(signature, None)
-            if eth_trx is not None:
+            eth_trx = sol_eth_trx.get(signature, None)
+            if eth_trx is not None and eth_trx['eth'] not in hidden:
                 if eth_trx['idx'] == 0:
-                    trx_receipt = self.eth_getTransactionReceipt(eth_trx['eth'], block_info)
+                    trx_info = trx_infos.get(eth_trx['eth'], None)
+                    trx_receipt = self.eth_getTransactionReceipt(eth_trx['eth'], block_info, trx_info)
                     if trx_receipt is not None:
                         gasUsed += int(trx_receipt['gasUsed'], 16)
                     if full:
-                        trx = self.eth_getTransactionByHash(eth_trx['eth'], block_info)
+                        trx = self.eth_getTransactionByHash(eth_trx['eth'], block_info, trx_info)
                         if trx is not None:
                             trx['transactionIndex'] = hex(trx_index)
                             trx_index += 1
@@ -244,11 +277,11 @@ class EthereumModel:
 
     def eth_getBlockByNumber(self, tag, full):
         """Returns information about a block by block number.
-            tag - integer of a block number, or the string "earliest", "latest" or "pending", as in the default block parameter.
+            tag - integer of a block number, or the string "latest", "safe" or "finalized", as in the default block parameter.
             full - If true it returns the full transaction objects, if false only the hashes of the transactions.
         """
         slot = self.process_block_tag(tag)
-        ret = self.getBlockBySlot(slot, full)
+        ret = self.getBlockBySlot(slot, full, BLOCK_TAG_COMMITMENTS.get(tag, RPC_COMMITMENT))
         if ret is not None:
             logger.debug("eth_getBlockByNumber: %s", json.dumps(ret, indent=3))
         else:
@@ -287,11 +320,46 @@ class EthereumModel:
             print("Can't get account info: %s"%err)
             return hex(0)
 
-    def eth_getTransactionReceipt(self, trxId, block_info = None):
+    def on_change(self, change):
+        """Keep the caches in step with the indexer, called on the change listener thread."""
+        kind = change['kind']
+        if kind == 'trx':
+            for eth_signature in change['hashes']:
+                self.ethereum_trx.invalidate(eth_signature)
+        elif kind == 'rollback':
+            for eth_signature in change['hashes']:
+                self.ethereum_trx.invalidate(eth_signature)
+            # the solana signatures of the rolled back transactions are not in the notification
+            self.sol_eth_trx.invalidate()
+        elif kind == 'slot':
+            self.indexed_slot = max(self.indexed_slot, change['slot'])
+        elif kind == 'reset':
+            # changes may have been missed, start over
+            for cache in (self.ethereum_trx, self.sol_eth_trx, self.blocks_by_hash):
+                cache.invalidate()
+        # the negative caching of the mutable tables relies on the notifications
+        negative_ttl = CHANGE_FEED_NEGATIVE_TTL if self.change_listener.connected else SQL_CACHE_NEGATIVE_TTL
+        self.ethereum_trx.negative_ttl = negative_ttl
+
+    def get_transaction(self, trxId):
+        """Indexed transaction, None if there is none or it is not finalized while RPC_COMMITMENT=finalized"""
+        if RPC_COMMITMENT == 'finalized' and trxId in self.unfinalized:
+            return None
+        return self.cached(self.ethereum_trx).get(trxId, None)
+
+    def cached(self, cache):
+        """The cache of a table the indexer rewrites while the change feed is connected, otherwise the table itself:
+        without notifications a cached value could be stale."""
+        if self.change_listener is None or not self.change_listener.connected:
+            return cache.sql_dict
+        return cache
+
+    def eth_getTransactionReceipt(self, trxId, block_info = None, trx_info = None):
         logger.debug('getTransactionReceipt: %s', trxId)
 
         trxId = trxId.lower()
-        trx_info = self.ethereum_trx.get(trxId, None)
+        if trx_info is None:
+            trx_info = self.get_transaction(trxId)
         if trx_info is None:
             logger.debug ("Not found receipt")
             return None
@@ -314,9 +382,8 @@ class EthereumModel:
         except Exception as err:
             logger.debug("Can't get block info: %s"%err)
 
-        logs = trx_info['logs']
-        for log in logs:
-            log['blockHash'] = blockHash
+        # trx_info may be shared by the cache
+        logs = [dict(log, blockHash=blockHash) for log in trx_info['logs']]
 
         result = {
             "transactionHash": trxId,
@@ -336,11 +403,12 @@ class EthereumModel:
         logger.debug('RESULT: %s', json.dumps(result, indent=3))
         return result
 
-    def eth_getTransactionByHash(self, trxId, block_info = None):
+    def eth_getTransactionByHash(self, trxId, block_info = None, trx_info = None):
         logger.debug('eth_getTransactionByHash: %s', trxId)
 
         trxId = trxId.lower()
-        trx_info = self.ethereum_trx.get(trxId, None)
+        if trx_info is None:
+            trx_info = self.get_transaction(trxId)
         if trx_info is None:
             logger.debug ("Not found receipt")
             return None
@@ -401,7 +469,7 @@ class EthereumModel:
         if trx.gasPrice < MINIMAL_GAS_PRICE:
             raise Exception("The transaction gasPrice is less then the minimum allowable value ({}<{})".format(trx.gasPrice, MINIMAL_GAS_PRICE))
 
-        eth_signature = '0x' + bytes(Web3.keccak(bytes.fromhex(rawTrx[2:]))).hex()
+        eth_signature = '0x' + trx.hash_signed().hex()
 
         sender = trx.sender()
         logger.debug('Eth Sender: %s', sender)
@@ -454,19 +522,25 @@ class EthereumModel:
                         'eth_trx': rawTrx[2:],
                         'slot': slot,
                         'logs': [],
-                        'status': 0,
+                        'status': '0x0',
                         'gas_used': 0,
                         'return_value': None,
                         'from_address': '0x'+sender,
                     }
+                self.unfinalized[eth_signature] = slot
                 self.eth_sol_trx[eth_signature] = [signature]
                 self.blocks_by_hash[block_hash] = slot
                 self.sol_eth_trx[signature] = {
                     'idx': 0,
                     'eth': eth_signature,
                 }
+                # other workers may have cached the miss; a publisher per call, request threads share the model
+                changes = ChangePublisher()
+                changes.transaction(eth_signature, slot, bool(got_result and got_result[0]))
+                changes.flush()
             except Exception as err:
-                logger.debug(err)
+                # the indexer stores it later, meanwhile the receipt is not served
+                logger.error("Could not store transaction %s: %s", eth_signature, err)
 
             return eth_signature
 
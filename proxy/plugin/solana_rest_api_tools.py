@@ -6,11 +6,12 @@ import os
 import random
 import re
 import struct
+import threading
 import time
+from concurrent.futures import Future
 from datetime import datetime
 from hashlib import sha256
 from typing import NamedTuple, Optional, Union, Dict, Tuple
-import psycopg2
 import rlp
 from base58 import b58decode, b58encode
 from construct import Bytes, Int8ul, Int32ul, Int64ul
@@ -27,7 +28,8 @@ from solana.rpc.api import Client as SolanaClient, SendTransactionError
 from solana.rpc.commitment import Commitment, Confirmed
 from solana.rpc.types import TxOpts
 from solana.sysvar import *
-from solana.transaction import AccountMeta, Transaction, TransactionInstruction
+from solana.transaction import AccountMeta, Transaction, TransactionInstruction, PACKET_DATA_SIZE, SIG_LENGTH
+from solana.utils import shortvec_encoding as shortvec
 from solana._layouts.system_instructions import SYSTEM_INSTRUCTIONS_LAYOUT
 from solana._layouts.system_instructions import InstructionType as SystemInstructionType
 
@@ -37,9 +39,10 @@ from spl.token.instructions import get_associated_token_address, create_associat
 from ..environment import neon_cli, evm_loader_id, ETH_TOKEN_MINT_ID, COLLATERAL_POOL_BASE, read_elf_params
 from ..common_neon.utils import get_from_dict
 from ..common_neon.errors import *
+from ..common_neon.neon_receipt import decode_neon_receipt
 from .eth_proto import Trx
 from ..core.acceptor.pool import new_acc_id_glob, acc_list_glob
-from ..indexer.sql_dict import POSTGRES_USER, POSTGRES_HOST, POSTGRES_DB, POSTGRES_PASSWORD
+from ..indexer.sql_backend import get_backend
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -52,6 +55,9 @@ USE_COMBINED_START_CONTINUE = os.environ.get("USE_COMBINED_START_CONTINUE", "NO"
 CONTINUE_COUNT_FACTOR = int(os.environ.get("CONTINUE_COUNT_FACTOR", "3"))
 TIMEOUT_TO_RELOAD_NEON_CONFIG = int(os.environ.get("TIMEOUT_TO_RELOAD_NEON_CONFIG", "3600"))
 MINIMAL_GAS_PRICE=int(os.environ.get("MINIMAL_GAS_PRICE", 1))*10**9
+SINGLE_TRX_STEP_LIMIT = int(os.environ.get("SINGLE_TRX_STEP_LIMIT", "500"))
+CREATE_ACCOUNT_BATCH_WINDOW = float(os.environ.get("CREATE_ACCOUNT_BATCH_WINDOW", "0.05"))
+CREATE_ACCOUNT_TIMEOUT = float(os.environ.get("CREATE_ACCOUNT_TIMEOUT", "60"))
 
 ACCOUNT_SEED_VERSION=b'\1'
 
@@ -69,6 +75,18 @@ system = "11111111111111111111111111111111"
 
 STORAGE_SIZE = 128 * 1024
 
+STRATEGY_SINGLE = "single"
+STRATEGY_ITERATIVE = "iterative"
+STRATEGY_HOLDER = "holder"
+# the emulator reported no steps_executed, it is logged once per process
+steps_executed_missing = False
+
+# Used only to compile messages for size estimation, any 32-byte values give the same size
+SIZE_ESTIMATE_BLOCKHASH = Blockhash("11111111111111111111111111111111")
+SIZE_ESTIMATE_STORAGE = PublicKey(b"\xff" * 32)
+# Compiled into a MessageTemplate, replaced by the recent blockhash on every build
+TEMPLATE_BLOCKHASH = Blockhash("11111111111111111111111111111111")
+
 ACCOUNT_INFO_LAYOUT = cStruct(
     "type" / Int8ul,
     "ether" / Bytes(20),
@@ -106,17 +124,8 @@ EXTRA_GAS = int(os.environ.get("EXTRA_GAS", "0"))
 
 class SQLCost():
     def __init__(self):
-
-        self.conn = psycopg2.connect(
-            dbname=POSTGRES_DB,
-            user=POSTGRES_USER,
-            password=POSTGRES_PASSWORD,
-            host=POSTGRES_HOST
-        )
-
-        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        cur = self.conn.cursor()
-        cur.execute('''
+        self.backend = get_backend()
+        self.backend.execute('''
                 CREATE TABLE IF NOT EXISTS OPERATOR_COST
                 (
                     hash char(64),
@@ -131,16 +140,14 @@ class SQLCost():
                     )
 
     def close(self):
-        self.conn.close()
+        pass
 
     def insert(self, hash, cost, used_gas, sender, to_address, sig, status, reason):
-        cur = self.conn.cursor()
-        cur.execute('''
+        params = (hash, cost, used_gas, sender, to_address, sig, status, reason)
+        self.backend.execute_prepared('operator_cost_insert', '''
                 INSERT INTO OPERATOR_COST (hash, cost, used_gas, sender, to_address, sig, status, reason)
                 VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-            ''',
-            (hash, cost, used_gas, sender, to_address, sig, status, reason)
-        )
+            ''', params)
 
 class CostSingleton(object):
     def __new__(cls):
@@ -161,8 +168,7 @@ class PermanentAccounts:
 
             logger.debug("LOCK RESOURCES {}".format(self.acc_id))
 
-            self.operator = signer.public_key()
-            self.operator_token = getTokenAddr(self.operator)
+            (self.operator, self.operator_token) = get_operator_accounts(signer)
 
             acc_id_bytes = self.acc_id.to_bytes((self.acc_id.bit_length() + 7) // 8, 'big')
 
@@ -192,17 +198,73 @@ class PermanentAccounts:
 
 
 class TransactionInfo:
-    def __init__(self, caller_token, eth_accounts, eth_trx):
+    def __init__(self, caller_token, eth_accounts, eth_trx, steps_executed=None):
         self.eth_trx = eth_trx
+        self.steps_executed = steps_executed
 
         self.caller_token = caller_token
         self.eth_accounts = eth_accounts
         self.nonce = eth_trx.nonce
 
-        hash = keccak_256(eth_trx.unsigned_msg()).digest()
+        hash = eth_trx.unsigned_msg_hash()
         collateral_pool_index = int().from_bytes(hash[:4], "little") % COLLATERALL_POOL_MAX
         self.collateral_pool_index_buf = collateral_pool_index.to_bytes(4, 'little')
-        self.collateral_pool_address = create_collateral_pool_address(collateral_pool_index)
+        self.collateral_pool_address = get_collateral_pool_address(collateral_pool_index)
+
+        # Accounts following the operator-specific part of every call/continue/cancel instruction
+        self.trailing_accounts = eth_accounts + [
+            AccountMeta(pubkey=sysinstruct, is_signer=False, is_writable=False),
+        ] + obligatory_accounts
+        self.continue_templates = {}
+
+    def get_continue_template(self, signer, storage):
+        key = str(storage)
+        template = self.continue_templates.get(key)
+        if template is None:
+            template = MessageTemplate(signer, make_continue_instruction(signer, storage, self, 0))
+            self.continue_templates[key] = template
+        return template
+
+
+class MessageTemplate:
+    """Compiled message of a transaction with one instruction and one signer.
+    Only the recent blockhash and the tail of the instruction data can change between sends."""
+    def __init__(self, signer, instruction):
+        trx = Transaction(recent_blockhash=TEMPLATE_BLOCKHASH, fee_payer=signer.public_key())
+        trx.add(instruction)
+        message = trx.compile_message()
+        if message.header.num_required_signatures != 1:
+            raise Exception("Message template supports only one signer")
+
+        self.signer = signer
+        self.message = message.serialize()
+        key_count = len(message.account_keys)
+        self.blockhash_offset = 3 + len(shortvec.encode_length(key_count)) + 32 * key_count
+
+    def build(self, recent_blockhash, data_tail):
+        """Return the signed wire transaction with recent_blockhash and the last bytes of the data replaced"""
+        message = bytearray(self.message)
+        message[self.blockhash_offset:self.blockhash_offset + 32] = b58decode(recent_blockhash)
+        message[len(message) - len(data_tail):] = data_tail
+        signature = self.signer.sign(bytes(message)).signature
+        return shortvec.encode_length(1) + signature + bytes(message)
+
+
+class StrategyStats:
+    """Counts how often the up-front execution strategy matched the one actually used"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, predicted, used):
+        with self.lock:
+            self.counts[(predicted, used)] = self.counts.get((predicted, used), 0) + 1
+            total = sum(self.counts.values())
+            hits = sum(count for (p, u), count in self.counts.items() if p == u)
+        logger.debug("Execution strategy predicted: %s, used: %s, hits %d of %d", predicted, used, hits, total)
+
+
+strategy_stats = StrategyStats()
 
 
 class AccountInfo(NamedTuple):
@@ -300,6 +362,23 @@ def create_collateral_pool_address(collateral_pool_index):
     return accountWithSeed(PublicKey(COLLATERAL_POOL_BASE), str.encode(seed), PublicKey(evm_loader_id))
 
 
+collateral_pool_addresses = None
+collateral_pool_lock = threading.Lock()
+
+
+def get_collateral_pool_address(collateral_pool_index):
+    global collateral_pool_addresses
+    addresses = collateral_pool_addresses
+    if addresses is None:
+        with collateral_pool_lock:
+            if collateral_pool_addresses is None:
+                # published whole, request threads never see a partly built list
+                collateral_pool_addresses = [create_collateral_pool_address(index)
+                                             for index in range(COLLATERALL_POOL_MAX)]
+            addresses = collateral_pool_addresses
+    return addresses[collateral_pool_index]
+
+
 def create_account_with_seed(client, funding, base, seed, storage_size, eth_trx=None):
     account = accountWithSeed(base.public_key(), seed, PublicKey(evm_loader_id))
 
@@ -367,6 +446,15 @@ def make_keccak_instruction_data(check_instruction_index, msg_len, data_start):
     return data
 
 
+def get_transaction_size(trx, signer):
+    """Return the exact wire size of trx signed by signer without signing or sending it."""
+    sized_trx = Transaction(recent_blockhash=SIZE_ESTIMATE_BLOCKHASH, fee_payer=signer.public_key())
+    sized_trx.add(trx)
+    message = sized_trx.compile_message().serialize()
+    signature_count = message[0]
+    return len(shortvec.encode_length(signature_count)) + signature_count * SIG_LENGTH + len(message)
+
+
 class EthereumError(Exception):
     def __init__(self, code, message, data=None):
         self.code = code
@@ -496,15 +584,12 @@ def call_emulated(contract_id, caller_id, data=None, value=None):
 
 def extract_measurements_from_receipt(receipt):
     log_messages = receipt['result']['meta']['logMessages']
-    transaction = receipt['result']['transaction']
-    accounts = transaction['message']['accountKeys']
     instructions = []
-    for instr in transaction['message']['instructions']:
-        program = accounts[instr['programIdIndex']]
+    for instr in decode_neon_receipt(receipt['result'], evm_loader_id).instructions:
         instructions.append({
-            'accs': [accounts[acc] for acc in instr['accounts']],
-            'program': accounts[instr['programIdIndex']],
-            'data': b58decode(instr['data']).hex()
+            'accs': instr.accounts,
+            'program': instr.program,
+            'data': instr.data.hex()
         })
 
     pattern = re.compile('Program ([0-9A-Za-z]+) (.*)')
@@ -558,8 +643,17 @@ def get_measurements(result):
 
 def send_transaction(client, trx, signer, eth_trx=None, reason=None):
     result = client.send_transaction(trx, signer, opts=TxOpts(skip_confirmation=True, preflight_commitment=Confirmed))
-    confirm_transaction(client, result["result"])
-    result = client.get_confirmed_transaction(result["result"])
+    return confirm_and_get_transaction(client, result["result"], eth_trx, reason)
+
+
+def send_raw_transaction(client, wire_trx, eth_trx=None, reason=None):
+    result = client.send_raw_transaction(wire_trx, opts=TxOpts(skip_confirmation=True, preflight_commitment=Confirmed))
+    return confirm_and_get_transaction(client, result["result"], eth_trx, reason)
+
+
+def confirm_and_get_transaction(client, signature, eth_trx, reason):
+    confirm_transaction(client, signature)
+    result = client.get_confirmed_transaction(signature)
     update_transaction_cost(result, eth_trx, reason=reason)
     return result
 
@@ -570,6 +664,19 @@ def send_measured_transaction(client, trx, signer, eth_trx, reason):
     return result
 
 
+def send_measured_raw_transaction(client, wire_trx, eth_trx, reason):
+    result = send_raw_transaction(client, wire_trx, eth_trx=eth_trx, reason=reason)
+    get_measurements(result)
+    return result
+
+
+def get_recent_blockhash(client):
+    blockhash_resp = client.get_recent_blockhash(commitment=Confirmed)
+    if not blockhash_resp["result"]:
+        raise RuntimeError("failed to get recent blockhash")
+    return blockhash_resp["result"]["value"]["blockhash"]
+
+
 def check_if_program_exceeded_instructions(err_result):
     err_instruction = "Program failed to complete: exceeded maximum number of instructions allowed"
     err_budget = "failed: Computational budget exceeded"
@@ -583,20 +690,8 @@ def check_if_program_exceeded_instructions(err_result):
 
 def check_if_continue_returned(result):
     tx_info = result['result']
-    accounts = tx_info["transaction"]["message"]["accountKeys"]
-    evm_loader_instructions = []
-
-    for idx, instruction in enumerate(tx_info["transaction"]["message"]["instructions"]):
-        if accounts[instruction["programIdIndex"]] == evm_loader_id:
-            evm_loader_instructions.append(idx)
-
-    for inner in (tx_info['meta']['innerInstructions']):
-        if inner["index"] in evm_loader_instructions:
-            for event in inner['instructions']:
-                if accounts[event['programIdIndex']] == evm_loader_id:
-                    instruction = base58.b58decode(event['data'])[:1]
-                    if int().from_bytes(instruction, "little") == 6:  # OnReturn evmInstruction code
-                        return (True, tx_info['transaction']['signatures'][0])
+    if decode_neon_receipt(tx_info, evm_loader_id).result is not None:
+        return (True, tx_info['transaction']['signatures'][0])
     return (False, ())
 
 
@@ -620,14 +715,14 @@ def call_continue_iterative(signer, client, perm_accs, trx_info, step_count):
 
 
 def sol_instr_10_continue(signer, client, perm_accs, trx_info, initial_step_count):
+    template = trx_info.get_continue_template(signer, perm_accs.storage)
     step_count = initial_step_count
     while step_count > 0:
-        trx = Transaction()
-        trx.add(make_continue_instruction(signer, perm_accs, trx_info, step_count))
+        wire_trx = template.build(get_recent_blockhash(client), step_count.to_bytes(8, byteorder="little"))
 
         logger.debug("Step count {}".format(step_count))
         try:
-            result = send_measured_transaction(client, trx, signer, trx_info.eth_trx, 'ContinueV02')
+            result = send_measured_raw_transaction(client, wire_trx, trx_info.eth_trx, 'ContinueV02')
             return result
         except SendTransactionError as err:
             if check_if_program_exceeded_instructions(err.result):
@@ -638,8 +733,7 @@ def sol_instr_10_continue(signer, client, perm_accs, trx_info, initial_step_coun
 
 
 def sol_instr_21_cancel(signer, client, perm_accs, trx_info):
-    operator = signer.public_key()
-    operator_token = getTokenAddr(operator)
+    (operator, operator_token) = get_operator_accounts(signer)
 
     trx = Transaction()
     trx.add(TransactionInstruction(
@@ -653,10 +747,7 @@ def sol_instr_21_cancel(signer, client, perm_accs, trx_info):
             AccountMeta(pubkey=incinerator, is_signer=False, is_writable=True),
             AccountMeta(pubkey=system, is_signer=False, is_writable=False),
 
-        ] + trx_info.eth_accounts + [
-
-            AccountMeta(pubkey=sysinstruct, is_signer=False, is_writable=False),
-        ] + obligatory_accounts
+        ] + trx_info.trailing_accounts
     ))
 
     logger.debug("Cancel")
@@ -664,15 +755,14 @@ def sol_instr_21_cancel(signer, client, perm_accs, trx_info):
     return result['result']['transaction']['signatures'][0]
 
 
-def make_partial_call_instruction(signer, perm_accs, trx_info, step_count, call_data):
-    operator = signer.public_key()
-    operator_token = getTokenAddr(operator)
+def make_partial_call_instruction(signer, storage, trx_info, step_count, call_data):
+    (operator, operator_token) = get_operator_accounts(signer)
 
     return TransactionInstruction(
         program_id = evm_loader_id,
         data = bytearray.fromhex("13") + trx_info.collateral_pool_index_buf + step_count.to_bytes(8, byteorder="little") + call_data,
         keys = [
-            AccountMeta(pubkey=perm_accs.storage, is_signer=False, is_writable=True),
+            AccountMeta(pubkey=storage, is_signer=False, is_writable=True),
 
             AccountMeta(pubkey=sysinstruct, is_signer=False, is_writable=False),
             AccountMeta(pubkey=operator, is_signer=True, is_writable=True),
@@ -681,16 +771,12 @@ def make_partial_call_instruction(signer, perm_accs, trx_info, step_count, call_
             AccountMeta(pubkey=trx_info.caller_token, is_signer=False, is_writable=True),
             AccountMeta(pubkey=system, is_signer=False, is_writable=False),
 
-        ] + trx_info.eth_accounts + [
-
-            AccountMeta(pubkey=sysinstruct, is_signer=False, is_writable=False),
-        ] + obligatory_accounts
+        ] + trx_info.trailing_accounts
         )
 
 
-def make_continue_instruction(signer, perm_accs, trx_info, step_count, index=None):
-    operator = signer.public_key()
-    operator_token = getTokenAddr(operator)
+def make_continue_instruction(signer, storage, trx_info, step_count, index=None):
+    (operator, operator_token) = get_operator_accounts(signer)
 
     data = bytearray.fromhex("14") + trx_info.collateral_pool_index_buf + step_count.to_bytes(8, byteorder="little")
     if index:
@@ -700,7 +786,7 @@ def make_continue_instruction(signer, perm_accs, trx_info, step_count, index=Non
         program_id = evm_loader_id,
         data = data,
         keys = [
-            AccountMeta(pubkey=perm_accs.storage, is_signer=False, is_writable=True),
+            AccountMeta(pubkey=storage, is_signer=False, is_writable=True),
 
             AccountMeta(pubkey=operator, is_signer=True, is_writable=True),
             AccountMeta(pubkey=trx_info.collateral_pool_address, is_signer=False, is_writable=True),
@@ -708,16 +794,12 @@ def make_continue_instruction(signer, perm_accs, trx_info, step_count, index=Non
             AccountMeta(pubkey=trx_info.caller_token, is_signer=False, is_writable=True),
             AccountMeta(pubkey=system, is_signer=False, is_writable=False),
 
-        ] + trx_info.eth_accounts + [
-
-            AccountMeta(pubkey=sysinstruct, is_signer=False, is_writable=False),
-        ] + obligatory_accounts
+        ] + trx_info.trailing_accounts
     )
 
 
 def make_call_from_account_instruction(signer, perm_accs, trx_info, step_count = 0):
-    operator = signer.public_key()
-    operator_token = getTokenAddr(operator)
+    (operator, operator_token) = get_operator_accounts(signer)
 
     return TransactionInstruction(
         program_id = evm_loader_id,
@@ -732,16 +814,12 @@ def make_call_from_account_instruction(signer, perm_accs, trx_info, step_count =
             AccountMeta(pubkey=trx_info.caller_token, is_signer=False, is_writable=True),
             AccountMeta(pubkey=system, is_signer=False, is_writable=False),
 
-        ] + trx_info.eth_accounts + [
-
-            AccountMeta(pubkey=sysinstruct, is_signer=False, is_writable=False),
-        ] + obligatory_accounts
+        ] + trx_info.trailing_accounts
     )
 
 
 def make_05_call_instruction(signer, trx_info, call_data):
-    operator = signer.public_key()
-    operator_token = getTokenAddr(operator)
+    (operator, operator_token) = get_operator_accounts(signer)
 
     return TransactionInstruction(
         program_id = evm_loader_id,
@@ -770,22 +848,8 @@ def update_transaction_cost(receipt, eth_trx, extra_sol_trx=False, reason=None):
         to_address = None
 
     sig = receipt['result']['transaction']['signatures'][0]
-    used_gas=None
-
-    tx_info = receipt['result']
-    accounts = tx_info["transaction"]["message"]["accountKeys"]
-    evm_loader_instructions = []
-
-    for idx, instruction in enumerate(tx_info["transaction"]["message"]["instructions"]):
-        if accounts[instruction["programIdIndex"]] == evm_loader_id:
-            evm_loader_instructions.append(idx)
-
-    for inner in (tx_info['meta']['innerInstructions']):
-        if inner["index"] in evm_loader_instructions:
-            for event in inner['instructions']:
-                if accounts[event['programIdIndex']] == evm_loader_id:
-                    used_gas = base58.b58decode(event['data'])[2:10]
-                    used_gas = int().from_bytes(used_gas, "little")
+    neon_result = decode_neon_receipt(receipt['result'], evm_loader_id).result
+    used_gas = neon_result.gas_used if neon_result else None
 
     table = CostSingleton().operator_cost
     table.insert(
@@ -801,13 +865,14 @@ def update_transaction_cost(receipt, eth_trx, extra_sol_trx=False, reason=None):
 
 
 def create_account_list_by_emulate(signer, client, eth_trx):
+    global steps_executed_missing
     sender_ether = bytes.fromhex(eth_trx.sender())
     add_keys_05 = []
     trx = Transaction()
 
     if not eth_trx.toAddress:
         to_address_arg = "deploy"
-        to_address = keccak_256(rlp.encode((bytes.fromhex(eth_trx.sender()), eth_trx.nonce))).digest()[-20:]
+        to_address = keccak_256(rlp.encode((sender_ether, eth_trx.nonce))).digest()[-20:]
     else:
         to_address_arg = eth_trx.toAddress.hex()
         to_address = eth_trx.toAddress
@@ -933,71 +998,108 @@ def create_account_list_by_emulate(signer, client, eth_trx):
             AccountMeta(pubkey=caller_token, is_signer=False, is_writable=True),
         ] + add_keys_05
 
-    trx_info = TransactionInfo(caller_token, eth_accounts, eth_trx)
+    # reported by neon-cli emulate of the evm_loader image in use, older releases do not report it
+    steps_executed = output_json.get("steps_executed")
+    if steps_executed is None and not steps_executed_missing:
+        steps_executed_missing = True
+        logger.warning("Emulator returns no steps_executed, the execution strategy is chosen by transaction size only")
+    trx_info = TransactionInfo(caller_token, eth_accounts, eth_trx, steps_executed)
 
     return trx_info, sender_ether, trx
 
 
+def select_execution_strategy(signer, eth_trx, trx_info, msg, create_acc_trx):
+    """Choose single/iterative/holder execution before anything is sent,
+    from the emulator step count and the exact size of the transactions to be built"""
+    if not eth_trx.toAddress:
+        return STRATEGY_HOLDER
+
+    steps_executed = trx_info.steps_executed
+    # without the step count a single trx is tried whenever it fits, call_signed falls back on the budget error
+    if steps_executed is None or steps_executed <= SINGLE_TRX_STEP_LIMIT:
+        single_trx = make_noniterative_call_trx(signer, eth_trx, trx_info, msg, create_acc_trx)
+        single_size = get_transaction_size(single_trx, signer)
+        logger.debug("Single trx size %d, emulated steps %s", single_size, steps_executed)
+        if single_size <= PACKET_DATA_SIZE:
+            return STRATEGY_SINGLE
+
+    partial_call_trx = make_partial_call_trx(signer, SIZE_ESTIMATE_STORAGE, eth_trx, trx_info, msg)
+    partial_call_size = get_transaction_size(partial_call_trx, signer)
+    logger.debug("Partial call trx size %d", partial_call_size)
+    if partial_call_size <= PACKET_DATA_SIZE:
+        return STRATEGY_ITERATIVE
+
+    return STRATEGY_HOLDER
+
+
 def call_signed(signer, client, eth_trx, steps):
 
     (trx_info, sender_ether, create_acc_trx) = create_account_list_by_emulate(signer, client, eth_trx)
+    msg = sender_ether + eth_trx.signature() + eth_trx.unsigned_msg()
 
-    call_iterative = False
-    call_from_holder = False
-
-    if not eth_trx.toAddress:
-        call_from_holder = True
-    else:
-        msg = sender_ether + eth_trx.signature() + eth_trx.unsigned_msg()
+    predicted = select_execution_strategy(signer, eth_trx, trx_info, msg, create_acc_trx)
+    strategy = predicted
+    logger.debug("Selected execution strategy: %s", strategy)
 
+    if strategy == STRATEGY_SINGLE:
         try:
             logger.debug("Try single trx call")
-            return call_signed_noniterative(signer, client, eth_trx, trx_info, msg, create_acc_trx)
+            signature = call_signed_noniterative(signer, client, eth_trx, trx_info, msg, create_acc_trx)
+            strategy_stats.record(predicted, strategy)
+            return signature
         except Exception as err:
             logger.debug(str(err))
             errStr = str(err)
             if "Program failed to complete" in errStr or "Computational budget exceeded" in errStr:
                 logger.debug("Program exceeded instructions")
-                call_iterative = True
+                strategy = STRATEGY_ITERATIVE
             elif str(err).startswith("transaction too large:"):
                 logger.debug("Transaction too large, call call_signed_with_holder_acc():")
-                call_from_holder = True
+                strategy = STRATEGY_HOLDER
             else:
                 raise
 
     perm_accs = PermanentAccounts(client, signer)
     try:
-        if call_iterative:
+        if strategy == STRATEGY_ITERATIVE:
             try:
-                return call_signed_iterative(signer, client, eth_trx, perm_accs, trx_info, steps, msg, create_acc_trx)
+                signature = call_signed_iterative(signer, client, eth_trx, perm_accs, trx_info, steps, msg, create_acc_trx)
+                strategy_stats.record(predicted, strategy)
+                return signature
             except Exception as err:
                 logger.debug(str(err))
                 if str(err).startswith("transaction too large:"):
                     logger.debug("Transaction too large, call call_signed_with_holder_acc():")
-                    call_from_holder = True
+                    strategy = STRATEGY_HOLDER
                 else:
                     raise
 
-        if call_from_holder:
-            return call_signed_with_holder_acc(signer, client, eth_trx, perm_accs, trx_info, steps, create_acc_trx)
+        signature = call_signed_with_holder_acc(signer, client, eth_trx, perm_accs, trx_info, steps, create_acc_trx)
+        strategy_stats.record(predicted, strategy)
+        return signature
     finally:
         del perm_accs
 
 
+def make_partial_call_trx(signer, storage, eth_trx, trx_info, msg):
+    trx = Transaction()
+    trx.add(TransactionInstruction(
+        program_id=keccakprog,
+        data=make_keccak_instruction_data(len(trx.instructions)+1, len(eth_trx.unsigned_msg()), data_start=13),
+        keys=[
+            AccountMeta(pubkey=keccakprog, is_signer=False, is_writable=False),
+        ]))
+    trx.add(make_partial_call_instruction(signer, storage, trx_info, 0, msg))
+    return trx
+
+
 def call_signed_iterative(signer, client, eth_trx, perm_accs, trx_info, steps, msg, create_acc_trx):
     if len(create_acc_trx.instructions):
         precall_txs = Transaction()
         precall_txs.add(create_acc_trx)
         send_measured_transaction(client, precall_txs, signer, eth_trx, 'CreateAccountsForTrx')
 
-    precall_txs = Transaction()
-    precall_txs.add(TransactionInstruction(
-        program_id=keccakprog,
-        data=make_keccak_instruction_data(len(precall_txs.instructions)+1, len(eth_trx.unsigned_msg()), data_start=13),
-        keys=[
-            AccountMeta(pubkey=keccakprog, is_signer=False, is_writable=False),
-        ]))
-    precall_txs.add(make_partial_call_instruction(signer, perm_accs, trx_info, 0, msg))
+    precall_txs = make_partial_call_trx(signer, perm_accs.storage, eth_trx, trx_info, msg)
 
     logger.debug("Partial call")
     send_measured_transaction(client, precall_txs, signer, eth_trx, 'PartialCallFromRawEthereumTXv02')
@@ -1005,7 +1107,7 @@ def call_signed_iterative(signer, client, eth_trx, perm_accs, trx_info, steps, m
     return call_continue(signer, client, perm_accs, trx_info, steps)
 
 
-def call_signed_noniterative(signer, client, eth_trx, trx_info, msg, create_acc_trx):
+def make_noniterative_call_trx(signer, eth_trx, trx_info, msg, create_acc_trx):
     call_txs_05 = Transaction()
     call_txs_05.add(create_acc_trx)
     call_txs_05.add(TransactionInstruction(
@@ -1015,6 +1117,11 @@ def call_signed_noniterative(signer, client, eth_trx, trx_info, msg, create_acc_
             AccountMeta(pubkey=keccakprog, is_signer=False, is_writable=False),
         ]))
     call_txs_05.add(make_05_call_instruction(signer, trx_info, msg))
+    return call_txs_05
+
+
+def call_signed_noniterative(signer, client, eth_trx, trx_info, msg, create_acc_trx):
+    call_txs_05 = make_noniterative_call_trx(signer, eth_trx, trx_info, msg, create_acc_trx)
     result = send_measured_transaction(client, call_txs_05, signer, eth_trx, 'CallFromRawEthereumTX')
     return result['result']['transaction']['signatures'][0]
 
@@ -1152,8 +1259,7 @@ def make_create_eth_account_trx(signer: SolanaAccount, eth_address: EthereumAddr
 
 
 def make_transfer_instruction(owner_pda_account: SolanaAccount, associated_token_account: PublicKey) -> TransactionInstruction:
-    owner_pda_address = owner_pda_account.public_key()
-    owner_associated_token_account = getTokenAddr(owner_pda_address)
+    (owner_pda_address, owner_associated_token_account) = get_operator_accounts(owner_pda_account)
     transfer_instruction = transfer2(Transfer2Params(source=owner_associated_token_account,
                                                      owner=owner_pda_address,
                                                      dest=associated_token_account,
@@ -1175,14 +1281,116 @@ def extend_trx_with_create_and_airdrop(signer: SolanaAccount, eth_account: Ether
     trx.add(transfer_instruction)
 
 
+class AccountCreationQueue:
+    """Gathers create-account (and airdrop) requests from all threads of the process
+    and packs as many of them as fit into one Solana transaction per CREATE_ACCOUNT_BATCH_WINDOW."""
+    def __init__(self, client: SolanaClient, signer: SolanaAccount):
+        self.client = client
+        self.signer = signer
+        self.lock = threading.Lock()
+        self.pending: Dict[str, Tuple[EthereumAddress, Future]] = {}
+        self.has_pending = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="AccountCreationQueue", daemon=True)
+        self.thread.start()
+
+    def submit(self, eth_account: EthereumAddress) -> Future:
+        """Return the future of the transaction creating eth_account, requests for one account are merged"""
+        key = str(eth_account)
+        with self.lock:
+            request = self.pending.get(key)
+            if request is None:
+                request = (eth_account, Future())
+                self.pending[key] = request
+                self.has_pending.set()
+        return request[1]
+
+    def run(self):
+        while True:
+            requests = []
+            try:
+                self.has_pending.wait()
+                time.sleep(CREATE_ACCOUNT_BATCH_WINDOW)
+                with self.lock:
+                    requests = list(self.pending.values())
+                    self.pending = {}
+                    self.has_pending.clear()
+
+                requests = [(eth_account, future) for eth_account, future in requests
+                            if future.set_running_or_notify_cancel()]
+                while len(requests):
+                    requests = self.send_batch(requests)
+            except Exception as err:
+                # the callers get the error at once instead of waiting for CREATE_ACCOUNT_TIMEOUT,
+                # the thread goes on serving the next requests
+                logger.error("Failed to create eth accounts: %s", err)
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(err)
+
+    def send_batch(self, requests):
+        """Send the requests which fit into one transaction, return the rest"""
+        trx = Transaction()
+        packed = []
+        consumed = 0
+        for eth_account, future in requests:
+            try:
+                account_trx = Transaction()
+                extend_trx_with_create_and_airdrop(self.signer, eth_account, trx=account_trx)
+            except Exception as err:
+                future.set_exception(err)
+                consumed += 1
+                continue
+            candidate = Transaction().add(trx, account_trx)
+            if len(packed) and get_transaction_size(candidate, self.signer) > PACKET_DATA_SIZE:
+                break
+            trx = candidate
+            packed.append((eth_account, future))
+            consumed += 1
+
+        rest = requests[consumed:]
+        if not len(packed):
+            return rest
+
+        logger.debug("Create %d eth accounts in one transaction: %s", len(packed), [str(acc) for acc, _ in packed])
+        try:
+            result = send_transaction(self.client, trx, self.signer, reason='CreateAccountsBatch')
+            error = result.get("error")
+            if error is not None:
+                raise Exception(f"error occurred: {error}")
+        except Exception as err:
+            if len(packed) > 1:
+                # one already created or broken account must not fail the others
+                logger.debug("Batch account creation failed: %s, retry one by one", err)
+                for request in packed:
+                    self.send_batch([request])
+                return rest
+            for eth_account, future in packed:
+                logger.error(f"Failed to create eth_account and airdrop: {eth_account}, {err}")
+                future.set_exception(Exception("Create eth_account error"))
+            return rest
+
+        for _, future in packed:
+            future.set_result(result)
+        return rest
+
+
+account_creation_queues_lock = threading.Lock()
+account_creation_queues: Dict[str, AccountCreationQueue] = {}
+
+
+def get_account_creation_queue(client: SolanaClient, signer: SolanaAccount) -> AccountCreationQueue:
+    key = str(signer.public_key())
+    with account_creation_queues_lock:
+        queue = account_creation_queues.get(key)
+        if queue is None:
+            queue = AccountCreationQueue(client, signer)
+            account_creation_queues[key] = queue
+        return queue
+
+
 def create_eth_account_and_airdrop(client: SolanaClient, signer: SolanaAccount, eth_account: EthereumAddress):
-    trx = Transaction()
-    extend_trx_with_create_and_airdrop(signer, eth_account, trx=trx)
-    result = send_transaction(client, trx, signer)
-    error = result.get("error")
-    if error is not None:
-        logger.error(f"Failed to create eth_account and airdrop: {eth_account}, error occurred: {error}")
-        raise Exception("Create eth_account error")
+    future = get_account_creation_queue(client, signer).submit(eth_account)
+    future.result(timeout=CREATE_ACCOUNT_TIMEOUT)
 
 
 def get_token_balance_gwei(client: SolanaClient, pda_account: str) -> int:
@@ -1220,6 +1428,20 @@ def getTokenAddr(account):
     return get_associated_token_address(PublicKey(account), ETH_TOKEN_MINT_ID)
 
 
+operator_accounts = {}
+
+
+def get_operator_accounts(signer):
+    """Return (operator, operator_token), the token address is derived once per operator"""
+    operator = signer.public_key()
+    key = str(operator)
+    accounts = operator_accounts.get(key)
+    if accounts is None:
+        accounts = (operator, getTokenAddr(operator))
+        operator_accounts[key] = accounts
+    return accounts
+
+
 def make_instruction_data_from_tx(instruction, private_key=None):
     if isinstance(instruction, dict):
         if instruction.get('chainId') is None:
@@ -0,0 +1,82 @@
+import unittest
+from unittest import mock
+from solana.account import Account as SolanaAccount
+from solana.publickey import PublicKey
+from solana.transaction import TransactionInstruction
+from ..plugin import solana_rest_api_tools
+from ..plugin.solana_rest_api_tools import AccountCreationQueue, EthereumAddress
+
+# bytes an account request adds to the transaction, PACKET_DATA_SIZE fits three
+ACCOUNT_SIZE = 400
+
+
+def extend_trx(signer, eth_account, code_acc=None, *, trx):
+    trx.add(TransactionInstruction(keys=[], program_id=PublicKey(1), data=bytes(eth_account.data)))
+
+
+def transaction_size(trx, signer):
+    return ACCOUNT_SIZE * len(trx.instructions)
+
+
+class TestAccountCreationQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.patches = [
+            mock.patch.object(solana_rest_api_tools, 'extend_trx_with_create_and_airdrop', side_effect=extend_trx),
+            mock.patch.object(solana_rest_api_tools, 'get_transaction_size', side_effect=transaction_size),
+            mock.patch.object(solana_rest_api_tools, 'send_transaction', side_effect=self.send_transaction),
+            # wide enough for all the submits of a test to land in one window
+            mock.patch.object(solana_rest_api_tools, 'CREATE_ACCOUNT_BATCH_WINDOW', 0.2),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.queue = AccountCreationQueue(client=None, signer=SolanaAccount())
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def send_transaction(self, client, trx, signer, reason=None):
+        self.sent.append(len(trx.instructions))
+        return {'result': 'signature{}'.format(len(self.sent))}
+
+    def submit(self, count):
+        return [self.queue.submit(EthereumAddress(bytes([idx]) * 20)) for idx in range(count)]
+
+    def test_batching(self):
+        futures = self.submit(2)
+        # requests for one account are merged
+        self.assertIs(self.queue.submit(EthereumAddress(bytes([0]) * 20)), futures[0])
+        self.assertEqual([future.result(timeout=5) for future in futures], [{'result': 'signature1'}] * 2)
+        self.assertEqual(self.sent, [2])
+
+    def test_size_split(self):
+        futures = self.submit(5)
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(self.sent, [3, 2])
+
+    def test_error_propagation(self):
+        def extend_or_fail(signer, eth_account, code_acc=None, *, trx):
+            if eth_account.data[0] == 1:
+                raise ValueError("bad account")
+            extend_trx(signer, eth_account, trx=trx)
+
+        with mock.patch.object(solana_rest_api_tools, 'extend_trx_with_create_and_airdrop', side_effect=extend_or_fail):
+            futures = self.submit(3)
+            self.assertRaises(ValueError, futures[1].result, timeout=5)
+            futures[0].result(timeout=5)
+            futures[2].result(timeout=5)
+
+        with mock.patch.object(solana_rest_api_tools, 'get_transaction_size', side_effect=RuntimeError("no size")):
+            futures = self.submit(2)
+            for future in futures:
+                self.assertRaises(RuntimeError, future.result, timeout=5)
+
+        # the queue thread survived
+        self.assertEqual(self.submit(1)[0].result(timeout=5), {'result': 'signature{}'.format(len(self.sent))})
+
+
+if __name__ == '__main__':
+    unittest.main()
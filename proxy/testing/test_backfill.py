@@ -0,0 +1,118 @@
+import os
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from ..indexer import backfill
+from ..indexer.backfill import BackfillIndexer, BackfillLeases, Lease, cut_ranges, OPEN, DONE, MERGED, \
+    BACKFILL_MAX_ATTEMPTS
+from ..indexer.sql_backend import SQLiteBackend
+
+
+class TestCutRanges(unittest.TestCase):
+
+    def test_ranges_do_not_split_slots(self):
+        signatures = [('s9', 30), ('s8', 30), ('s7', 29), ('s6', 27), ('s5', 27), ('s4', 27), ('s3', 20), ('s2', 11)]
+        leases = cut_ranges(signatures, 2, 'start')
+        self.assertEqual(leases, [
+            Lease(30, 30, 's9', 's7'),
+            Lease(21, 29, 's7', 's3'),
+            Lease(11, 20, 's3', 'start'),
+        ])
+
+
+class TestBackfillLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.leases = BackfillLeases(backend=SQLiteBackend(os.path.join(self.tmp.name, 'test.sqlite')))
+        self.leases.create([Lease(21, 30, 's9', 's3'), Lease(11, 20, 's3', None)])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_claim(self):
+        first = self.leases.claim('worker1')
+        second = self.leases.claim('worker2')
+        self.assertEqual(first, Lease(11, 20, 's3', None))
+        self.assertEqual(second, Lease(21, 30, 's9', 's3'))
+        self.assertIsNone(self.leases.claim('worker3'))
+
+        self.assertFalse(self.leases.renew(first, 'worker2'))
+        self.assertTrue(self.leases.renew(first, 'worker1'))
+        self.assertTrue(self.leases.complete(first, 'worker1', {'pending_trxs': {}, 'holders': {}}))
+        self.leases.release(second, 'worker2')
+        self.assertEqual(self.leases.claim('worker3'), second)
+
+        self.leases.set_merged(first)
+        statuses = [(lease.start_slot, status, state) for (lease, status, state) in self.leases.ranges()]
+        self.assertEqual(statuses, [(11, MERGED, {'pending_trxs': {}, 'holders': {}}), (21, OPEN, None)])
+
+    def test_expired_lease(self):
+        lease = self.leases.claim('worker1', timeout=-1)
+        self.assertEqual(self.leases.claim('worker2'), lease)
+        self.assertFalse(self.leases.complete(lease, 'worker1', {}))
+        self.assertTrue(self.leases.complete(lease, 'worker2', {}))
+        self.assertEqual([status for (_, status, _) in self.leases.ranges()], [DONE, OPEN])
+
+    def test_failed_range_backs_off(self):
+        first = self.leases.claim('worker1')
+        self.assertEqual(self.leases.fail(first, 'worker1', retry_delay=60), 1)
+        # the other range goes first, the failed one waits for its backoff
+        self.assertEqual(self.leases.claim('worker2'), Lease(21, 30, 's9', 's3'))
+        self.assertIsNone(self.leases.claim('worker3'))
+        self.assertGreater(self.leases.next_retry('worker1'), time.time() + 50)
+        self.assertIsNone(self.leases.next_retry('worker2'))
+
+        self.assertEqual(self.leases.fail(first, 'worker1', retry_delay=-1), 2)
+        self.assertIsNone(self.leases.claim('worker3', max_attempts=2))
+        self.assertEqual(self.leases.claim('worker3'), first)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestBackfillWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.leases = BackfillLeases(backend=SQLiteBackend(os.path.join(self.tmp.name, 'test.sqlite')))
+        self.leases.create([Lease(21, 30, 's9', 's3'), Lease(11, 20, 's3', None)])
+        self.indexed = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def work(self, failures):
+        """Run a worker whose first failures[start_slot] attempts of a range fail"""
+        def index_range(lease):
+            self.indexed.append(lease.start_slot)
+            if self.indexed.count(lease.start_slot) <= failures.get(lease.start_slot, 0):
+                raise RuntimeError("block {} is not available".format(lease.start_slot))
+            return {'pending_trxs': {}, 'holders': {}}
+
+        worker = SimpleNamespace(leases=self.leases, owner='worker1', index_range=index_range)
+        with mock.patch.object(backfill, 'time', FakeClock()):
+            BackfillIndexer.work(worker)
+        return [status for (_, status, _) in self.leases.ranges()]
+
+    def test_retry_after_other_ranges(self):
+        self.assertEqual(self.work({11: 2}), [DONE, DONE])
+        self.assertEqual(self.indexed, [11, 21, 11, 11])
+
+    def test_failing_range_is_given_up(self):
+        self.assertEqual(self.work({11: BACKFILL_MAX_ATTEMPTS + 1}), [OPEN, DONE])
+        self.assertEqual(self.indexed, [11, 21] + [11] * (BACKFILL_MAX_ATTEMPTS - 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+from ..indexer.sql_dict import CachedSQLDict
+
+
+class FakeTable(dict):
+    """In-memory stand-in for SQLDict that counts reads"""
+    tablename = 'fake'
+
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+        # called after each read, before its result gets to the cache
+        self.after_read = None
+
+    def __getitem__(self, key):
+        self.reads += 1
+        try:
+            return super().__getitem__(key)
+        finally:
+            self.read_done()
+
+    def get_many(self, keys):
+        self.reads += 1
+        found = {key: super(FakeTable, self).__getitem__(key) for key in keys if key in self}
+        self.read_done()
+        return found
+
+    def read_done(self):
+        if self.after_read is not None:
+            (after_read, self.after_read) = (self.after_read, None)
+            after_read()
+
+    def set_many(self, items):
+        self.update(items)
+
+
+class TestCachedSQLDict(unittest.TestCase):
+
+    def test_read_through_and_lru(self):
+        table = FakeTable()
+        table.update({'a': 1, 'b': 2, 'c': 3})
+        cache = CachedSQLDict(table, max_size=2)
+
+        self.assertEqual(cache['a'], 1)
+        self.assertEqual(cache['a'], 1)
+        self.assertEqual(table.reads, 1)
+        self.assertEqual(cache['b'], 2)
+        self.assertEqual(cache['c'], 3)    # evicts 'a'
+        self.assertEqual(cache['a'], 1)
+        self.assertEqual(table.reads, 4)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_negative_ttl(self):
+        table = FakeTable()
+        cache = CachedSQLDict(table, max_size=10, negative_ttl=60)
+        self.assertIsNone(cache.get('x'))
+        table['x'] = 1
+        self.assertIsNone(cache.get('x'))
+        self.assertEqual(cache.stats()['negative_hits'], 1)
+        cache.invalidate('x')
+        self.assertEqual(cache.get('x'), 1)
+
+    def test_write_through(self):
+        table = FakeTable()
+        cache = CachedSQLDict(table, max_size=10, negative_ttl=60)
+        self.assertNotIn('x', cache)
+        cache['x'] = 1
+        cache.set_many({'y': 2})
+        self.assertEqual(table, {'x': 1, 'y': 2})
+        reads = table.reads
+        self.assertEqual(cache.get_many(['x', 'y']), {'x': 1, 'y': 2})
+        self.assertEqual(table.reads, reads)
+
+    def test_invalidation_during_read(self):
+        table = FakeTable()
+        cache = CachedSQLDict(table, max_size=10, negative_ttl=60)
+
+        def commit(value):
+            # the indexer commits and notifies between the SQL read and the fill
+            table['x'] = value
+            cache.invalidate('x')
+
+        table.after_read = lambda: commit('indexed')
+        self.assertIsNone(cache.get('x'))
+        # no negative entry hides the indexed row
+        self.assertEqual(cache.get('x'), 'indexed')
+
+        cache.invalidate('x')
+        table.after_read = lambda: commit('rolled back')
+        self.assertEqual(cache.get_many(['x', 'y']), {'x': 'indexed'})
+        # the stale value did not overwrite the invalidation
+        self.assertEqual(cache.get_many(['x']), {'x': 'rolled back'})
+
+    def test_invalidated_keys_are_bounded(self):
+        table = FakeTable()
+        table.update({'a': 1, 'b': 2, 'c': 3})
+        cache = CachedSQLDict(table, max_size=2)
+        for key in 'abc':
+            cache.invalidate(key)
+        self.assertEqual(list(cache.invalidated), ['b', 'c'])
+        self.assertEqual(cache['a'], 1)
+        self.assertEqual(cache['a'], 1)
+        self.assertEqual(table.reads, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
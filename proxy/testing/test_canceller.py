@@ -0,0 +1,53 @@
+import base64
+import unittest
+from solana.publickey import PublicKey
+from ..indexer.utils import get_account_lists, STORAGE_ACCOUNT_INFO_LAYOUT, MULTIPLE_ACCOUNTS_BATCH
+
+
+def storage_data(accounts):
+    header = STORAGE_ACCOUNT_INFO_LAYOUT.build(dict(
+        caller=bytes(20), nonce=0, gas_limit=0, gas_price=0, slot=0, operator=bytes(32),
+        accounts_len=len(accounts), executor_data_size=0, evm_data_size=0, gas_used_and_paid=0,
+        number_of_payments=0, sign=bytes(65)))
+    return bytes([3]) + header + b''.join(bytes(PublicKey(acc)) for acc in accounts)
+
+
+class FakeProvider:
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.requests = []
+
+    def make_request(self, method, keys, opts):
+        self.requests.append((method, keys))
+        return {'result': {'value': [
+            None if self.accounts.get(key) is None else {'data': [base64.b64encode(self.accounts[key]).decode(), 'base64']}
+            for key in keys]}}
+
+
+class FakeClient:
+    def __init__(self, accounts):
+        self._provider = FakeProvider(accounts)
+
+
+class TestCanceller(unittest.TestCase):
+
+    def test_get_account_lists(self):
+        locked = [str(PublicKey(i + 1)) for i in range(3)]
+        storages = [str(PublicKey((1000 + i).to_bytes(32, 'little'))) for i in range(MULTIPLE_ACCOUNTS_BATCH + 2)]
+        accounts = {storage: bytes([0]) + bytes(100) for storage in storages}
+        accounts[storages[0]] = storage_data(locked)
+        accounts[storages[-1]] = storage_data(locked[:1])
+        del accounts[storages[1]]
+
+        client = FakeClient(accounts)
+        acc_lists = get_account_lists(client, storages)
+        self.assertEqual([method for method, _ in client._provider.requests], ['getMultipleAccounts'] * 2)
+        self.assertEqual(acc_lists[storages[0]], locked)
+        self.assertEqual(acc_lists[storages[-1]], locked[:1])
+        # missing storages are left out, emptied ones are None
+        self.assertNotIn(storages[1], acc_lists)
+        self.assertIsNone(acc_lists[storages[2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
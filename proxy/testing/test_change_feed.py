@@ -0,0 +1,61 @@
+import json
+import unittest
+from ..indexer.change_feed import ChangePublisher, ChangeListener, CHANGE_CHANNEL, CHANGE_HASHES_PER_NOTIFY
+
+
+class RecordingBackend:
+    def __init__(self):
+        self.notifications = []
+
+    def notify(self, channel, payload):
+        self.notifications.append((channel, json.loads(payload)))
+
+
+class TestChangeFeed(unittest.TestCase):
+
+    def test_publish(self):
+        backend = RecordingBackend()
+        publisher = ChangePublisher(backend, enabled=True)
+        hashes = ['0x{:064x}'.format(i) for i in range(CHANGE_HASHES_PER_NOTIFY + 1)]
+        for (slot, eth_signature) in enumerate(hashes):
+            publisher.transaction(eth_signature, 1000 + slot, has_logs=slot in (5, 7))
+        publisher.rollback('0xdead')
+        publisher.indexed_slot(2000)
+        publisher.flush()
+
+        self.assertTrue(all(channel == CHANGE_CHANNEL for (channel, _) in backend.notifications))
+        changes = [change for (_, change) in backend.notifications]
+        self.assertEqual(changes, [
+            {'kind': 'trx', 'hashes': hashes[:CHANGE_HASHES_PER_NOTIFY]},
+            {'kind': 'trx', 'hashes': hashes[CHANGE_HASHES_PER_NOTIFY:]},
+            {'kind': 'rollback', 'hashes': ['0xdead']},
+            {'kind': 'logs', 'from': 1005, 'to': 1007},
+            {'kind': 'slot', 'slot': 2000},
+        ])
+
+        # flushed changes are not published again
+        publisher.flush()
+        self.assertEqual(len(backend.notifications), 5)
+
+    def test_disabled(self):
+        backend = RecordingBackend()
+        publisher = ChangePublisher(backend, enabled=False)
+        publisher.transaction('0x01', 10, has_logs=True)
+        publisher.flush()
+        self.assertEqual(backend.notifications, [])
+        self.assertEqual(publisher.changes(), [])
+
+    def test_dispatch_errors(self):
+        received = []
+
+        def callback(change):
+            received.append(change)
+            raise KeyError('hashes')
+
+        listener = ChangeListener(callback)
+        listener.dispatch({'kind': 'trx'})
+        self.assertEqual(received, [{'kind': 'trx'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
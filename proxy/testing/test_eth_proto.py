@@ -0,0 +1,35 @@
+import unittest
+from eth_account import Account
+from sha3 import keccak_256
+from ..plugin.eth_proto import Trx
+
+RAW_TRX = (
+    'f8730a85174876e800825208948d900bfa2353548a4631be870f99939575551b608906aaf7c8516d0c0000808602e92be91e'
+    '86a040a2a5d73931f66185e8526f09c4d0dc1f389c1b9fcd5e37a012839e6c5c70f0a00554615806c3fa7dc7c8096b3bfed5'
+    'a29354045e56982bdf3ee11f649e53d51e'
+)
+
+
+class TestEthProtoTrx(unittest.TestCase):
+
+    def test_decode_once(self):
+        raw = bytes.fromhex(RAW_TRX)
+        trx = Trx.fromString(bytearray(raw))
+
+        self.assertEqual(trx.nonce, 10)
+        self.assertEqual(trx.toAddress.hex(), '8d900bfa2353548a4631be870f99939575551b60')
+        self.assertEqual(trx.hash_signed(), keccak_256(raw).digest())
+        self.assertEqual(trx.unsigned_msg_hash(), keccak_256(trx.unsigned_msg()).digest())
+        self.assertEqual('0x' + trx.sender(), Account.recover_transaction(raw).lower())
+        self.assertEqual(len(trx.signature()), 65)
+
+        # results are computed once and then reused
+        self.assertIs(trx.sender(), trx.sender())
+        self.assertIs(trx.hash_signed(), trx.hash_signed())
+        self.assertFalse(hasattr(trx, '__dict__'))
+
+    def test_hash_signed_without_raw(self):
+        trx = Trx.fromString(bytes.fromhex(RAW_TRX))
+        rebuilt = Trx(*[getattr(trx, name) for name, _ in Trx.fields])
+        self.assertEqual(rebuilt.hash_signed(), trx.hash_signed())
+        self.assertEqual(rebuilt.sender(), trx.sender())
@@ -0,0 +1,80 @@
+import unittest
+from solana.account import Account as SolanaAccount
+from solana.publickey import PublicKey
+from solana.transaction import AccountMeta, Transaction, TransactionInstruction, PACKET_DATA_SIZE
+from ..plugin.solana_rest_api_tools import TransactionInfo, get_transaction_size, make_noniterative_call_trx, \
+    make_partial_call_trx, select_execution_strategy, SIZE_ESTIMATE_STORAGE, STRATEGY_HOLDER, STRATEGY_ITERATIVE, \
+    STRATEGY_SINGLE, SINGLE_TRX_STEP_LIMIT
+
+
+class EthTrx:
+    """The fields of an ethereum transaction the strategy choice reads"""
+    def __init__(self, to_address, msg_size):
+        self.toAddress = to_address
+        self.nonce = 0
+        self.msg = bytes(msg_size)
+
+    def unsigned_msg(self):
+        return self.msg
+
+    def unsigned_msg_hash(self):
+        return bytes(32)
+
+
+def account(idx):
+    return AccountMeta(pubkey=PublicKey(bytes([idx]) * 32), is_signer=False, is_writable=True)
+
+
+class TestExecutionStrategy(unittest.TestCase):
+
+    def setUp(self):
+        self.signer = SolanaAccount(bytes([1]) * 32)
+        self.no_accounts = Transaction()
+
+    def choose(self, msg_size, steps_executed, to_address=b'\x22' * 20, create_acc_trx=None):
+        eth_trx = EthTrx(to_address, msg_size)
+        trx_info = TransactionInfo(PublicKey(bytes([3]) * 32), [account(4), account(5)], eth_trx, steps_executed)
+        if create_acc_trx is None:
+            create_acc_trx = self.no_accounts
+        single_size = get_transaction_size(
+            make_noniterative_call_trx(self.signer, eth_trx, trx_info, eth_trx.msg, create_acc_trx), self.signer)
+        partial_size = get_transaction_size(
+            make_partial_call_trx(self.signer, SIZE_ESTIMATE_STORAGE, eth_trx, trx_info, eth_trx.msg), self.signer)
+        strategy = select_execution_strategy(self.signer, eth_trx, trx_info, eth_trx.msg, create_acc_trx)
+        return strategy, single_size, partial_size
+
+    def test_transaction_size(self):
+        trx = Transaction().add(TransactionInstruction(keys=[account(4)], program_id=PublicKey(2), data=bytes(10)))
+        signed = Transaction(recent_blockhash="11111111111111111111111111111111").add(trx)
+        signed.sign(self.signer)
+        self.assertEqual(get_transaction_size(trx, self.signer), len(signed.serialize()))
+
+    def test_single(self):
+        (strategy, single_size, _) = self.choose(200, SINGLE_TRX_STEP_LIMIT)
+        self.assertLessEqual(single_size, PACKET_DATA_SIZE)
+        self.assertEqual(strategy, STRATEGY_SINGLE)
+        # unknown step count: the size decides
+        self.assertEqual(self.choose(200, None)[0], STRATEGY_SINGLE)
+
+    def test_iterative(self):
+        (strategy, single_size, _) = self.choose(200, SINGLE_TRX_STEP_LIMIT + 1)
+        self.assertLessEqual(single_size, PACKET_DATA_SIZE)
+        self.assertEqual(strategy, STRATEGY_ITERATIVE)
+
+        # the account creation makes the single trx oversize, the partial call does not carry it
+        create_acc_trx = Transaction().add(TransactionInstruction(keys=[], program_id=PublicKey(2), data=bytes(400)))
+        (strategy, single_size, partial_size) = self.choose(400, 10, create_acc_trx=create_acc_trx)
+        self.assertGreater(single_size, PACKET_DATA_SIZE)
+        self.assertLessEqual(partial_size, PACKET_DATA_SIZE)
+        self.assertEqual(strategy, STRATEGY_ITERATIVE)
+
+    def test_holder(self):
+        self.assertEqual(self.choose(200, 10, to_address=None)[0], STRATEGY_HOLDER)
+
+        (strategy, _, partial_size) = self.choose(1000, 10)
+        self.assertGreater(partial_size, PACKET_DATA_SIZE)
+        self.assertEqual(strategy, STRATEGY_HOLDER)
+
+
+if __name__ == '__main__':
+    unittest.main()
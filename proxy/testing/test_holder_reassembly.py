@@ -0,0 +1,67 @@
+import unittest
+from ..indexer.holder_reassembly import IntervalSet, HolderBuffer, HolderReassembler, HEADER_SIZE
+
+
+def holder_image(signature, unsigned_msg):
+    return signature + len(unsigned_msg).to_bytes(8, "little") + unsigned_msg
+
+
+class TestIntervalSet(unittest.TestCase):
+
+    def test_merge(self):
+        intervals = IntervalSet()
+        intervals.add(10, 20)
+        intervals.add(30, 40)
+        self.assertEqual(list(intervals), [(10, 20), (30, 40)])
+        self.assertFalse(intervals.covers(10, 40))
+        intervals.add(15, 35)
+        self.assertEqual(list(intervals), [(10, 40)])
+        intervals.add(40, 50)
+        intervals.add(0, 5)
+        self.assertEqual(list(intervals), [(0, 5), (10, 50)])
+        self.assertTrue(intervals.covers(12, 50))
+        self.assertFalse(intervals.covers(4, 11))
+        self.assertEqual(intervals.size(), 45)
+
+
+class TestHolderReassembly(unittest.TestCase):
+
+    def test_out_of_order_and_overlapping_writes(self):
+        image = holder_image(b'\x01' * 65, b'\xab' * 1000)
+        holder = HolderBuffer('holder')
+        holder.write(500, image[500:])
+        self.assertIsNone(holder.payload())
+        holder.write(0, image[:300])
+        holder.write(200, image[200:600])
+        holder.write(0, image[:100])
+        (signature, unsigned_msg) = holder.payload()
+        self.assertEqual(bytes(signature), b'\x01' * 65)
+        self.assertEqual(bytes(unsigned_msg), b'\xab' * 1000)
+        self.assertEqual(len(holder.data), HEADER_SIZE + 1000)
+
+    def test_state_round_trip(self):
+        image = holder_image(b'\x02' * 65, b'\xcd' * 10)
+        holder = HolderBuffer('holder')
+        holder.write(0, image[:50])
+        holder.signatures.append('sig')
+        restored = HolderBuffer.from_state(holder.to_state())
+        restored.write(50, image[50:])
+        self.assertEqual(bytes(restored.payload()[1]), b'\xcd' * 10)
+        self.assertEqual(restored.signatures, ['sig'])
+
+    def test_memory_limit(self):
+        reassembler = HolderReassembler(max_bytes=1100)
+        reassembler.write('a', 0, b'\x00' * 600, 'sig1', 1)
+        reassembler.write('b', 0, b'\x00' * 300, 'sig2', 2)
+        reassembler.write('a', 600, b'\x00' * 10, 'sig3', 3)
+        reassembler.write('c', 0, b'\x00' * 400, 'sig4', 4)
+        self.assertNotIn('b', reassembler)
+        self.assertIn('a', reassembler)
+        self.assertEqual(reassembler.get('a').signatures, ['sig1', 'sig3'])
+        self.assertEqual(reassembler.total_bytes, 1010)
+        reassembler.pop('a')
+        self.assertEqual(reassembler.total_bytes, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from base58 import b58encode
+from solana.account import Account as SolanaAccount
+from solana.publickey import PublicKey
+from solana.transaction import AccountMeta, Transaction
+from ..plugin.solana_rest_api_tools import MessageTemplate, TransactionInfo, make_continue_instruction
+
+
+class EthTrx:
+    nonce = 0
+
+    def unsigned_msg_hash(self):
+        return bytes(32)
+
+
+class TestMessageTemplate(unittest.TestCase):
+
+    def test_continue_is_byte_identical(self):
+        signer = SolanaAccount(bytes([1]) * 32)
+        storage = PublicKey(bytes([2]) * 32)
+        eth_accounts = [AccountMeta(pubkey=PublicKey(bytes([idx]) * 32), is_signer=False, is_writable=True)
+                        for idx in (4, 5)]
+        trx_info = TransactionInfo(PublicKey(bytes([3]) * 32), eth_accounts, EthTrx())
+        template = trx_info.get_continue_template(signer, storage)
+        self.assertIs(trx_info.get_continue_template(signer, storage), template)
+
+        for (blockhash, step_count) in ((bytes([7]) * 32, 500), (bytes([8]) * 32, 1)):
+            blockhash = b58encode(blockhash).decode('utf-8')
+            trx = Transaction(recent_blockhash=blockhash, fee_payer=signer.public_key())
+            trx.add(make_continue_instruction(signer, storage, trx_info, step_count))
+            trx.sign(signer)
+            self.assertEqual(template.build(blockhash, step_count.to_bytes(8, byteorder="little")), trx.serialize())
+
+    def test_one_signer(self):
+        signer = SolanaAccount(bytes([1]) * 32)
+        trx_info = TransactionInfo(PublicKey(bytes([3]) * 32),
+                                   [AccountMeta(pubkey=PublicKey(bytes([4]) * 32), is_signer=True, is_writable=True)],
+                                   EthTrx())
+        self.assertRaises(Exception, MessageTemplate, signer,
+                          make_continue_instruction(signer, PublicKey(bytes([2]) * 32), trx_info, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
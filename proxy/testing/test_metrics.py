@@ -0,0 +1,47 @@
+import unittest
+from ..indexer.metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        metrics = Metrics()
+        metrics.inc('instructions_total', type="Continue")
+        metrics.inc('instructions_total', 2, type="Continue")
+        metrics.inc('rpc_errors_total', method="getBlock", error='say "no"')
+        metrics.set('lag_slots', 12, kind="receipts")
+        metrics.observe('fetch', 0.5)
+        metrics.observe('fetch', 0.25)
+
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE neon_indexer_instructions_total counter', lines)
+        self.assertIn('neon_indexer_instructions_total{type="Continue"} 3', lines)
+        self.assertIn('neon_indexer_rpc_errors_total{error="say \\"no\\"",method="getBlock"} 1', lines)
+        self.assertIn('# TYPE neon_indexer_lag_slots gauge', lines)
+        self.assertIn('neon_indexer_lag_slots{kind="receipts"} 12', lines)
+        self.assertIn('neon_indexer_stage_calls_total{stage="fetch"} 2', lines)
+        self.assertIn('neon_indexer_stage_seconds_total{stage="fetch"} 0.75', lines)
+
+    def test_summary_deltas(self):
+        metrics = Metrics()
+        metrics.inc('receipts_processed_total', 10)
+        with metrics.time('decode'):
+            pass
+        summary = metrics.summary()
+        self.assertIn('receipts_processed_total +10', summary)
+        self.assertIn('decode ', summary)
+
+        metrics.inc('receipts_processed_total', 5)
+        metrics.set('queue_depth', 3, queue="holders")
+        summary = metrics.summary()
+        self.assertIn('receipts_processed_total +5', summary)
+        self.assertIn('queue_depth[holders] 3', summary)
+        self.assertIn('decode 0.00s/0', summary)
+
+        # unchanged counters are left out
+        self.assertNotIn('receipts_processed_total', metrics.summary())
+        self.assertEqual(metrics.counter('receipts_processed_total'), 15)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import base58
+from ..common_neon.neon_receipt import parse_neon_receipt, NeonReceiptCache
+
+PROGRAM_ID = 'evmLoader1111111111111111111111111111111111'
+
+
+def b58(data):
+    return base58.b58encode(data).decode('utf-8')
+
+
+def make_trx(signature, events):
+    return {
+        'slot': 10,
+        'transaction': {
+            'signatures': [signature],
+            'message': {
+                'accountKeys': ['payer', 'KeccakSecp256k11111111111111111111111111111', PROGRAM_ID],
+                'instructions': [
+                    {'programIdIndex': 1, 'accounts': [], 'data': b58(b'\x01')},
+                    {'programIdIndex': 2, 'accounts': [0], 'data': b58(b'\x13\x00')},
+                ],
+            },
+        },
+        'meta': {
+            'err': None,
+            'innerInstructions': [
+                {'index': 1, 'instructions': [{'programIdIndex': 2, 'accounts': [], 'data': b58(event)}
+                                              for event in events]},
+            ],
+        },
+    }
+
+
+ON_EVENT = b'\x07' + b'\xaa' * 20 + (2).to_bytes(8, 'little') + b'\x01' * 32 + b'\x02' * 32 + b'log data'
+ON_RETURN = b'\x06\x11' + (21000).to_bytes(8, 'little') + b'\xbe\xef'
+
+
+class TestNeonReceipt(unittest.TestCase):
+
+    def test_parse(self):
+        receipt = parse_neon_receipt(make_trx('sig', [ON_EVENT, ON_RETURN]), PROGRAM_ID)
+        self.assertEqual(receipt.signature, 'sig')
+        self.assertEqual([instr.tag for instr in receipt.instructions], [0x01, 0x13])
+        self.assertEqual(len(receipt.evm_instructions(PROGRAM_ID)), 1)
+
+        (event,) = receipt.events
+        self.assertEqual(event.instruction_index, 1)
+        self.assertEqual(event.address, b'\xaa' * 20)
+        self.assertEqual(event.topics, [b'\x01' * 32, b'\x02' * 32])
+        self.assertEqual(event.data, b'log data')
+
+        self.assertTrue(receipt.result.succeeded)
+        self.assertEqual(receipt.result.gas_used, 21000)
+        self.assertEqual(receipt.result.return_value, b'\xbe\xef')
+
+    def test_no_result(self):
+        receipt = parse_neon_receipt(make_trx('sig', [ON_EVENT]), PROGRAM_ID)
+        self.assertIsNone(receipt.result)
+        failed = parse_neon_receipt(make_trx('sig', [b'\x06\xd0' + bytes(8)]), PROGRAM_ID)
+        self.assertFalse(failed.result.succeeded)
+
+    def test_cache(self):
+        cache = NeonReceiptCache(max_size=1)
+        first = cache.get(make_trx('a', [ON_RETURN]), PROGRAM_ID)
+        self.assertIs(cache.get(make_trx('a', [ON_RETURN]), PROGRAM_ID), first)
+        cache.get(make_trx('b', [ON_RETURN]), PROGRAM_ID)
+        self.assertIsNot(cache.get(make_trx('a', [ON_RETURN]), PROGRAM_ID), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from ..indexer.receipt_fetcher import AdaptiveConcurrency, ReceiptFetcher, backoff_delay, FETCH_MAX_BACKOFF
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+
+    def test_additive_increase(self):
+        concurrency = AdaptiveConcurrency(initial=2, maximum=4, target_latency=1.0)
+        for _ in range(100):
+            concurrency.on_success(0.1)
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_multiplicative_decrease(self):
+        concurrency = AdaptiveConcurrency(initial=16, maximum=64, target_latency=1.0)
+        concurrency.on_throttle()
+        self.assertEqual(concurrency.limit, 8)
+        concurrency.on_success(5.0)
+        self.assertLess(concurrency.limit, 8)
+        for _ in range(20):
+            concurrency.on_throttle()
+        self.assertEqual(concurrency.limit, 1)
+
+    def test_backoff(self):
+        self.assertLessEqual(backoff_delay(0), 0.25)
+        self.assertLessEqual(backoff_delay(100), FETCH_MAX_BACKOFF)
+        self.assertEqual(backoff_delay(0, retry_after=3), 3)
+
+
+class FlakyBatchFetcher(ReceiptFetcher):
+    """The second call of every batch fails"""
+
+    def __init__(self):
+        super().__init__('http://localhost:0')
+        self.batches = []
+
+    async def request_batch(self, method, params_list):
+        self.batches.append(params_list)
+        responses = [{'result': {'blockhash': str(params[0])}} for params in params_list]
+        if len(params_list) > 1:
+            responses[1] = {'error': {'code': -32004, 'message': 'Block not available'}}
+        return responses
+
+
+class TestBatchFetch(unittest.TestCase):
+
+    def test_failed_calls_are_retried(self):
+        fetcher = FlakyBatchFetcher()
+        try:
+            blocks = fetcher.fetch_blocks([10, 11, 12])
+        finally:
+            fetcher.close()
+        self.assertEqual(blocks, {10: {'blockhash': '10'}, 11: {'blockhash': '11'}, 12: {'blockhash': '12'}})
+        self.assertEqual([[params[0] for params in batch] for batch in fetcher.batches], [[10, 11, 12], [11]])
+
+
+if __name__ == '__main__':
+    unittest.main()
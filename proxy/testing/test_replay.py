@@ -0,0 +1,241 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+import base58
+import rlp
+from eth_account import Account
+from ..environment import evm_loader_id
+from ..indexer import solana_receipts_update, sql_backend
+from ..indexer.replay import ArchiveWriter, RecordingProvider, RecordingFetcher, ReplayProvider, ReplayFetcher, \
+    ReplaySource, NoCanceller, NotRecordedError, read_archive, replay, replay_client
+from ..indexer.solana_receipts_update import Indexer, DECODE_MAX_RESTARTS, DECODE_MIN_BATCH, decode_trx_payloads, \
+    get_trx_payload
+from ..indexer.utils import get_trx_receipts
+
+TABLES = ('eth_transactions', 'eth_sol_transactions', 'sol_eth_transactions', 'solana_blocks', 'neon_receipts',
+          'unfinalized_transactions', 'logs')
+CHAIN_ID = 111
+
+
+def entry(signature, slot, err=None):
+    return {'signature': signature, 'slot': slot, 'err': err, 'memo': None, 'blockTime': None}
+
+
+def b58(data):
+    return base58.b58encode(data).decode('utf-8')
+
+
+def call_receipt(signature, slot, nonce):
+    """Receipt of a CallFromRawTrx that emits one event and returns"""
+    trx = dict(nonce=nonce, gasPrice=1, gas=21000, to='0x' + '22' * 20, value=1, data=b'', chainId=CHAIN_ID)
+    signed = Account.sign_transaction(trx, '0x' + '01' * 32)
+    unsigned_msg = rlp.encode([nonce, 1, 21000, bytes.fromhex('22' * 20), 1, b'', CHAIN_ID, 0, 0])
+    sign = signed.r.to_bytes(32, 'big') + signed.s.to_bytes(32, 'big') + bytes([signed.v - 35 - 2 * CHAIN_ID])
+    event = b'\x07' + b'\xaa' * 20 + (1).to_bytes(8, 'little') + b'\x01' * 32 + b'log data'
+    result = b'\x06\x11' + (21000).to_bytes(8, 'little')
+    return {
+        'slot': slot,
+        'transaction': {
+            'signatures': [signature],
+            'message': {
+                'accountKeys': [b58(b'\x05' * 32), evm_loader_id],
+                'instructions': [{'programIdIndex': 1, 'accounts': [0],
+                                  'data': b58(b'\x05' + bytes(4) + bytes(20) + sign + unsigned_msg)}],
+            },
+        },
+        'meta': {
+            'err': None,
+            'innerInstructions': [{'index': 0, 'instructions': [{'programIdIndex': 1, 'accounts': [],
+                                                                 'data': b58(data)} for data in (event, result)]}],
+            'logMessages': [],
+        },
+    }
+
+
+def chain_records():
+    """A short evm_loader history: two calls and a failed transaction, blocks 10..14"""
+    signatures = [b58(bytes([idx]) * 64) for idx in range(1, 4)]
+    return [
+        {'method': 'getSignaturesForAddress', 'params': [evm_loader_id, {}], 'result': [
+            entry(signatures[2], 13), entry(signatures[1], 12, err={'InstructionError': [0, 'Custom']}),
+            entry(signatures[0], 11)]},
+        {'method': 'getConfirmedTransaction', 'params': [signatures[0], 'json'],
+         'result': call_receipt(signatures[0], 11, 0)},
+        {'method': 'getConfirmedTransaction', 'params': [signatures[2], 'json'],
+         'result': call_receipt(signatures[2], 13, 1)},
+    ] + [{'method': 'getBlock', 'params': [slot, {}], 'result': {'blockhash': b58(bytes([slot]) * 32)}}
+         for slot in range(10, 15)]
+
+
+class FakeProvider:
+    def __init__(self, responses):
+        self.responses = responses
+
+    def make_request(self, method, *params):
+        return self.responses[method]
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend_instance = sql_backend.backend_instance
+
+    def tearDown(self):
+        sql_backend.backend_instance = self.backend_instance
+        self.directory.cleanup()
+
+    def indexer(self, database, client, fetcher):
+        """An indexer on its own sqlite database"""
+        sql_backend.backend_instance = sql_backend.SQLiteBackend(os.path.join(self.directory.name, database))
+        return Indexer(subscribe=False, client=client, fetcher=fetcher, canceller=NoCanceller())
+
+    def dump(self, indexer):
+        backend = indexer.constants.backend
+        tables = {table: sorted(repr(row) for row in backend.fetchall('SELECT * FROM {}'.format(table)))
+                  for table in TABLES}
+        return (tables, indexer.constants['indexer_state']['cursor'], indexer.constants['last_block'])
+
+    def test_record_and_replay(self):
+        path = os.path.join(self.directory.name, 'archive.jsonl.gz')
+        chain = ReplaySource(chain_records())
+        archive = ArchiveWriter(path)
+        recorded = self.indexer('recorded.sqlite', replay_client(chain), RecordingFetcher(ReplayFetcher(chain), archive))
+        recorded.client._provider = RecordingProvider(recorded.client._provider, archive)
+        archive.write({'header': {'cursor': recorded.cursor, 'last_block': recorded.constants['last_block']}})
+        replay(recorded, chain)
+        archive.close()
+
+        source = ReplaySource.load(path)
+        replayed = self.indexer('replayed.sqlite', replay_client(source), ReplayFetcher(source))
+        (processed, _) = replay(replayed, source)
+        self.assertEqual(processed, 3)
+
+        (tables, cursor, last_block) = self.dump(recorded)
+        self.assertEqual(len(tables['eth_transactions']), 2)
+        self.assertEqual(len(tables['neon_receipts']), 2)
+        self.assertEqual(len(tables['logs']), 2)
+        self.assertEqual(last_block, 14)
+        self.assertEqual(self.dump(replayed), (tables, cursor, last_block))
+
+    def test_missing_response_stops_replay(self):
+        records = [record for record in chain_records()
+                   if record['method'] != 'getBlock' or record['params'][0] != 13]
+        source = ReplaySource(records)
+        indexer = self.indexer('replayed.sqlite', replay_client(source), ReplayFetcher(source))
+        # the block of the second call is needed for its hash
+        self.assertRaises(Exception, replay, indexer, source)
+        self.assertRaises(NotRecordedError, indexer.client._provider.make_request, 'getBlock', 13, {})
+
+    def test_lost_receipt_is_skipped(self):
+        signatures = [b58(bytes([idx]) * 64) for idx in range(1, 4)]
+        records = [record for record in chain_records()
+                   if record['method'] != 'getConfirmedTransaction' or record['params'][0] != signatures[0]]
+        source = ReplaySource(records)
+        indexer = self.indexer('replayed.sqlite', replay_client(source), ReplayFetcher(source))
+        indexer.cursor = None
+        with mock.patch.object(solana_receipts_update, 'RECEIPT_MAX_FETCHES', 3):
+            for attempt in range(1, 3):
+                indexer.gather_unknown_transactions()
+                indexer.process_receipts()
+                # the oldest receipt holds the cursor back
+                self.assertIsNone(indexer.cursor)
+                self.assertEqual(indexer.fetch_attempts, {signatures[0]: attempt})
+
+            indexer.gather_unknown_transactions()
+            indexer.process_receipts()
+            self.assertEqual(indexer.cursor, signatures[2])
+            self.assertEqual(indexer.fetch_attempts, {})
+        self.assertEqual(len(indexer.constants.backend.fetchall('SELECT * FROM eth_transactions')), 1)
+
+    def test_predecode(self):
+        source = ReplaySource()
+        indexer = self.indexer('decoded.sqlite', replay_client(source), ReplayFetcher(source))
+        self.addCleanup(indexer.close)
+        receipts = [call_receipt(b58(idx.to_bytes(2, 'big') * 32), 11, idx) for idx in range(DECODE_MIN_BATCH)]
+        payloads = [get_trx_payload(base58.b58decode(receipt['transaction']['message']['instructions'][0]['data']))
+                    for receipt in receipts]
+        inline = {(bytes(unsigned_msg), bytes(sign)): get_trx_receipts(unsigned_msg, sign)
+                  for (unsigned_msg, sign) in payloads}
+        self.assertEqual(decode_trx_payloads(list(inline)), list(inline.values()))
+        self.assertEqual(decode_trx_payloads([(b'not rlp', bytes(65))]), [None])
+
+        indexer.predecode(receipts)
+        self.assertEqual(indexer.decoded_trxs, inline)
+
+        # a small batch is decoded on the indexer thread
+        indexer.predecode(receipts[1:])
+        self.assertEqual(indexer.decoded_trxs, {})
+        for (payload, result) in inline.items():
+            self.assertEqual(indexer.decode_trx(*payload), result)
+
+        # dead decode processes are replaced a few times, then everything is decoded inline
+        for restart in range(1, DECODE_MAX_RESTARTS + 1):
+            broken = mock.Mock()
+            broken.map.side_effect = BrokenProcessPool("worker died")
+            indexer.decode_pool = broken
+            indexer.predecode(receipts)
+            self.assertEqual(indexer.decoded_trxs, {})
+            broken.shutdown.assert_called_once()
+            if restart < DECODE_MAX_RESTARTS:
+                self.assertIsNotNone(indexer.decode_pool)
+                indexer.decode_pool.shutdown()
+        self.assertIsNone(indexer.decode_pool)
+        indexer.predecode(receipts)
+        self.assertEqual(indexer.decoded_trxs, {})
+
+    def test_record(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'archive.jsonl.gz')
+            archive = ArchiveWriter(path)
+            archive.write({'header': {'cursor': 's0', 'last_block': 5}})
+            provider = RecordingProvider(FakeProvider({
+                'getSlot': {'jsonrpc': '2.0', 'id': 1, 'result': 12},
+                'getBlock': {'jsonrpc': '2.0', 'id': 2, 'error': {'code': -32007, 'message': 'skipped'}},
+            }), archive)
+            self.assertEqual(provider.make_request('getSlot', {'commitment': 'confirmed'})['result'], 12)
+            self.assertIn('error', provider.make_request('getBlock', 11, {}))
+            archive.close()
+
+            # errors are not recorded
+            self.assertEqual(list(read_archive(path)), [
+                {'header': {'cursor': 's0', 'last_block': 5}},
+                {'method': 'getSlot', 'params': [{'commitment': 'confirmed'}], 'result': 12},
+            ])
+
+    def test_signatures(self):
+        # two overlapping pages, as passes with different cursors get them
+        source = ReplaySource([
+            {'method': 'getSignaturesForAddress', 'params': ['evm', {}],
+             'result': [entry('s3', 12), entry('s2', 11), entry('s1', 11)]},
+            {'method': 'getSignaturesForAddress', 'params': ['evm', {'until': 's2'}],
+             'result': [entry('s5', 14), entry('s4', 13, err={'InstructionError': []}), entry('s3', 12)]},
+            {'method': 'getConfirmedTransaction', 'params': ['s5', 'json'], 'result': {'slot': 14, 'meta': {}}},
+            {'method': 'getBlock', 'params': [15, {}], 'result': {'blockhash': 'h15'}},
+        ])
+
+        def history(page):
+            return [item['signature'] for item in page]
+
+        self.assertEqual(history(source.signatures()), ['s5', 's4', 's3', 's2', 's1'])
+        self.assertEqual(history(source.signatures(before='s4', limit=2)), ['s3', 's2'])
+        self.assertEqual(history(source.signatures(until='s3')), ['s5', 's4'])
+        self.assertEqual(source.signatures(before='unknown'), [])
+        self.assertEqual(source.max_slot, 15)
+
+        provider = ReplayProvider(source)
+        self.assertEqual(provider.make_request('getSlot', {'commitment': 'finalized'})['result'], 15)
+        self.assertEqual(provider.make_request('getConfirmedTransaction', 's5', 'json')['result']['slot'], 14)
+        self.assertIsNone(provider.make_request('getConfirmedTransaction', 's1', 'json')['result'])
+        self.assertEqual(provider.make_request('getBlocks', 10, 20, {})['result'], [15])
+        self.assertRaises(NotRecordedError, provider.make_request, 'getBlock', 14, {})
+        statuses = provider.make_request('getSignatureStatuses', ['s4', 'unknown'], {})['result']['value']
+        self.assertEqual(statuses[0]['confirmationStatus'], 'finalized')
+        self.assertIsNotNone(statuses[0]['err'])
+        self.assertIsNone(statuses[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
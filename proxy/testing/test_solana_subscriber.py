@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+from ..indexer import solana_receipts_update
+from ..indexer.solana_receipts_update import Indexer
+from ..indexer.solana_subscriber import SolanaSubscriber, default_ws_url, LOGS_SUBSCRIPTION_ID
+
+
+def logs_notification(signature, slot, err=None):
+    return {'jsonrpc': '2.0', 'method': 'logsNotification',
+            'params': {'result': {'context': {'slot': slot},
+                                  'value': {'signature': signature, 'err': err, 'logs': []}},
+                       'subscription': 5}}
+
+
+class TestSolanaSubscriber(unittest.TestCase):
+
+    def test_default_ws_url(self):
+        self.assertEqual(default_ws_url('http://solana:8899'), 'ws://solana:8900')
+        self.assertEqual(default_ws_url('https://api.devnet.solana.com'), 'wss://api.devnet.solana.com')
+
+    def test_announcements(self):
+        subscriber = SolanaSubscriber('ws://localhost:0', 'program')
+        subscriber.on_message({'jsonrpc': '2.0', 'id': LOGS_SUBSCRIPTION_ID, 'result': 5})
+        self.assertTrue(subscriber.connected)
+        # the first wait after subscribing returns at once: notifications may have been missed before
+        self.assertEqual(subscriber.wait(10), {})
+
+        subscriber.on_message(logs_notification('sig1', 100))
+        subscriber.on_message(logs_notification('sig2', 101, err={'InstructionError': [0, 'Custom']}))
+        subscriber.on_message({'jsonrpc': '2.0', 'method': 'slotNotification',
+                               'params': {'result': {'parent': 104, 'root': 70, 'slot': 105}, 'subscription': 6}})
+        self.assertEqual(subscriber.wait(10), {'sig1': False, 'sig2': True})
+        self.assertEqual(subscriber.slot, 105)
+
+        self.assertEqual(subscriber.wait(10, slot_target=105), {})
+        self.assertEqual(subscriber.wait(0.01), {})
+
+    def test_indexer_slot(self):
+        subscriber = SolanaSubscriber('ws://localhost:0', 'program', 'processed')
+        subscriber.on_message({'jsonrpc': '2.0', 'id': LOGS_SUBSCRIPTION_ID, 'result': 5})
+        subscriber.on_message({'jsonrpc': '2.0', 'method': 'slotNotification',
+                               'params': {'result': {'parent': 104, 'root': 70, 'slot': 105}, 'subscription': 6}})
+        client = mock.Mock()
+        client.get_slot.return_value = {'result': 90}
+        indexer = mock.Mock(subscriber=subscriber, client=client)
+        indexer.subscribed.return_value = True
+
+        with mock.patch.object(solana_receipts_update, 'INDEXER_SUBSCRIBE_COMMITMENT', 'processed'):
+            self.assertEqual(Indexer.get_slot(indexer, 'processed'), 105)
+            self.assertEqual(Indexer.get_slot(indexer, 'recent'), 105)
+            # the announced slot is ahead of the confirmed one
+            self.assertEqual(Indexer.get_slot(indexer, 'confirmed'), 90)
+            client.get_slot.assert_called_once_with(commitment='confirmed')
+
+
+if __name__ == '__main__':
+    unittest.main()
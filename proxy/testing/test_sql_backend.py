@@ -0,0 +1,167 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from ..indexer import sql_backend
+from ..indexer.sql_backend import SQLiteBackend, numbered_placeholders
+from ..indexer.sql_dict import SQLDict
+from ..indexer.sql_tables import UnfinalizedTransactionsDict, BlocksByHashDict, EthereumTransactionsDict
+
+
+class TestSQLiteBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.backend = SQLiteBackend(os.path.join(self.tmpdir.name, 'test.sqlite'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_sql_dict(self):
+        table = SQLDict(tablename='test_table', backend=self.backend)
+        self.assertNotIn('a', table)
+        table['a'] = {'value': 1}
+        table['a'] = {'value': 2}
+        self.assertEqual(table['a'], {'value': 2})
+        self.assertEqual(len(table), 1)
+        del table['a']
+        self.assertRaises(KeyError, table.__getitem__, 'a')
+        self.assertRaises(KeyError, table.__delitem__, 'a')
+
+    def test_bulk_operations(self):
+        table = SQLDict(tablename='test_bulk', backend=self.backend)
+        table.set_many({str(i): [i] for i in range(1500)})
+        table.set_many([('0', ['zero'])])
+        self.assertEqual(len(table), 1500)
+        self.assertEqual(table.get_many(['0', '1', 'missing']), {'0': ['zero'], '1': [1]})
+        self.assertEqual(table.contains_many(str(i) for i in range(1495, 1505)), set(str(i) for i in range(1495, 1500)))
+        self.assertEqual(sum(1 for _ in self.backend.iterate('SELECT key FROM test_bulk', batch_size=100)), 1500)
+
+    def test_unfinalized_transactions(self):
+        table = UnfinalizedTransactionsDict(backend=self.backend)
+        table.set_many({'0x' + '01' * 32: 10, '0x' + '02' * 32: 20, '0x' + '03' * 32: 30})
+        self.assertEqual(table.up_to(20), {'0x' + '01' * 32: 10, '0x' + '02' * 32: 20})
+        del table['0x' + '01' * 32]
+        self.assertEqual(table.up_to(20), {'0x' + '02' * 32: 20})
+
+    def test_ethereum_transaction_without_result(self):
+        # what eth_sendRawTransaction stores when the receipt has no Neon result yet
+        table = EthereumTransactionsDict(backend=self.backend)
+        value = {'eth_trx': 'f86b01', 'slot': 42, 'logs': [], 'status': '0x0', 'gas_used': 0,
+                 'return_value': None, 'from_address': '0x' + '11' * 20}
+        table['0x' + '01' * 32] = value
+        self.assertEqual(table['0x' + '01' * 32], value)
+        table['0x' + '02' * 32] = dict(value, status=1)
+        self.assertEqual(table['0x' + '02' * 32]['status'], '0x1')
+
+    def test_block_hashes_of_slots(self):
+        table = BlocksByHashDict(backend=self.backend)
+        table.set_many({'0x' + '0a' * 32: 10, '0x' + '0b' * 32: 11})
+        self.assertEqual(table.hashes_of([10, 11, 12]), {10: '0x' + '0a' * 32, 11: '0x' + '0b' * 32})
+        self.assertEqual(table.hashes_of([]), {})
+
+    def test_numbered_placeholders(self):
+        self.assertEqual(numbered_placeholders('VALUES (%s,%s) WHERE key = %s'), 'VALUES ($1,$2) WHERE key = $3')
+
+
+class FakeCursor:
+    rowcount = 1
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, params=None):
+        self.conn.server.log.append((self.conn.number, query.split()[0]))
+        if self.conn.server.fail_next:
+            self.conn.server.fail_next = False
+            self.conn.closed = True
+            raise sql_backend.psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    def fetchone(self):
+        return ('value',)
+
+
+class FakeConnection:
+    """Stands for PreparedConnection: the real execute_prepared over a cursor that logs the statements"""
+    if sql_backend.psycopg2 is not None:
+        execute_prepared = sql_backend.PreparedConnection.execute_prepared
+
+    def __init__(self, server, number):
+        self.server = server
+        self.number = number
+        self.prepared = set()
+        self.closed = False
+        self.autocommit = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return sql_backend.psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeServer:
+    """Stands for ThreadedConnectionPool: a new connection per checkout of a closed one"""
+
+    def __init__(self, *args, **kwargs):
+        self.log = []
+        self.connections = 0
+        self.idle = []
+        self.fail_next = False
+        self.fail_connect = False
+
+    def getconn(self):
+        if self.fail_connect:
+            self.fail_connect = False
+            raise sql_backend.psycopg2.OperationalError("could not connect to server")
+        if len(self.idle):
+            return self.idle.pop()
+        self.connections += 1
+        return FakeConnection(self, self.connections)
+
+    def putconn(self, conn, close=False):
+        if not close:
+            self.idle.append(conn)
+
+
+@unittest.skipIf(sql_backend.psycopg2 is None, "no psycopg2")
+class TestPostgresBackend(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch.object(sql_backend.psycopg2.pool, 'ThreadedConnectionPool', FakeServer):
+            self.backend = sql_backend.PostgresBackend()
+        self.server = self.backend.pool.pool
+
+    def test_prepared_once_per_session(self):
+        for _ in range(2):
+            self.assertEqual(self.backend.fetchone_prepared('get', 'SELECT value FROM t WHERE key = %s', ('a',)),
+                             ('value',))
+        self.assertEqual(self.server.log, [(1, 'PREPARE'), (1, 'EXECUTE'), (1, 'EXECUTE')])
+
+    def test_read_is_retried(self):
+        self.backend.fetchone_prepared('get', 'SELECT value FROM t WHERE key = %s', ('a',))
+        self.server.fail_next = True
+        self.assertEqual(self.backend.fetchone_prepared('get', 'SELECT value FROM t WHERE key = %s', ('a',)),
+                         ('value',))
+        # the new session prepares the statement again
+        self.assertEqual(self.server.log, [(1, 'PREPARE'), (1, 'EXECUTE'), (1, 'EXECUTE'),
+                                           (2, 'PREPARE'), (2, 'EXECUTE')])
+
+    def test_write_is_not_repeated(self):
+        self.backend.execute_prepared('insert', 'INSERT INTO t VALUES (%s)', ('a',))
+        # the server may have applied the statement before the connection dropped
+        self.server.fail_next = True
+        self.assertRaises(sql_backend.psycopg2.OperationalError, self.backend.execute_prepared,
+                          'insert', 'INSERT INTO t VALUES (%s)', ('b',))
+        self.assertEqual(self.server.log, [(1, 'PREPARE'), (1, 'EXECUTE'), (1, 'EXECUTE')])
+        self.backend.execute('DELETE FROM t')
+        self.assertEqual(self.server.log[3:], [(2, 'DELETE')])
+
+    def test_failed_checkout_is_retried(self):
+        self.server.fail_connect = True
+        self.backend.execute_prepared('insert', 'INSERT INTO t VALUES (%s)', ('a',))
+        self.assertEqual(self.server.log, [(1, 'PREPARE'), (1, 'EXECUTE')])
+
+
+if __name__ == '__main__':
+    unittest.main()
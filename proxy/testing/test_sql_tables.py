@@ -0,0 +1,100 @@
+import unittest
+from ..indexer.sql_tables import encode_logs, decode_logs, encode_hash, decode_hash, encode_signature, decode_signature, \
+    encode_receipt, decode_receipt
+
+
+class TestSQLTablesEncoding(unittest.TestCase):
+
+    def test_logs_round_trip(self):
+        logs = [
+            {
+                'address': '0x' + '11' * 20,
+                'topics': ['0x' + 'aa' * 32, '0x' + 'bb' * 32],
+                'data': '0x0102',
+                'transactionLogIndex': hex(0),
+                'transactionIndex': hex(1),
+                'blockNumber': hex(123456),
+                'logIndex': hex(2),
+                'transactionHash': '0x' + 'cc' * 32,
+                'blockHash': '0x' + 'dd' * 32,
+            },
+            {
+                'address': '0x' + '22' * 20,
+                'topics': [],
+                'data': '0x',
+                'transactionLogIndex': hex(0),
+                'transactionIndex': hex(0),
+                'blockNumber': hex(7),
+                'logIndex': hex(0),
+            },
+        ]
+        self.assertEqual(decode_logs(encode_logs(logs)), logs)
+        self.assertEqual(decode_logs(encode_logs([])), [])
+
+    def test_keys(self):
+        eth_hash = '0x' + 'ab' * 32
+        self.assertEqual(decode_hash(encode_hash(eth_hash.upper().replace('0X', '0x'))), eth_hash)
+        self.assertRaises(ValueError, encode_hash, '0x1234')
+
+        signature = '5j7s6NiJS3JAkvgkoc18WVAsiSaci2pxB2A6ueCJP4tprA2TFg9wSyTLeYouxPBJEMzJinENTkpA52YStRW5Dia7'
+        self.assertEqual(decode_signature(encode_signature(signature)), signature)
+        self.assertRaises(ValueError, encode_signature, '1111')
+
+    def test_receipt_round_trip(self):
+        program = 'eeLSJgWzzxrqKv1UxtRVVH8FX3qCQWUs9QuAjJpETGU'
+        other = 'KeccakSecp256k11111111111111111111111111111'
+        keys = [
+            '5j7s6NiJS3JAkvgkoc18WVAsiSaci2pxB2A6ueCJP4tp',
+            other,
+            'SysvarC1ock11111111111111111111111111111111',
+            program,
+        ]
+        trx = {
+            'slot': 100,
+            'transaction': {'message': {
+                'accountKeys': keys,
+                'instructions': [
+                    {'programIdIndex': 1, 'accounts': [2], 'data': '3Bxs4'},
+                    {'programIdIndex': 3, 'accounts': [0, 3], 'data': '2UzHM'},
+                ],
+            }},
+            'meta': {
+                'err': None,
+                'logMessages': ['Program log: something'],
+                'innerInstructions': [{'index': 1, 'instructions': [
+                    {'programIdIndex': 3, 'accounts': [0], 'data': '3yZe7d'},
+                    {'programIdIndex': 2, 'accounts': [], 'data': '3Bxs4'},
+                ]}],
+            },
+        }
+        receipt = decode_receipt(encode_receipt(trx, program), 100, False)
+        message = receipt['transaction']['message']
+
+        def resolve(instruction):
+            return (message['accountKeys'][instruction['programIdIndex']],
+                    [message['accountKeys'][idx] for idx in instruction['accounts']],
+                    instruction['data'])
+
+        self.assertEqual(receipt['slot'], 100)
+        self.assertIsNone(receipt['meta']['err'])
+        self.assertEqual(resolve(message['instructions'][0]), (other, [], ''))
+        self.assertEqual(resolve(message['instructions'][1]), (program, [keys[0], program], '2UzHM'))
+        self.assertEqual(len(receipt['meta']['innerInstructions']), 1)
+        inner = receipt['meta']['innerInstructions'][0]
+        self.assertEqual(inner['index'], 1)
+        self.assertEqual([resolve(event) for event in inner['instructions']], [(program, [], '3yZe7d')])
+
+        trx['meta']['err'] = {'InstructionError': [1, 'Custom']}
+        failed = decode_receipt(encode_receipt(trx, program), 100, True)
+        self.assertIsNotNone(failed['meta']['err'])
+        self.assertEqual(failed['transaction']['message']['instructions'], [])
+
+
+class TestSQLDictCopyText(unittest.TestCase):
+
+    def test_copy_text_escaping(self):
+        from ..indexer.sql_backend import copy_text
+        self.assertEqual(copy_text(None), '\\N')
+        self.assertEqual(copy_text(42), '42')
+        self.assertEqual(copy_text('a\tb\nc\\d'), 'a\\tb\\nc\\\\d')
+        self.assertEqual(copy_text(b'\x01\xff'), '\\\\x01ff')
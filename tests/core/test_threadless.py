@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    proxy.py
+    ~~~~~~~~
+    ⚡⚡⚡ Fast, Lightweight, Pluggable, TLS interception capable proxy server focused on
+    Network monitoring, controls & Application development, testing, debugging.
+
+    :copyright: (c) 2013-present by Abhinav Singh and contributors.
+    :license: BSD, see LICENSE for more details.
+"""
+import socket
+import asyncio
+import unittest
+import selectors
+import multiprocessing
+from typing import Dict, List, Union
+from unittest import mock
+
+from proxy.common.flags import Flags
+from proxy.common.types import HasFileno
+from proxy.core.threadless import Threadless
+
+
+class FakeWork:
+
+    def __init__(self, conn: socket.socket) -> None:
+        self.conn = conn
+        self.events: Dict[socket.socket, int] = {conn: selectors.EVENT_READ}
+        self.handled: List[List[Union[int, HasFileno]]] = []
+
+    def get_events(self) -> Dict[socket.socket, int]:
+        return dict(self.events)
+
+    def handle_events(
+            self,
+            readables: List[Union[int, HasFileno]],
+            writables: List[Union[int, HasFileno]]) -> bool:
+        self.handled.append(readables)
+        if self.conn in readables:
+            self.conn.recv(1024)
+        return False
+
+    def is_inactive(self) -> bool:
+        return False
+
+
+class TestThreadless(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.pipe = multiprocessing.Pipe()
+        self.threadless = Threadless(
+            client_queue=self.pipe[0],
+            flags=Flags(),
+            work_klass=mock.MagicMock())
+        self.threadless.selector = mock.MagicMock(wraps=selectors.DefaultSelector())
+        self.threadless.loop = asyncio.new_event_loop()
+        self.pairs = [socket.socketpair() for _ in range(3)]
+        for conn, _ in self.pairs:
+            work = FakeWork(conn)
+            self.threadless.works[conn.fileno()] = work  # type: ignore
+        self.threadless.update_events(list(self.threadless.works))
+
+    def tearDown(self) -> None:
+        self.threadless.loop.close()  # type: ignore
+        for conn, peer in self.pairs:
+            conn.close()
+            peer.close()
+
+    def test_dispatches_ready_works_only(self) -> None:
+        (conn, peer) = self.pairs[1]
+        peer.send(b'ping')
+        self.threadless.run_once()
+
+        work = self.threadless.works[conn.fileno()]
+        self.assertEqual(work.handled, [[conn]])  # type: ignore
+        for idle, _ in (self.pairs[0], self.pairs[2]):
+            self.assertEqual(self.threadless.works[idle.fileno()].handled, [])  # type: ignore
+
+    def test_registers_changes_only(self) -> None:
+        selector = self.threadless.selector
+        self.assertEqual(selector.register.call_count, 3)  # type: ignore
+        (conn, peer) = self.pairs[0]
+        work = self.threadless.works[conn.fileno()]
+
+        # an unchanged interest costs no selector call
+        peer.send(b'ping')
+        self.threadless.run_once()
+        self.assertEqual(selector.register.call_count, 3)  # type: ignore
+        selector.modify.assert_not_called()  # type: ignore
+        selector.unregister.assert_not_called()  # type: ignore
+
+        work.events[conn] = selectors.EVENT_READ | selectors.EVENT_WRITE  # type: ignore
+        peer.send(b'ping')
+        self.threadless.run_once()
+        selector.modify.assert_called_once_with(  # type: ignore
+            conn, selectors.EVENT_READ | selectors.EVENT_WRITE, conn.fileno())
+
+    def test_cleanup_unregisters(self) -> None:
+        (conn, _) = self.pairs[2]
+        with mock.patch('os.close'), mock.patch.object(
+                self.threadless.works[conn.fileno()], 'shutdown', create=True):
+            self.threadless.cleanup(conn.fileno())
+        self.threadless.selector.unregister.assert_called_once_with(conn)  # type: ignore
+        self.assertNotIn(conn.fileno(), self.threadless.registered)